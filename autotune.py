@@ -0,0 +1,177 @@
+import argparse
+import csv
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+
+"""
+Autotuner of the training throughput settings of this machine. Runs short probes of the real training step,
+main.py --mode train --max-steps N in a subprocess each, and measures the images per second. The batch size is
+searched first, upwards until a probe runs out of memory and then bisected between the largest batch that fit
+and the first one that did not. The TensorFlow intra-/inter-op threads and then the data loading threads are
+searched at the best batch size. The best settings are written to a JSON config for main.py --config.
+Arguments autotune.py does not know are passed on to every probe, e.g. the generator preset or image size.
+
+	python autotune.py --output autotune.json --generator-preset mobile
+	python main.py --config autotune.json
+"""
+
+# Signs of an out of memory error in the output of a failed probe
+OOM_MARKERS = ('ResourceExhaustedError', 'OOM when allocating', 'out of memory', 'MemoryError', 'bad_alloc')
+
+PROBE_FIELDS = ['batch_size', 'intra_op_threads', 'inter_op_threads', 'num_data_threads', 'status', \
+	'images_per_second']
+
+# Steps main.write_stats leaves out of the throughput
+WARMUP_STEPS = 2
+
+def run_probe(args, settings, main_args):
+	"""
+	Trains for a few steps with the given settings in a subprocess
+
+	:return: (status, images per second), status is "ok", "oom", "timeout" or "failed"
+	"""
+	with tempfile.TemporaryDirectory() as directory:
+		stats_path = os.path.join(directory, 'stats.json')
+		command = [sys.executable, args.main, '--mode', 'train', '--num-epochs', str(10**6), \
+			'--max-steps', str(WARMUP_STEPS + args.probe_steps), '--fid-every', '0', '--checkpoint-every', '0', \
+			'--checkpoint-dir', os.path.join(directory, 'checkpoints'), '--log-dir', os.path.join(directory, 'logs'), \
+			'--stats-file', stats_path] + main_args
+		for name, value in sorted(settings.items()):
+			command += ['--' + name.replace('_', '-'), str(value)]
+		try:
+			process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, \
+				universal_newlines=True, timeout=args.probe_timeout)
+		except subprocess.TimeoutExpired:
+			return 'timeout', None
+
+		# The kernel's OOM killer sends SIGKILL
+		if process.returncode == -9 or any(marker in process.stdout for marker in OOM_MARKERS):
+			return 'oom', None
+		if process.returncode != 0 or not os.path.exists(stats_path):
+			if args.verbose:
+				print(process.stdout[-2000:])
+			return 'failed', None
+		with open(stats_path, 'r') as f:
+			images_per_second = json.load(f)['images_per_second']
+		if images_per_second is None or math.isnan(images_per_second):
+			# Fewer training steps than the warm up, e.g. a batch larger than the dataset
+			return 'failed', None
+		return 'ok', images_per_second
+
+class Autotuner(object):
+	def __init__(self, args, main_args):
+		self.args = args
+		self.main_args = main_args
+		self.probes = []
+
+	def probe(self, **settings):
+		"""
+		:return: images per second of the settings, None if they did not run; every setting is probed once
+		"""
+		for probe in self.probes:
+			if all(probe[name] == value for name, value in settings.items()):
+				return probe['images_per_second']
+		status, images_per_second = run_probe(self.args, settings, self.main_args)
+		self.probes.append(dict(settings, status=status, images_per_second=images_per_second))
+		print("%-10s %6s %6s %6s  %-8s %s" % (settings['batch_size'], settings['intra_op_threads'], \
+			settings['inter_op_threads'], settings['num_data_threads'], status, \
+			'%.2f' % images_per_second if images_per_second is not None else '-'))
+		return images_per_second
+
+	def best(self, settings, name, values):
+		"""
+		:return: settings with the value of name that probes fastest, the current one included
+		"""
+		values = [settings[name]] + [value for value in values if value != settings[name]]
+		results = [(self.probe(**dict(settings, **{name: value})), value) for value in values]
+		results = [(speed, value) for speed, value in results if speed is not None]
+		return dict(settings, **{name: max(results)[1]}) if results else settings
+
+	def search_batch_size(self, settings):
+		"""
+		Tries the batch sizes in increasing order until one runs out of memory, then bisects between the largest
+		batch that fit and that one
+
+		:return: settings with the fastest batch size that fits
+		"""
+		fitting = None
+		too_large = None
+		for batch_size in sorted(self.args.batch_sizes):
+			speed = self.probe(**dict(settings, batch_size=batch_size))
+			if speed is None and self.probes[-1]['status'] == 'oom':
+				too_large = batch_size
+				break
+			if speed is not None:
+				fitting = batch_size
+
+		for _ in range(self.args.oom_bisections):
+			if fitting is None or too_large is None or too_large - fitting <= 1:
+				break
+			batch_size = (fitting + too_large) // 2
+			if self.probe(**dict(settings, batch_size=batch_size)) is None:
+				too_large = batch_size
+			else:
+				fitting = batch_size
+
+		results = [(probe['images_per_second'], probe['batch_size']) for probe in self.probes \
+			if probe['images_per_second'] is not None]
+		if not results:
+			raise SystemExit("No batch size could be trained, run with --verbose to see why")
+		return dict(settings, batch_size=max(results)[1])
+
+	def tune(self, settings):
+		print("%-10s %6s %6s %6s  %-8s %s" % ('batch', 'intra', 'inter', 'data', 'status', 'images/s'))
+		settings = self.search_batch_size(settings)
+		settings = self.best(settings, 'intra_op_threads', self.args.intra_op_threads)
+		settings = self.best(settings, 'inter_op_threads', self.args.inter_op_threads)
+		settings = self.best(settings, 'num_data_threads', self.args.data_threads)
+		return settings
+
+def thread_counts(cores):
+	"""
+	:return: 0 (TensorFlow's default) and the powers of 2 up to the number of cores, and the number of cores
+	"""
+	counts = [0] + [2 ** i for i in range(int(math.log2(cores)) + 1)]
+	return counts if cores in counts else counts + [cores]
+
+def main():
+	cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+	parser = argparse.ArgumentParser(description='GAUGAN training throughput autotuner, unknown arguments are passed to main.py')
+	parser.add_argument('--main', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'))
+	parser.add_argument('--output', type=str, default='autotune.json', help='Config file for main.py --config')
+	parser.add_argument('--results', type=str, default=None, help='Also write every probe to this CSV file')
+	parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+	parser.add_argument('--oom-bisections', type=int, default=2,
+		help='Probes between the largest batch size that fits and the smallest that runs out of memory')
+	parser.add_argument('--intra-op-threads', type=int, nargs='+', default=thread_counts(cores))
+	parser.add_argument('--inter-op-threads', type=int, nargs='+', default=[0, 1, 2, 4])
+	parser.add_argument('--data-threads', type=int, nargs='+', default=[1, 2, 4, 8])
+	parser.add_argument('--probe-steps', type=int, default=6, help='Timed training steps per probe, after the warm up')
+	parser.add_argument('--probe-timeout', type=float, default=900, help='Seconds before a probe counts as failed')
+	parser.add_argument('--verbose', action='store_true', help='Print the output of failed probes')
+	args, main_args = parser.parse_known_args()
+
+	print("Probing on %d cores, passing %s to main.py" % (cores, ' '.join(main_args) or 'no arguments'))
+	tuner = Autotuner(args, main_args)
+	settings = tuner.tune({'batch_size': min(args.batch_sizes), 'intra_op_threads': 0, 'inter_op_threads': 0, \
+		'num_data_threads': 8})
+	speed = tuner.probe(**settings)
+	print("\nBest: %.2f images/s with --batch-size %d --intra-op-threads %d --inter-op-threads %d " \
+		"--num-data-threads %d" % (speed, settings['batch_size'], settings['intra_op_threads'], \
+		settings['inter_op_threads'], settings['num_data_threads']))
+
+	with open(args.output, 'w') as f:
+		json.dump(settings, f, indent=1)
+	print("Written to %s, train with python main.py --config %s" % (args.output, args.output))
+	if args.results:
+		with open(args.results, 'w') as csvfile:
+			writer = csv.DictWriter(csvfile, fieldnames=PROBE_FIELDS)
+			writer.writeheader()
+			writer.writerows(tuner.probes)
+
+if __name__ == '__main__':
+	main()
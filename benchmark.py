@@ -0,0 +1,500 @@
+import argparse
+import csv
+import os
+import time
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import tensorflow as tf
+
+from code.constants import OPTIMIZER_STATES
+from code.generator import SPADEGenerator, GENERATOR_PRESETS
+from code.incremental import IncrementalGenerator
+from code.memory import allocator_stats
+from code.metrics import inception_model, fid
+from code.modulation_cache import ModulationCache, structure_bytes
+from code.optimizers import state_bytes
+from code.preprocess import load_image_batch
+from code.spadeblock import SpadeBlock
+from code.spadelayer import SpadeLayer
+from code.spectral_norm import frozen_power_iteration
+from code.tiling import tiled_generate, tiled_synthesize, seam_positions
+
+"""
+Micro benchmarks for the generator building blocks. Each benchmark checks that the optimized path matches
+the reference path numerically before timing both.
+"""
+
+def random_segmap(batch_size, height, width, segmap_filters):
+	labels = tf.random.uniform((batch_size, height, width), maxval=segmap_filters, dtype=tf.int32)
+	return tf.one_hot(labels, segmap_filters)
+
+def time_function(fn, *inputs, repeats=10):
+	"""
+	:return: average seconds per call of fn(*inputs), after one warm up call
+	"""
+	fn(*inputs)
+	start = time.perf_counter()
+	for _ in range(repeats):
+		result = fn(*inputs)
+	np.asarray(result)
+	return (time.perf_counter() - start) / repeats
+
+def max_differences(reference_fn, fused_fn, *inputs):
+	"""
+	:return: the max abs difference between the outputs of reference_fn and fused_fn, called with training=True
+	(batch statistics) and with training=False (moving statistics). Training runs first, so the moving statistics
+	are no longer the identity initialization in the inference comparison.
+	"""
+	return [float(tf.reduce_max(tf.abs(reference_fn(*inputs, training=training) - fused_fn(*inputs, training=training)))) \
+		for training in (True, False)]
+
+def modulation_traffic(numel, fused, bytes_per_element=4):
+	"""
+	Bytes read + written by the normalize-modulate part of a SpadeLayer (everything after the hidden segmap
+	convolution) for a feature map with numel elements.
+	"""
+	if fused:
+		# gamma_beta conv output (2N written), then one pass reading x and gamma_beta and writing out
+		return (2 + 4) * numel * bytes_per_element
+	# bn (read x, write norm), gamma and beta conv outputs, 1 + gamma, (1 + gamma) * norm, + beta
+	return (2 + 1 + 1 + 2 + 3 + 3) * numel * bytes_per_element
+
+def benchmark_spade(args):
+	layer = SpadeLayer(in_channels=args.segmap_filters, out_channels=args.channels)
+	features = tf.random.normal((args.batch_size, args.height, args.width, args.channels))
+	segmap = random_segmap(args.batch_size, args.height, args.width, args.segmap_filters)
+
+	# Both paths share the same layer and therefore the same variables and spectral norm state
+	def run(fused):
+		def fn(x, s, training=False):
+			layer.fused = fused
+			return layer(x, s, training=training)
+		return tf.function(fn)
+
+	reference_fn, fused_fn = run(False), run(True)
+	with frozen_power_iteration():
+		train_error, inference_error = max_differences(reference_fn, fused_fn, features, segmap)
+
+		reference_time = time_function(reference_fn, features, segmap, repeats=args.repeats)
+		fused_time = time_function(fused_fn, features, segmap, repeats=args.repeats)
+
+	numel = int(np.prod(features.shape))
+	reference_traffic = modulation_traffic(numel, fused=False)
+	fused_traffic = modulation_traffic(numel, fused=True)
+
+	print("SpadeLayer %dx%dx%d, batch %d" % (args.height, args.width, args.channels, args.batch_size))
+	print("Max abs difference: %.3g training, %.3g inference" % (train_error, inference_error))
+	print("Reference: %.2f ms, %.1f MB modulation traffic" % (reference_time * 1000, reference_traffic / 2**20))
+	print("Fused:     %.2f ms, %.1f MB modulation traffic" % (fused_time * 1000, fused_traffic / 2**20))
+	if max(train_error, inference_error) > args.tolerance:
+		raise SystemExit("Fused SpadeLayer does not match the reference (tolerance %g)" % args.tolerance)
+
+def peak_memory(device, fn, *inputs):
+	"""
+	:return: peak allocator bytes of device while running fn(*inputs), or None where the TensorFlow allocator
+	keeps no statistics (see memory.allocator_stats, which also covers the CPU allocator)
+	"""
+	if allocator_stats(device) is None:
+		return None
+	tf.config.experimental.reset_memory_stats(device)
+	fn(*inputs)
+	tf.test.experimental.sync_devices()
+	return allocator_stats(device)[1]
+
+def benchmark_upsample(args):
+	block = SpadeBlock(args.fin, args.fout, args.segmap_filters)
+	upsample = tf.keras.layers.UpSampling2D()
+	features = tf.random.normal((args.batch_size, args.height // 2, args.width // 2, args.fin))
+	segmap = random_segmap(args.batch_size, args.height, args.width, args.segmap_filters)
+
+	reference_fn = tf.function(lambda x, s, training=False: block(upsample(x), s, training=training))
+	fused_fn = tf.function(lambda x, s, training=False: block(x, s, upsample=True, training=training))
+
+	with tf.device(args.device), frozen_power_iteration():
+		train_error, inference_error = max_differences(reference_fn, fused_fn, features, segmap)
+
+		reference_time = time_function(reference_fn, features, segmap, repeats=args.repeats)
+		fused_time = time_function(fused_fn, features, segmap, repeats=args.repeats)
+		reference_peak = peak_memory(args.device, reference_fn, features, segmap)
+		fused_peak = peak_memory(args.device, fused_fn, features, segmap)
+
+	# Full resolution copies of the block input: the upsampled features plus the batch norm outputs of
+	# spade0 (and spade_s), against low resolution batch norm outputs only in the fused path
+	numel = args.batch_size * args.height * args.width * args.fin
+	normalized_inputs = 2 if block.learned_shortcut else 1
+	reference_bytes = (1 + normalized_inputs) * numel * 4
+	fused_bytes = normalized_inputs * (numel // 4) * 4
+
+	print("SpadeBlock %d -> %d at %dx%d, batch %d" % (args.fin, args.fout, args.height, args.width, args.batch_size))
+	print("Max abs difference: %.3g training, %.3g inference" % (train_error, inference_error))
+	for name, seconds, input_bytes, peak in [('Reference', reference_time, reference_bytes, reference_peak), \
+		('Fused', fused_time, fused_bytes, fused_peak)]:
+		peak_str = "n/a" if peak is None else "%.1f MB" % (peak / 2**20)
+		print("%-9s: %.2f ms, %.1f MB upsampled input tensors, peak memory %s" % (name, seconds * 1000, \
+			input_bytes / 2**20, peak_str))
+	if max(train_error, inference_error) > args.tolerance:
+		raise SystemExit("Fused upsampling does not match the reference (tolerance %g)" % args.tolerance)
+
+def count_flops(concrete_function):
+	"""
+	:return: floating point operations (2 per multiply-add) of one call of a traced function
+	"""
+	options = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+	options['output'] = 'none'
+	profile = tf.compat.v1.profiler.profile(graph=concrete_function.graph, options=options)
+	return profile.total_float_ops
+
+def preset_fid(generator, checkpoint_dir, args):
+	"""
+	:return: FID of a trained generator restored from checkpoint_dir on the first test images
+	"""
+	tf.train.Checkpoint(generator=generator).restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+	dataset = load_image_batch(dir_name=args.test_img_dir, batch_size=args.num_fid_samples, drop_remainder=False)
+	images, seg_maps = next(iter(dataset))
+	with frozen_power_iteration():
+		generated = generator.call(None, seg_maps)
+	return fid(inception_model(args.height, args.width), images, generated)
+
+def benchmark_presets(args):
+	checkpoints = dict(checkpoint.split('=', 1) for checkpoint in args.checkpoint)
+	segmap = random_segmap(1, args.height, args.width, args.segmap_filters)
+
+	rows = []
+	for preset in args.presets:
+		generator = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.width, img_h=args.height, \
+			preset=preset)
+		synthesize = tf.function(lambda s: generator.call(None, s))
+
+		with frozen_power_iteration():
+			flops = count_flops(synthesize.get_concrete_function(tf.TensorSpec(segmap.shape, tf.float32)))
+			latency = time_function(synthesize, segmap, repeats=args.repeats)
+		params = sum(int(np.prod(v.shape)) for v in generator.synthesis_variables())
+		preset_score = preset_fid(generator, checkpoints[preset], args) if preset in checkpoints else None
+
+		rows.append([preset, params, flops, latency * 1000, preset_score])
+
+	print("%-8s %12s %12s %14s %8s" % ('preset', 'params (M)', 'GFLOPs', 'CPU ms/image', 'FID'))
+	for preset, params, flops, latency, preset_score in rows:
+		score_str = 'n/a' if preset_score is None else '%.2f' % preset_score
+		print("%-8s %12.2f %12.2f %14.1f %8s" % (preset, params / 1e6, flops / 1e9, latency, score_str))
+
+	if args.csv:
+		with open(args.csv, 'w') as csvfile:
+			csvwriter = csv.writer(csvfile)
+			csvwriter.writerow(['Preset', 'Parameters', 'FLOPs', 'CPU ms per image', 'FID'])
+			csvwriter.writerows(rows)
+
+def benchmark_separable(args):
+	segmap = random_segmap(1, args.height, args.width, args.segmap_filters)
+	variants = [('standard', ()), ('spade', ('spade',)), ('block', ('block',)), ('both', ('spade', 'block'))]
+
+	print("%-9s %12s %12s %14s" % ('separable', 'params (M)', 'GFLOPs', 'CPU ms/image'))
+	for name, separable in variants:
+		generator = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.width, img_h=args.height, \
+			preset=args.preset, share_segmap_trunk=args.share_segmap_trunk, separable=separable)
+		synthesize = tf.function(lambda s: generator.call(None, s))
+
+		with frozen_power_iteration():
+			flops = count_flops(synthesize.get_concrete_function(tf.TensorSpec(segmap.shape, tf.float32)))
+			latency = time_function(synthesize, segmap, repeats=args.repeats)
+		params = sum(int(np.prod(v.shape)) for v in generator.synthesis_variables())
+
+		print("%-9s %12.2f %12.2f %14.1f" % (name, params / 1e6, flops / 1e9, latency * 1000))
+
+def benchmark_modulation_cache(args):
+	generator = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.width, img_h=args.height, \
+		preset=args.preset, fused_spade=args.fused_spade)
+	generator.prepare_inference()
+	segmaps = random_segmap(args.batch_size, args.height, args.width, args.segmap_filters)
+	cache = ModulationCache(args.cache_mb * 2**20)
+
+	with frozen_power_iteration():
+		synthesize = tf.function(lambda s: generator.call(None, s))
+		modulate = tf.function(generator.segmap_modulations)
+		synthesize_modulated = tf.function(lambda s, m: generator.call(None, s, modulations=m))
+		cached_fn = lambda s: synthesize_modulated(s, cache.modulations(s, 'benchmark', modulate))
+
+		reference = synthesize(segmaps)
+		cached = cached_fn(segmaps)
+		max_error = float(tf.reduce_max(tf.abs(reference - cached)))
+
+		reference_time = time_function(synthesize, segmaps, repeats=args.repeats)
+		hit_time = time_function(cached_fn, segmaps, repeats=args.repeats)
+
+	entry_bytes = structure_bytes(modulate(segmaps)) / args.batch_size
+	print("Generator %s at %dx%d, batch %d" % (args.preset, args.height, args.width, args.batch_size))
+	print("Max abs difference: %.3g" % max_error)
+	print("Uncached:  %.2f ms/image" % (reference_time * 1000 / args.batch_size))
+	print("Cache hit: %.2f ms/image" % (hit_time * 1000 / args.batch_size))
+	print("%.2f MB per cached segmap, %d segmaps fit in %d MB" % (entry_bytes / 2**20, \
+		args.cache_mb * 2**20 // entry_bytes, args.cache_mb))
+	if max_error > args.tolerance:
+		raise SystemExit("Cached modulations do not match the reference (tolerance %g)" % args.tolerance)
+
+def random_label_map(height, width, segmap_filters, region_size=32):
+	"""
+	:return: synthetic segmap labels of blocky regions, shape=[height, width]
+	"""
+	regions = np.random.randint(0, segmap_filters, size=(height // region_size + 1, width // region_size + 1))
+	return np.kron(regions, np.ones((region_size, region_size), dtype=regions.dtype))[:height, :width]
+
+def seam_ratio(image, tile_h, tile_w, margin):
+	"""
+	:return: mean absolute difference between neighbouring pixels across the seams between tiles, relative to
+	the mean over all neighbouring pixels. Around 1 when the seams are invisible.
+	"""
+	image = image.astype(np.float32)
+	dy = np.abs(np.diff(image, axis=0))
+	dx = np.abs(np.diff(image, axis=1))
+	rows = [y - 1 for y in seam_positions(image.shape[0], tile_h, margin)]
+	cols = [x - 1 for x in seam_positions(image.shape[1], tile_w, margin)]
+	seams = np.concatenate([dy[rows].ravel(), dx[:, cols].ravel()])
+	return seams.mean() / np.concatenate([dy.ravel(), dx.ravel()]).mean()
+
+def benchmark_tiling(args):
+	generator = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.tile_width, img_h=args.tile_height, \
+		preset=args.preset)
+	generator.prepare_inference()
+	synthesize = tiled_synthesize(generator)
+
+	print("%-11s %7s %14s %12s %11s" % ('size', 'margin', 'megapixels/s', 'band (MB)', 'seam ratio'))
+	for size in args.sizes:
+		height, width = [int(side) for side in size.split('x')]
+		labels = random_label_map(height, width, args.segmap_filters)
+		for margin in args.margins:
+			# Warm up the traced generator on a small map first
+			tiled_generate(generator, labels[:args.tile_height, :args.tile_width], args.segmap_filters, margin, \
+				synthesize=synthesize)
+			start = time.perf_counter()
+			image = tiled_generate(generator, labels, args.segmap_filters, margin, batch_size=args.batch_size, \
+				synthesize=synthesize)
+			seconds = time.perf_counter() - start
+
+			# Two tile heights of float32 image and weight sums, however large the map
+			band_bytes = 2 * args.tile_height * width * (3 + 1) * 4
+			print("%-11s %7d %14.3f %12.1f %11.2f" % (size, margin, height * width / seconds / 1e6, \
+				band_bytes / 2**20, seam_ratio(image, args.tile_height, args.tile_width, margin)))
+
+def benchmark_incremental(args):
+	generator = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.width, img_h=args.height, \
+		preset=args.preset, share_segmap_trunk=args.share_segmap_trunk, fused_upsample=args.fused_upsample)
+	generator.prepare_inference()
+	incremental = IncrementalGenerator(generator)
+	labels = random_label_map(args.height, args.width, args.segmap_filters)
+	incremental.render(tf.one_hot(labels[np.newaxis], args.segmap_filters))
+
+	print("Generator %s at %dx%d" % (args.preset, args.height, args.width))
+	print("%6s %12s %16s %10s %12s" % ('brush', 'full (ms)', 'incremental (ms)', 'speedup', 'recomputed'))
+	max_error = 0.0
+	for brush in args.brushes:
+		full_times, incremental_times, recomputed = [], [], []
+		for _ in range(args.edits):
+			# Paint a brush x brush square of one label somewhere on the map
+			y = np.random.randint(0, args.height - brush + 1)
+			x = np.random.randint(0, args.width - brush + 1)
+			labels[y:y + brush, x:x + brush] = np.random.randint(args.segmap_filters)
+			segmap = tf.one_hot(labels[np.newaxis], args.segmap_filters)
+
+			start = time.perf_counter()
+			image = incremental.render(segmap)
+			incremental_times.append(time.perf_counter() - start)
+			recomputed.append(incremental.last_recomputed)
+
+			with frozen_power_iteration():
+				start = time.perf_counter()
+				reference = generator.call(None, segmap).numpy()
+				full_times.append(time.perf_counter() - start)
+			max_error = max(max_error, float(np.abs(image - reference).max()))
+
+		full, partial = np.median(full_times) * 1000, np.median(incremental_times) * 1000
+		print("%6d %12.1f %16.1f %9.2fx %11.0f%%" % (brush, full, partial, full / partial, \
+			np.mean(recomputed) * 100))
+	print("Max abs difference: %.3g" % max_error)
+	if max_error > args.tolerance:
+		raise SystemExit("Incremental re-synthesis does not match the full forward pass (tolerance %g)" % args.tolerance)
+
+def benchmark_vgg_cache(args):
+	vgg = SPADEGenerator(args.segmap_filters, img_w=args.width, img_h=args.height).vgg_loss()
+	fake = tf.random.uniform((args.batch_size, args.height, args.width, 3))
+	real = tf.random.uniform((args.batch_size, args.height, args.width, 3))
+	# The round trip through the float16 store of VGGFeatureCache
+	cached = [tf.cast(tf.cast(feature, tf.float16), tf.float32) for feature in vgg.features(real)]
+
+	def gradient(fn):
+		with tf.GradientTape() as tape:
+			tape.watch(fake)
+			loss = fn()
+		return tape.gradient(loss, fake)
+
+	reference = lambda: gradient(lambda: vgg(fake, real))
+	with_cache = lambda: gradient(lambda: vgg(fake, real, fake_features=cached))
+	relative_error = float(tf.abs(vgg(fake, real, fake_features=cached) - vgg(fake, real)) / vgg(fake, real))
+
+	reference_time = time_function(reference, repeats=args.repeats)
+	cached_time = time_function(with_cache, repeats=args.repeats)
+	image_bytes = sum(int(np.prod(feature.shape[1:])) for feature in cached) * 2
+	print("VGG loss + gradient at %dx%d, batch %d" % (args.height, args.width, args.batch_size))
+	print("Relative loss difference with float16 features: %.3g" % relative_error)
+	print("Uncached: %.2f ms, cached: %.2f ms, speedup %.2fx" % (reference_time * 1000, cached_time * 1000, \
+		reference_time / cached_time))
+	print("%.2f MB of features per image" % (image_bytes / 2**20))
+
+def benchmark_optimizer_state(args):
+	segmaps = tf.one_hot(np.stack([random_label_map(args.height, args.width, args.segmap_filters) \
+		for _ in range(args.batch_size)]), args.segmap_filters)
+	# A randomly initialized generator of the same architecture gives targets a student can reach exactly
+	teacher = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.width, img_h=args.height, \
+		preset=args.preset)
+	targets = teacher.call(None, segmaps)
+	checkpoints = sorted(set([args.steps // 4, args.steps // 2, args.steps]))
+
+	rows = []
+	for state in args.states:
+		# Same seed, same initial weights and power iteration vectors for every state
+		tf.random.set_seed(args.seed)
+		student = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.width, img_h=args.height, \
+			preset=args.preset, learning_rate=args.learning_rate, optimizer_state=state)
+		student.call(None, segmaps)
+
+		@tf.function
+		def step():
+			variables = student.synthesis_variables()
+			with tf.GradientTape() as tape:
+				loss = tf.reduce_mean(tf.abs(student.call(None, segmaps) - targets))
+			student.optimizer.apply_gradients(zip(tape.gradient(loss, variables), variables))
+			return loss
+
+		losses = [float(step())]
+		start = time.perf_counter()
+		for _ in range(args.steps - 1):
+			losses.append(float(step()))
+		seconds = (time.perf_counter() - start) / max(1, args.steps - 1)
+		rows.append((state, state_bytes(student.optimizer), seconds, [losses[i - 1] for i in checkpoints]))
+
+	full = rows[0][1] if rows[0][0] == 'float32' else None
+	print("Generator %s at %dx%d, batch %d, %d steps" % (args.preset, args.height, args.width, args.batch_size, \
+		args.steps))
+	print("%-9s %10s %8s %10s   %s" % ('state', 'state MB', 'saved', 'ms/step', \
+		'  '.join('L1 @%-5d' % i for i in checkpoints)))
+	for state, size, seconds, losses in rows:
+		saved = '%.0f%%' % (100 * (1 - size / full)) if full else '-'
+		print("%-9s %10.1f %8s %10.1f   %s" % (state, size / 2**20, saved, seconds * 1000, \
+			'  '.join('%9.4f' % loss for loss in losses)))
+
+def main():
+	parser = argparse.ArgumentParser(description='GAUGAN benchmarks')
+	subparsers = parser.add_subparsers(dest='benchmark')
+	subparsers.required = True
+
+	spade = subparsers.add_parser('spade', help='Fused vs reference SpadeLayer')
+	spade.add_argument('--batch-size', type=int, default=8)
+	spade.add_argument('--height', type=int, default=96)
+	spade.add_argument('--width', type=int, default=128)
+	spade.add_argument('--channels', type=int, default=64)
+	spade.add_argument('--segmap-filters', type=int, default=61)
+	spade.add_argument('--repeats', type=int, default=10)
+	spade.add_argument('--tolerance', type=float, default=1e-4)
+	spade.set_defaults(run=benchmark_spade)
+
+	upsample = subparsers.add_parser('upsample', help='SpadeBlock with fused vs materialized nearest upsampling')
+	upsample.add_argument('--batch-size', type=int, default=8)
+	upsample.add_argument('--height', type=int, default=96, help='output height of the block')
+	upsample.add_argument('--width', type=int, default=128, help='output width of the block')
+	upsample.add_argument('--fin', type=int, default=128)
+	upsample.add_argument('--fout', type=int, default=64)
+	upsample.add_argument('--segmap-filters', type=int, default=61)
+	upsample.add_argument('--device', type=str, default='CPU:0')
+	upsample.add_argument('--repeats', type=int, default=10)
+	upsample.add_argument('--tolerance', type=float, default=1e-4)
+	upsample.set_defaults(run=benchmark_upsample)
+
+	presets = subparsers.add_parser('presets', help='Params, FLOPs, CPU latency and FID of the generator presets')
+	presets.add_argument('--presets', type=str, nargs='+', default=sorted(GENERATOR_PRESETS), choices=sorted(GENERATOR_PRESETS))
+	presets.add_argument('--checkpoint', type=str, action='append', default=[],
+		help='PRESET=DIR checkpoint directory of a trained preset, to report its FID')
+	presets.add_argument('--test-img-dir', type=str, default='./data/landscape_data/test')
+	presets.add_argument('--num-fid-samples', type=int, default=32)
+	presets.add_argument('--height', type=int, default=96)
+	presets.add_argument('--width', type=int, default=128)
+	presets.add_argument('--z-dim', type=int, default=64)
+	presets.add_argument('--segmap-filters', type=int, default=61)
+	presets.add_argument('--repeats', type=int, default=10)
+	presets.add_argument('--csv', type=str, default=None, help='Also write the table to this CSV file')
+	presets.set_defaults(run=benchmark_presets)
+
+	separable = subparsers.add_parser('separable', help='Params, FLOPs and CPU latency with depthwise separable convs')
+	separable.add_argument('--preset', type=str, default='full', choices=sorted(GENERATOR_PRESETS))
+	separable.add_argument('--share-segmap-trunk', action='store_true')
+	separable.add_argument('--height', type=int, default=96)
+	separable.add_argument('--width', type=int, default=128)
+	separable.add_argument('--z-dim', type=int, default=64)
+	separable.add_argument('--segmap-filters', type=int, default=61)
+	separable.add_argument('--repeats', type=int, default=10)
+	separable.set_defaults(run=benchmark_separable)
+
+	modulation_cache = subparsers.add_parser('modulation-cache', help='Generator latency on modulation cache hits')
+	modulation_cache.add_argument('--batch-size', type=int, default=4)
+	modulation_cache.add_argument('--preset', type=str, default='full', choices=sorted(GENERATOR_PRESETS))
+	modulation_cache.add_argument('--fused-spade', action='store_true')
+	modulation_cache.add_argument('--cache-mb', type=int, default=1024)
+	modulation_cache.add_argument('--height', type=int, default=96)
+	modulation_cache.add_argument('--width', type=int, default=128)
+	modulation_cache.add_argument('--z-dim', type=int, default=64)
+	modulation_cache.add_argument('--segmap-filters', type=int, default=61)
+	modulation_cache.add_argument('--repeats', type=int, default=10)
+	modulation_cache.add_argument('--tolerance', type=float, default=1e-4)
+	modulation_cache.set_defaults(run=benchmark_modulation_cache)
+
+	tiling = subparsers.add_parser('tiling', help='Throughput and seam quality of tiled inference on large segmaps')
+	tiling.add_argument('--sizes', type=str, nargs='+', default=['384x512', '768x1024'], help='HEIGHTxWIDTH maps')
+	tiling.add_argument('--margins', type=int, nargs='+', default=[0, 8, 16, 32])
+	tiling.add_argument('--batch-size', type=int, default=8)
+	tiling.add_argument('--preset', type=str, default='full', choices=sorted(GENERATOR_PRESETS))
+	tiling.add_argument('--tile-height', type=int, default=96)
+	tiling.add_argument('--tile-width', type=int, default=128)
+	tiling.add_argument('--z-dim', type=int, default=64)
+	tiling.add_argument('--segmap-filters', type=int, default=61)
+	tiling.set_defaults(run=benchmark_tiling)
+
+	incremental = subparsers.add_parser('incremental', help='Latency of re-synthesis after small local segmap edits')
+	incremental.add_argument('--brushes', type=int, nargs='+', default=[4, 8, 16, 32], help='side of the edited square')
+	incremental.add_argument('--edits', type=int, default=10, help='edits per brush size')
+	incremental.add_argument('--preset', type=str, default='full', choices=sorted(GENERATOR_PRESETS))
+	incremental.add_argument('--share-segmap-trunk', action='store_true')
+	incremental.add_argument('--fused-upsample', action='store_true')
+	incremental.add_argument('--height', type=int, default=96)
+	incremental.add_argument('--width', type=int, default=128)
+	incremental.add_argument('--z-dim', type=int, default=64)
+	incremental.add_argument('--segmap-filters', type=int, default=61)
+	incremental.add_argument('--tolerance', type=float, default=1e-4)
+	incremental.set_defaults(run=benchmark_incremental)
+
+	vgg_cache = subparsers.add_parser('vgg-cache', help='VGG loss with cached vs computed real image features')
+	vgg_cache.add_argument('--batch-size', type=int, default=8)
+	vgg_cache.add_argument('--height', type=int, default=96)
+	vgg_cache.add_argument('--width', type=int, default=128)
+	vgg_cache.add_argument('--segmap-filters', type=int, default=61)
+	vgg_cache.add_argument('--repeats', type=int, default=10)
+	vgg_cache.set_defaults(run=benchmark_vgg_cache)
+
+	optimizer_state = subparsers.add_parser('optimizer-state',
+		help='Memory and convergence of the Adam moment storage options, fitting a student to a random teacher')
+	optimizer_state.add_argument('--states', type=str, nargs='+', default=OPTIMIZER_STATES, choices=OPTIMIZER_STATES)
+	optimizer_state.add_argument('--preset', type=str, default='mobile', choices=sorted(GENERATOR_PRESETS))
+	optimizer_state.add_argument('--batch-size', type=int, default=4)
+	optimizer_state.add_argument('--height', type=int, default=96)
+	optimizer_state.add_argument('--width', type=int, default=128)
+	optimizer_state.add_argument('--z-dim', type=int, default=64)
+	optimizer_state.add_argument('--segmap-filters', type=int, default=61)
+	optimizer_state.add_argument('--learning-rate', type=float, default=0.0001)
+	optimizer_state.add_argument('--steps', type=int, default=200)
+	optimizer_state.add_argument('--seed', type=int, default=0)
+	optimizer_state.set_defaults(run=benchmark_optimizer_state)
+
+	args = parser.parse_args()
+	args.run(args)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,29 @@
+"""
+Settings shared by the command line and the models. This module imports nothing, so that main.py can parse
+its arguments (and answer --help) before TensorFlow is loaded.
+"""
+
+# Channel width going into each of the seven SpadeBlocks and coming out of the last one, in multiples of z_dim
+CHANNEL_MULTIPLIERS = [16, 16, 16, 16, 8, 4, 2, 1]
+
+# Named generator sizes: a multiplier on every channel width, plus the SPADE hidden width and SPADE kernel
+# size of each block
+GENERATOR_PRESETS = {
+	# The original architecture
+	'full': {'width': 1.0, 'hidden_channels': [128] * 7, 'kernel_size': [5] * 7},
+	'half': {'width': 0.5, 'hidden_channels': [64] * 7, 'kernel_size': [5] * 7},
+	'mobile': {'width': 0.25, 'hidden_channels': [64, 64, 64, 32, 32, 32, 32], 'kernel_size': [3] * 7},
+}
+
+# Channel rankings of prune.prune_generator
+PRUNE_SALIENCIES = ['weight_norm', 'bn_scale']
+
+# TFLite conversions of quantize.convert_generator
+QUANTIZE_MODES = ['int8', 'dynamic', 'float']
+
+# Adam moment storage of optimizers.adam, from the plain Keras Adam to bfloat16 and factored moments
+OPTIMIZER_STATES = ['float32', 'bfloat16', 'factored']
+
+# Total stride of the four max pools of VGG19 in front of the last feature the VGG loss uses (block5_conv1).
+# Smaller images pool down to nothing.
+VGG_POOLING_STRIDE = 16
@@ -3,13 +3,14 @@ from tensorflow.keras import Model
 from tensorflow.keras.layers import Dense, Flatten, Conv2D, BatchNormalization, LeakyReLU, Reshape, Conv2DTranspose 
 from tensorflow_addons.layers import InstanceNormalization
 from code.spectral_norm import spectral_conv
+from code.optimizers import adam
 
 
 # forward is call
 # - it is feeding input through the layers
 
 class Discriminator(Model):
-    def __init__(self, segmap_filters, beta1=0.5, beta2=0.999, learning_rate=0.0004):
+    def __init__(self, segmap_filters, beta1=0.5, beta2=0.999, learning_rate=0.0004, optimizer_state='float32'):
         super(Discriminator, self).__init__()
         # Padding, Stride, etc calculations
         KERNEL_SIZE = 4
@@ -18,7 +19,7 @@ class Discriminator(Model):
         self.beta1 = beta1
         self.beta2 = beta2
         self.learning_rate = learning_rate
-        self.optimizer = tf.keras.optimizers.Adam(learning_rate = self.learning_rate, beta_1 = self.beta1, beta_2 = self.beta2)
+        self.optimizer = adam(self.learning_rate, self.beta1, self.beta2, optimizer_state)
 
         # Initial first block
         self.glorot = tf.keras.initializers.GlorotNormal()
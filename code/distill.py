@@ -0,0 +1,142 @@
+import glob
+import json
+import os
+import numpy as np
+import tensorflow as tf
+
+from code.spectral_norm import frozen_power_iteration
+
+"""
+Knowledge distillation of a trained (teacher) SPADEGenerator into a smaller student generator. The teacher
+outputs and the features of a few of its SpadeBlocks are computed once over the training segmaps and cached
+on disk, together with what they were computed from, and the student is trained to match them with an L1 image term, an L1 feature term (through a
+learned 1x1 projection to the teacher's channel width) and the VGG perceptual loss.
+"""
+
+# Written next to the cached batches once they are complete
+CACHE_METADATA = 'teacher.json'
+
+def teacher_cache_matches(cache_dir, metadata):
+	"""
+	:param metadata: what the cache has to be computed from, see cache_teacher_outputs
+
+	:return: whether cache_dir holds a complete cache computed from metadata
+	"""
+	path = os.path.join(cache_dir, CACHE_METADATA)
+	if not os.path.exists(path):
+		return False
+	with open(path, 'r') as f:
+		return json.load(f) == metadata
+
+def cache_teacher_outputs(teacher, dataset, cache_dir, feature_blocks, metadata):
+	"""
+	Runs the teacher once over the dataset and writes one .npz file per batch to cache_dir, holding the
+	segmap labels, the teacher images and the teacher features of the given SpadeBlocks (as float16). A cache
+	already in cache_dir is replaced.
+
+	:param teacher: a restored SPADEGenerator
+	:param dataset: dataset of (image, segmap) batches, segmaps may be pyramids
+	:param cache_dir: directory to write the cache to
+	:param feature_blocks: indices of the SpadeBlocks whose outputs are distilled
+	:param metadata: JSON serializable description of the teacher checkpoint, feature_blocks and the data, for
+	teacher_cache_matches
+
+	:return: the number of cached batches
+	"""
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+	# The metadata is removed first and written last, so that an interrupted cache is not taken for a complete one
+	for path in glob.glob(os.path.join(cache_dir, CACHE_METADATA)) + glob.glob(os.path.join(cache_dir, 'batch*.npz')):
+		os.remove(path)
+
+	# Every batch sees the same, converged spectral norms, not ones that are still changing with each call
+	teacher.prepare_inference()
+	num_batches = 0
+	with frozen_power_iteration():
+		for _, seg_maps in dataset:
+			teacher_images, teacher_features = teacher.call(None, seg_maps, return_features=True)
+
+			# Segmaps are one hot, so the labels of the full resolution segmap are enough to rebuild them
+			seg_maps = seg_maps[-1] if isinstance(seg_maps, tuple) else seg_maps
+			arrays = {'labels': np.argmax(seg_maps, axis=-1).astype(np.uint8), \
+				'images': np.asarray(teacher_images, dtype=np.float16)}
+			for block in feature_blocks:
+				arrays['feature%d' % block] = np.asarray(teacher_features[block], dtype=np.float16)
+
+			np.savez(os.path.join(cache_dir, 'batch%06d.npz' % num_batches), **arrays)
+			num_batches += 1
+
+	with open(os.path.join(cache_dir, CACHE_METADATA), 'w') as f:
+		json.dump(metadata, f, indent=1)
+	return num_batches
+
+def load_teacher_cache(cache_dir, segmap_filters, feature_blocks):
+	"""
+	:param cache_dir: directory written by cache_teacher_outputs
+	:param segmap_filters: number of channels in the one hot segmap
+
+	:return: dataset of (segmaps, teacher images, tuple of teacher features) batches, reshuffled every epoch
+	"""
+	paths = sorted(glob.glob(os.path.join(cache_dir, 'batch*.npz')))
+	if not paths:
+		raise ValueError('No cached teacher outputs in "%s"' % cache_dir)
+
+	with np.load(paths[0]) as batch:
+		signature = (tf.TensorSpec((None,) + batch['labels'].shape[1:], tf.uint8), \
+			tf.TensorSpec((None,) + batch['images'].shape[1:], tf.float16), \
+			tuple(tf.TensorSpec((None,) + batch['feature%d' % block].shape[1:], tf.float16) \
+			for block in feature_blocks))
+
+	def read_batches():
+		for path in np.random.permutation(paths):
+			with np.load(path) as batch:
+				yield batch['labels'], batch['images'], tuple(batch['feature%d' % block] for block in feature_blocks)
+
+	dataset = tf.data.Dataset.from_generator(read_batches, output_signature=signature)
+	dataset = dataset.map(lambda labels, images, features: (tf.one_hot(tf.cast(labels, tf.int32), segmap_filters), \
+		tf.cast(images, tf.float32), tuple(tf.cast(feature, tf.float32) for feature in features)))
+	return dataset.prefetch(1)
+
+class Distiller(tf.keras.Model):
+	"""
+	Holds the 1x1 projections from the student's feature widths to the teacher's and computes the
+	distillation loss.
+	"""
+	def __init__(self, student, teacher, feature_blocks, lambda_feature=1, lambda_vgg=10):
+		super(Distiller, self).__init__()
+		self.student = student
+		self.feature_blocks = list(feature_blocks)
+		self.lambda_feature = lambda_feature
+		self.lambda_vgg = lambda_vgg
+		self.glorot = tf.keras.initializers.GlorotNormal()
+
+		self.projections = [tf.Variable(self.glorot(shape=[1,1,student.block_configs[block]['fout'], \
+			teacher.block_configs[block]['fout']])) for block in self.feature_blocks]
+
+	def distillation_variables(self):
+		"""
+		The student's synthesis variables followed by the feature projections
+		"""
+		return self.student.synthesis_variables() + list(self.projections)
+
+	def loss(self, student_image, student_features, teacher_image, teacher_features):
+		"""
+		:param student_image: student output, shape=[batch_size, height, width, 3]
+		:param student_features: outputs of every student SpadeBlock
+		:param teacher_image: cached teacher output
+		:param teacher_features: cached teacher outputs of the SpadeBlocks in feature_blocks
+
+		:return: (total loss, image loss, feature loss, vgg loss)
+		"""
+		image_loss = tf.reduce_mean(tf.abs(student_image - teacher_image))
+
+		feature_loss = 0
+		for block, projection, teacher_feature in zip(self.feature_blocks, self.projections, teacher_features):
+			projected = tf.nn.conv2d(student_features[block], projection, strides=1, padding="SAME")
+			feature_loss += tf.reduce_mean(tf.abs(projected - teacher_feature))
+
+		# Same argument order as SPADEGenerator.loss, the gradient flows through the first argument
+		vgg_loss = self.student.vgg_loss()(student_image, teacher_image)
+
+		total = image_loss + self.lambda_feature * feature_loss + self.lambda_vgg * vgg_loss
+		return total, image_loss, feature_loss, vgg_loss
@@ -0,0 +1,160 @@
+import csv
+import hashlib
+import os
+import re
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from code.inference import list_segmaps
+from code.metrics import activations, evaluate_activations
+from code.preprocess import decode_segmap
+from code.spectral_norm import frozen_power_iteration
+
+"""
+Checkpoint evaluation in a process of its own, so that training never waits for InceptionV3. The evaluator
+follows the checkpoints that training saves, restores the generator from each new one, generates images for a
+fixed subset of the test set in large batches and appends the FID, KID and precision/recall to a CSV log keyed
+by training step. The activations of the real images are computed once and cached on disk.
+"""
+
+EVALUATION_FIELDS = ['step', 'checkpoint', 'fid', 'kid', 'kid_std', 'precision', 'recall', 'num_samples', 'seconds']
+
+def evaluation_dataset(paths, num_objects, batch_size, n_threads=8):
+	"""
+	:param paths: segmap paths; the real image of "x_seg.png" is "x.jpg", as in preprocess.load_image_batch
+
+	:return: dataset of (images, segmaps) batches, in the order of paths
+	"""
+	def load_pair(segmap_path):
+		image_path = tf.strings.join([tf.strings.substr(segmap_path, 0, tf.strings.length(segmap_path) - 8), '.jpg'])
+		image = tf.image.convert_image_dtype(tf.io.decode_png(tf.io.read_file(image_path), channels=3), tf.float32)
+		return image, decode_segmap(segmap_path, num_objects)
+
+	dataset = tf.data.Dataset.from_tensor_slices(paths)
+	dataset = dataset.map(load_pair, num_parallel_calls=n_threads)
+	return dataset.batch(batch_size).prefetch(2)
+
+def checkpoint_step(checkpoint_path):
+	"""
+	:return: training step saved with the checkpoint, or its CheckpointManager number for checkpoints saved
+	without a step
+	"""
+	try:
+		return int(tf.train.load_variable(checkpoint_path, 'step/.ATTRIBUTES/VARIABLE_VALUE'))
+	except (tf.errors.NotFoundError, ValueError):
+		match = re.search(r'-(\d+)$', checkpoint_path)
+		return int(match.group(1)) if match else -1
+
+class EvaluationLog(object):
+	"""
+	CSV of evaluation results, one row per checkpoint. Checkpoints already in the log are not evaluated again
+	when the evaluator is restarted.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.evaluated = set()
+		if os.path.exists(path):
+			with open(path, 'r') as f:
+				self.evaluated.update(row['checkpoint'] for row in csv.DictReader(f))
+
+	def append(self, row):
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		new_file = not os.path.exists(self.path)
+		with open(self.path, 'a') as f:
+			writer = csv.DictWriter(f, fieldnames=EVALUATION_FIELDS)
+			if new_file:
+				writer.writeheader()
+			writer.writerow(row)
+		self.evaluated.add(row['checkpoint'])
+
+def real_activations(model, dataset, paths, cache_dir=None):
+	"""
+	:return: activations of the real images of dataset, loaded from cache_dir if they were computed for the
+	same image paths and model input size before
+	"""
+	if cache_dir is None:
+		return np.concatenate([activations(model, images) for images, _ in dataset], axis=0)
+
+	digest = hashlib.sha1(('\n'.join(paths) + str(model.input_shape)).encode()).hexdigest()
+	cache_path = os.path.join(cache_dir, 'real_activations_%s.npy' % digest[:16])
+	if os.path.exists(cache_path):
+		return np.load(cache_path)
+	result = real_activations(model, dataset, paths)
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+	np.save(cache_path, result)
+	return result
+
+class CheckpointEvaluator(object):
+	def __init__(self, generator, model, dir_name, num_objects, num_samples=500, batch_size=32, n_threads=8, \
+		cache_dir=None):
+		"""
+		:param generator: an unrestored SPADEGenerator of the architecture being trained
+		:param model: see metrics.inception_model
+		:param dir_name: test directory the fixed evaluation subset is taken from
+		:param num_samples: size of the subset, the first segmaps in sorted order
+		:param cache_dir: optional directory the real image activations are cached in
+		"""
+		self.generator = generator
+		self.model = model
+		# Built now, so that every weight, batch norm statistics included, has to come from the checkpoints
+		generator.call(None, tf.zeros([1, generator.img_h, generator.img_w, generator.segmap_filters]))
+		paths = list_segmaps(dir_name)[:num_samples]
+		self.dataset = evaluation_dataset(paths, num_objects, batch_size, n_threads)
+		self.synthesize = tf.function(lambda segmaps: generator.call(None, segmaps), reduce_retracing=True)
+
+		self.real_activations = real_activations(model, self.dataset, paths, cache_dir)
+		self.num_samples = len(self.real_activations)
+
+	def evaluate(self, checkpoint_path):
+		"""
+		:return: a row of the evaluation log for the checkpoint
+		"""
+		start = time.perf_counter()
+		try:
+			tf.train.Checkpoint(generator=self.generator).restore(checkpoint_path).expect_partial() \
+				.assert_existing_objects_matched()
+		except AssertionError:
+			# The assertion message lists the values of every unmatched weight
+			raise ValueError("%s lacks weights of the generator being evaluated, check the architecture flags" % \
+				checkpoint_path) from None
+		self.generator.prepare_inference()
+
+		generated = []
+		with frozen_power_iteration():
+			for _, segmaps in self.dataset:
+				generated.append(activations(self.model, self.synthesize(segmaps).numpy()))
+
+		row = evaluate_activations(self.real_activations, np.concatenate(generated, axis=0))
+		row.update({'step': checkpoint_step(checkpoint_path), 'checkpoint': checkpoint_path, \
+			'num_samples': self.num_samples, 'seconds': round(time.perf_counter() - start, 1)})
+		return row
+
+def follow_checkpoints(evaluator, checkpoint_dir, log, poll_seconds=60):
+	"""
+	Evaluates every checkpoint in checkpoint_dir that is not in the log yet, oldest first, then waits for new
+	ones. Returns once the pending checkpoints are done if poll_seconds is 0.
+	"""
+	while True:
+		state = tf.train.get_checkpoint_state(checkpoint_dir)
+		pending = [path for path in (state.all_model_checkpoint_paths if state else []) if path not in log.evaluated]
+		for path in pending:
+			try:
+				row = evaluator.evaluate(path)
+			except tf.errors.NotFoundError as e:
+				# CheckpointManager deletes old checkpoints, this one may be gone already. Other errors, e.g. a
+				# checkpoint of another architecture, would fail for every checkpoint and stop the evaluator
+				print("Could not evaluate %s: %s" % (path, e))
+				continue
+			log.append(row)
+			print("Step %d: FID %.3f, KID %.4f +- %.4f, precision %.3f, recall %.3f over %d samples (%s, %.1fs)" % \
+				(row['step'], row['fid'], row['kid'], row['kid_std'], row['precision'], row['recall'], \
+				row['num_samples'], path, row['seconds']))
+
+		if poll_seconds <= 0:
+			return
+		time.sleep(poll_seconds)
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+"""
+Disk cache of the VGG19 features of the real training images. The real branch of the VGG loss sees the same
+images every epoch (there is no augmentation), so its five section outputs are computed once, stored in one
+memory mapped array per section and read back by the input pipeline in later epochs. Entries are keyed by
+the image file (path, size and modification time) and a description of the preprocessing, such as the image
+size, so edited images or a changed resolution are never served stale features. The store has a fixed number
+of slots derived from its size cap; once it is full, the remaining images keep going through VGG. Every image
+is seen once per epoch, so evicting entries would not save any work.
+"""
+
+def image_path(segmap_path):
+	"""
+	:return: the real image of a segmap, "x.jpg" for "x_seg.png", as in preprocess.load_image_batch
+	"""
+	return segmap_path[:-len('_seg.png')] + '.jpg'
+
+class VGGFeatureCache(object):
+	def __init__(self, cache_dir, shapes, max_bytes, preprocessing, dtype=np.float16):
+		"""
+		:param cache_dir: directory of the memory mapped arrays and their index
+		:param shapes: [height, width, channels] of every VGG section output for one image
+		:param max_bytes: size cap of the arrays, which decides how many images are cached
+		:param preprocessing: description of everything besides the image file the features depend on, e.g.
+		the image size and the VGG weights
+		:param dtype: storage type, float16 halves the disk and page cache footprint
+		"""
+		self.cache_dir = cache_dir
+		self.shapes = [tuple(int(side) for side in shape) for shape in shapes]
+		self.preprocessing = preprocessing
+		self.dtype = np.dtype(dtype)
+		image_bytes = sum(int(np.prod(shape)) for shape in self.shapes) * self.dtype.itemsize
+		self.capacity = int(max_bytes // image_bytes)
+		self.index_path = os.path.join(cache_dir, 'index.json')
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+		layout = {'shapes': self.shapes, 'dtype': self.dtype.name, 'capacity': self.capacity}
+		self.slots = {}
+		if os.path.exists(self.index_path):
+			with open(self.index_path, 'r') as f:
+				index = json.load(f)
+			# A different layout means different array files, start over
+			if index['layout'] == json.loads(json.dumps(layout)):
+				self.slots = index['slots']
+		self.layout = layout
+
+		mode = 'r+' if self.slots else 'w+'
+		self.arrays = [np.memmap(os.path.join(cache_dir, 'section%d.npy' % i), dtype=self.dtype, mode=mode, \
+			shape=(max(1, self.capacity),) + shape) for i, shape in enumerate(self.shapes)]
+
+	def key(self, segmap_path):
+		path = image_path(segmap_path)
+		stat = os.stat(path)
+		return hashlib.sha1(('%s|%d|%d|%s' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, \
+			self.preprocessing)).encode()).hexdigest()
+
+	def read(self, segmap_path):
+		"""
+		:return: the cached features of one image and True, or zeros and False on a miss
+		"""
+		segmap_path = segmap_path.decode() if isinstance(segmap_path, bytes) else segmap_path
+		with self.lock:
+			slot = self.slots.get(self.key(segmap_path))
+			if slot is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+		if slot is None:
+			return tuple(np.zeros(shape, dtype=self.dtype) for shape in self.shapes) + (False,)
+		return tuple(np.array(array[slot]) for array in self.arrays) + (True,)
+
+	def lookup(self, segmap_path):
+		"""
+		Input pipeline version of read, see preprocess.load_image_batch
+
+		:return: (segmap_path, tuple of features as float32, whether they were cached)
+		"""
+		dtype = tf.as_dtype(self.dtype)
+		result = tf.numpy_function(self.read, [segmap_path], [dtype] * len(self.shapes) + [tf.bool])
+		features = []
+		for feature, shape in zip(result[:-1], self.shapes):
+			feature.set_shape(shape)
+			features.append(tf.cast(feature, tf.float32))
+		hit = tf.ensure_shape(result[-1], [])
+		return segmap_path, tuple(features), hit
+
+	def write(self, segmap_paths, features):
+		"""
+		Caches the features of a batch of images, as long as there are free slots
+
+		:param segmap_paths: segmap path of every image in the batch
+		:param features: VGG section outputs of the batch, see VGG_Loss.features
+		"""
+		features = [np.asarray(feature) for feature in features]
+		for i, segmap_path in enumerate(segmap_paths):
+			segmap_path = segmap_path.decode() if isinstance(segmap_path, bytes) else segmap_path
+			key = self.key(segmap_path)
+			with self.lock:
+				if key in self.slots or len(self.slots) >= self.capacity:
+					continue
+				slot = len(self.slots)
+			for array, feature in zip(self.arrays, features):
+				array[slot] = feature[i]
+			# Only visible to readers once the features are in place
+			with self.lock:
+				self.slots[key] = slot
+
+	def flush(self):
+		"""
+		Writes the arrays and the index to disk, so the next run starts with the cached features
+		"""
+		for array in self.arrays:
+			array.flush()
+		with self.lock:
+			index = {'layout': self.layout, 'slots': dict(self.slots)}
+		temporary = self.index_path + '.tmp'
+		with open(temporary, 'w') as f:
+			json.dump(index, f)
+		os.replace(temporary, self.index_path)
@@ -1,30 +1,77 @@
+import json
 import numpy as np
 import tensorflow as tf
 from code.spadeblock import SpadeBlock
+from code.spadelayer import segmap_at
 from tensorflow.keras.layers import UpSampling2D, LeakyReLU, Conv2D, Dense
-from code.spectral_norm import spectral_conv
+from code.spectral_norm import spectral_conv, conv_weights, refine_power_iteration
 from code.vgg import VGG_Loss
+from code.constants import CHANNEL_MULTIPLIERS, GENERATOR_PRESETS
+from code.optimizers import adam
+
+def preset_block_configs(preset, z_dim):
+    """
+    Expands a named preset into one config per SpadeBlock.
+
+    :param preset: a key of GENERATOR_PRESETS
+    :param z_dim: the base channel width (nf)
+
+    :return: list of dicts with the fin, fout, hidden_channels and kernel_size of each SpadeBlock
+    """
+    if preset not in GENERATOR_PRESETS:
+        raise ValueError('Unknown generator preset "%s", expected one of %s' % (preset, sorted(GENERATOR_PRESETS)))
+    config = GENERATOR_PRESETS[preset]
+    widths = [max(1, int(round(m * z_dim * config['width']))) for m in CHANNEL_MULTIPLIERS]
+
+    return [{'fin': widths[i], 'fout': widths[i + 1], 'hidden_channels': config['hidden_channels'][i], \
+        'kernel_size': config['kernel_size'][i]} for i in range(len(widths) - 1)]
+
+def save_block_configs(block_configs, path):
+    """
+    Writes per block configs (e.g. of a pruned generator, which no preset describes) to a JSON file
+    """
+    # Keras wraps the configs stored on the model in trackable containers, json needs plain ones
+    plain = [{key: list(value) if isinstance(value, (list, tuple)) else value for key, value in config.items()} \
+        for config in block_configs]
+    with open(path, 'w') as f:
+        json.dump(plain, f, indent=2)
+
+def load_block_configs(path):
+    with open(path, 'r') as f:
+        return json.load(f)
 
 class SPADEGenerator(tf.keras.Model):
+    # Whether the features are upsampled by 2 before each of the seven SpadeBlocks
+    UPSAMPLE_BEFORE = [False, True, False, True, True, True, True]
+
     def __init__(self, segmap_filters, beta1=0.5, beta2=0.999, learning_rate=0.0001, batch_size=16, z_dim=64, \
-        img_w=128, img_h=96, lambda_vgg=10):
+        img_w=128, img_h=96, lambda_vgg=10, fused_spade=False, share_segmap_trunk=False, \
+        fused_upsample=False, preset='full', block_configs=None, separable=(), optimizer_state='float32'):
         super(SPADEGenerator, self).__init__()
         
         self.beta1 = beta1
         self.beta2 = beta2
         self.learning_rate = learning_rate
-        self.optimizer = tf.keras.optimizers.Adam(learning_rate = self.learning_rate, beta_1 = self.beta1, beta_2 = self.beta2)
+        # optimizer_state picks the Adam moment storage, see optimizers.py
+        self.optimizer = adam(self.learning_rate, self.beta1, self.beta2, optimizer_state)
         self.batch_size = batch_size
         self.num_channels = z_dim
-        self.upsample_count = 5
+        self.upsample_count = sum(self.UPSAMPLE_BEFORE)
         self.img_w = img_w
         self.img_h = img_h
         self.lambda_vgg = lambda_vgg
         self.glorot = tf.keras.initializers.GlorotNormal()
 
         self.sw, self.sh = self.compute_latent_vector_size()
-        self.fc = tf.Variable(self.glorot(shape=[3,3,segmap_filters,16*z_dim]))
-        self.fc_bias = tf.Variable(self.glorot(shape=[16*z_dim]))
+
+        # Per block channel widths and SPADE settings, from a preset unless given explicitly
+        if block_configs is None:
+            block_configs = preset_block_configs(preset, z_dim)
+        self.block_configs = block_configs
+        self.segmap_filters = segmap_filters
+
+        self.fc = tf.Variable(self.glorot(shape=[3,3,segmap_filters,block_configs[0]['fin']]))
+        self.fc_bias = tf.Variable(self.glorot(shape=[block_configs[0]['fin']]))
 
         # Not sure what this is for
         #self.dense = tf.keras.layers.Dense(self.sh*self.sw*self.num_channels, dtype=tf.float32)
@@ -35,84 +82,234 @@ class SPADEGenerator(tf.keras.Model):
         self.z_dim = z_dim
 
         # SPADE LAYERS
+        # separable lists the layer types ("spade" and/or "block") that use depthwise separable convolutions
+        self.separable = tuple(separable)
         self.dense = Dense(z_dim * 16 * self.sw * self.sh)
-        self.spade_layers0 = SpadeBlock(16 * nf, 16 * nf, segmap_filters)
-        self.spade_layers1 = SpadeBlock(16 * nf, 16 * nf, segmap_filters)
-        self.spade_layers2 = SpadeBlock(16 * nf, 16 * nf, segmap_filters)
-        self.spade_layers3 = SpadeBlock(16 * nf, 8 * nf, segmap_filters)
-        self.spade_layers4 = SpadeBlock(8 * nf, 4 * nf, segmap_filters)
-        self.spade_layers5 = SpadeBlock(4 * nf, 2 * nf, segmap_filters)
-        self.spade_layers6 = SpadeBlock(2 * nf, 1 * nf, segmap_filters)
+        blocks = [SpadeBlock(config['fin'], config['fout'], segmap_filters, fused_spade=fused_spade, \
+            shared_trunk=share_segmap_trunk, hidden_channels=config['hidden_channels'], \
+            spade_kernel_size=config['kernel_size'], separable='block' in self.separable, \
+            separable_spade='spade' in self.separable, middle_channels=config.get('middle_channels')) \
+            for config in block_configs]
+        self.spade_layers0, self.spade_layers1, self.spade_layers2, self.spade_layers3, \
+            self.spade_layers4, self.spade_layers5, self.spade_layers6 = blocks
+
+        # One segmap embedding per resolution, shared by all SpadeLayers at that resolution, instead of one
+        # per SpadeLayer. Only the gamma/beta heads stay per layer.
+        self.share_segmap_trunk = share_segmap_trunk
+        if self.share_segmap_trunk:
+            trunk_configs = self.trunk_configs()
+            self.trunk_convs = [conv_weights(self.glorot, config['kernel_size'], segmap_filters, \
+                config['hidden_channels'], 'spade' in self.separable) for config in trunk_configs]
+            self.trunk_biases = [tf.Variable(self.glorot(shape=[config['hidden_channels']])) \
+                for config in trunk_configs]
 
         # filters=3, kernel=3, strides=1
-        self.conv_layer = tf.Variable(self.glorot(shape=[3,3,nf,3]))
+        self.conv_layer = tf.Variable(self.glorot(shape=[3,3,block_configs[-1]['fout'],3]))
         self.conv_bias = tf.Variable(self.glorot(shape=[3]))
 
         # Unsample layer by 2
         self.upsample = UpSampling2D()
+        # Fused upsampling hands the low resolution features to the next SpadeBlock, which upsamples them
+        # inside its normalize-modulate step instead of materializing the upsampled activation
+        self.fused_upsample = fused_upsample
 
 
         self.lrelu = LeakyReLU(alpha=0.2)
         self.bce = tf.keras.losses.BinaryCrossentropy()
-        self.vgg_loss_obj = VGG_Loss()
+        # Built by vgg_loss on first use, so that inference never loads the VGG19 weights
+        self.vgg_loss_obj = None
     
-    def call(self, noise, segs):
+    def call(self, noise, segs, return_features=False, modulations=None):
+        """
+        :param return_features: also return the output of every SpadeBlock, for distillation
+        :param modulations: output of segmap_modulations for segs, to skip the whole segmap branch
+        """
         #reshaped = tf.reshape(result_dense, [-1, self.image_width, self.image_height, self.num_channels])
         #reshaped = tf.reshape(result_dense, [segs.shape[0], -1, 4, 4])
 
         # Conv2D based off seg map noise
-        result = tf.image.resize(segs, size=(self.sh, self.sw), method="nearest")
-        result = spectral_conv(inputs=result, weight=self.fc, stride=1, bias=self.fc_bias)
+        if modulations is None:
+            result = self.segmap_latent(segs)
+        else:
+            result, block_modulations = modulations
 
         # Dense Random Noise
         #result = self.dense(noise)
         #result = tf.reshape(result, [self.batch_size, self.sh, self.sw, 16 * self.z_dim])
 
-        # Start doing spade layers
-        result = self.spade_layers0(result, segs)
-        result = self.upsample(result)
+        # Start doing spade layers. The features are upsampled by 2 before blocks 1, 3, 4, 5 and 6, and the
+        # segmap embedding is recomputed (or shared, see segmap_embedding) whenever the resolution changes
+        features = []
+        for i, (block, (upsample, height, width, scale)) in enumerate(zip(self.spade_blocks(), self.block_schedule(segs))):
+            if upsample and not self.fused_upsample:
+                result = self.upsample(result)
 
-        # Middle layers
-        result = self.spade_layers1(result, segs)
-        result = self.spade_layers2(result, segs)
+            if modulations is not None:
+                block_kwargs = {'modulations': block_modulations[i]}
+            else:
+                if scale is not None:
+                    seg_hidden = self.segmap_embedding(segs, scale, height, width)
+                block_kwargs = {'seg_hidden': seg_hidden}
 
-        # Rest of the layers
-        result = self.upsample(result)
-        result = self.spade_layers3(result, segs)
-        
-        result = self.upsample(result)
-        result = self.spade_layers4(result, segs)
-
-        result = self.upsample(result)
-        result = self.spade_layers5(result, segs)
-
-        result = self.upsample(result)
-        result = self.spade_layers6(result, segs)
+            result = block(result, segs, upsample=upsample and self.fused_upsample, **block_kwargs)
+            features.append(result)
 
         # Take activation function plus final convolution layer in generator
         result = self.lrelu(result)
         result = spectral_conv(inputs=result, weight=self.conv_layer, stride=1, bias=self.conv_bias)
 
+        if return_features:
+            return result, features
         return result
+
+    def segmap_latent(self, segs):
+        """
+        :return: the sh x sw starting features, computed from the segmap by the fc convolution
+        """
+        result = segmap_at(segs, self.sh, self.sw)
+        return spectral_conv(inputs=result, weight=self.fc, stride=1, bias=self.fc_bias)
+
+    def block_schedule(self, segs):
+        """
+        :return: for every SpadeBlock, (whether its input is upsampled by 2, output height, output width, index
+        of the segmap embedding to recompute at this block or None to reuse the previous one)
+        """
+        # Segmaps smaller than img_h x img_w (progressive training) skip the first upsampling stages, so the
+        # latent grid stays sh x sw and the output comes out at the segmap's resolution
+        skipped_upsamples = self.upsample_count - self.active_upsample_count(segs)
+
+        schedule = []
+        height, width = self.sh, self.sw
+        scale = 0
+        for i in range(len(self.UPSAMPLE_BEFORE)):
+            upsample = self.UPSAMPLE_BEFORE[i]
+            if upsample and skipped_upsamples > 0:
+                skipped_upsamples -= 1
+                upsample = False
+            if upsample:
+                height, width = 2 * height, 2 * width
+
+            embedding = None
+            if i == 0 or self.UPSAMPLE_BEFORE[i]:
+                scale += int(self.UPSAMPLE_BEFORE[i])
+                embedding = scale
+            schedule.append((upsample, height, width, embedding))
+        return schedule
+
+    def segmap_modulations(self, segs):
+        """
+        Everything the generator computes from the segmap alone: the fc output and the gamma/beta maps of every
+        SpadeLayer. The noise is ignored, so these are fixed for a segmap and checkpoint and can be cached and
+        passed back to call (see ModulationCache).
+
+        :return: (fc output, tuple of SpadeBlock.modulations per block)
+        """
+        block_modulations = []
+        for block, (_, height, width, scale) in zip(self.spade_blocks(), self.block_schedule(segs)):
+            if scale is not None:
+                seg_hidden = self.segmap_embedding(segs, scale, height, width)
+            block_modulations.append(block.modulations(segs, height, width, seg_hidden))
+        return self.segmap_latent(segs), tuple(block_modulations)
     
-    @tf.function
+    def spade_blocks(self):
+        return [self.spade_layers0, self.spade_layers1, self.spade_layers2, self.spade_layers3, \
+            self.spade_layers4, self.spade_layers5, self.spade_layers6]
+
+    def synthesis_variables(self):
+        """
+        Trainable variables of the generator itself, without the (frozen) VGG loss network
+        """
+        variables = [self.fc, self.fc_bias, self.conv_layer, self.conv_bias]
+        if self.share_segmap_trunk:
+            variables += tf.nest.flatten(list(self.trunk_convs)) + list(self.trunk_biases)
+        for block in self.spade_blocks():
+            variables += block.trainable_variables
+        return variables
+
+    def prepare_inference(self):
+        """
+        Builds a freshly created or restored generator and converges its spectral norm power iterations, so
+        that it can run with a frozen power iteration (see spectral_norm.frozen_power_iteration)
+        """
+        self.call(None, tf.zeros([1, self.img_h, self.img_w, self.segmap_filters]))
+        refine_power_iteration(self.synthesis_variables())
+
+    def trunk_configs(self):
+        """
+        SPADE hidden width and kernel size of every resolution, for the shared segmap trunks. The blocks
+        that share a resolution have to agree on them.
+        """
+        configs = []
+        for i, config in enumerate(self.block_configs):
+            if i == 0 or self.UPSAMPLE_BEFORE[i]:
+                configs.append(config)
+            elif (config['hidden_channels'], config['kernel_size']) != \
+                (configs[-1]['hidden_channels'], configs[-1]['kernel_size']):
+                raise ValueError("SpadeBlock %d needs the SPADE settings of the previous block to share its trunk" % i)
+        return configs
+
+    def segmap_embedding(self, segs, scale, height, width):
+        """
+        Shared SPADE segmap embedding at the given resolution (the scale-th upsampling stage), or None when
+        every SpadeLayer embeds the segmap itself.
+        """
+        if not self.share_segmap_trunk:
+            return None
+
+        segmap_resized = segmap_at(segs, height, width)
+        seg_hidden = spectral_conv(inputs=segmap_resized, weight=self.trunk_convs[scale], stride=1, \
+            bias=self.trunk_biases[scale])
+        return tf.nn.relu(seg_hidden)
+
+    def segmap_pyramid_sizes(self):
+        """
+        (height, width) of the segmap at every resolution the generator uses, coarsest first, for building
+        segmap pyramids in the input pipeline
+        """
+        return [(self.sh * 2 ** i, self.sw * 2 ** i) for i in range(self.upsample_count + 1)]
+
+    def active_upsample_count(self, segs):
+        """
+        Number of upsampling stages needed to go from the sh x sw latent grid to the resolution of segs
+        (the finest level of a pyramid)
+        """
+        segmap = segs[-1] if isinstance(segs, (tuple, list)) else segs
+        _, height, width, _ = list(segmap.shape)
+        for count in range(self.upsample_count, -1, -1):
+            if (height, width) == (self.sh * 2 ** count, self.sw * 2 ** count):
+                return count
+        raise ValueError("Segmap of size %dx%d is not %dx%d upsampled by a power of 2 up to %d" % \
+            (height, width, self.sh, self.sw, 2 ** self.upsample_count))
+
     def compute_latent_vector_size(self):
-        # sw = tf.math.floordiv(self.img_w, tf.math.pow(2, self.upsample_count))
-        # sh = tf.math.divide(tf.cast(sw,dtype=tf.float32) , tf.math.divide(4,3))
-        # sh = tf.math.floor(sh)
+        # Both sides are derived from the configured resolution, which has to survive upsample_count halvings
+        factor = 2 ** self.upsample_count
+        if self.img_w % factor != 0 or self.img_h % factor != 0:
+            raise ValueError("Image size %dx%d has to be a multiple of %d" % (self.img_h, self.img_w, factor))
 
-        # Non Tensorflow version that does not produce tensors
-        sw = self.img_w // (2 ** self.upsample_count)
-        sh = round(sw / (4 / 3))
+        sw = self.img_w // factor
+        sh = self.img_h // factor
 
         return sw, sh
 
     
-    def loss(self, fake_logits, fake_image, real_image):
+    def vgg_loss(self):
+        """
+        :return: the VGG perceptual loss network
+        """
+        if self.vgg_loss_obj is None:
+            self.vgg_loss_obj = VGG_Loss()
+        return self.vgg_loss_obj
+
+    def loss(self, fake_logits, fake_image, real_image, real_features=None):
+        """
+        :param real_features: VGG features of real_image, if they are cached (see feature_cache.py)
+        """
         # Only hinge loss for now--can add extra losses later
         hinge_loss = tf.reduce_mean(tf.keras.losses.hinge(tf.zeros_like(fake_logits), fake_logits))
         #return self.bce(tf.ones_like(fake_logits), fake_logits)
         #return -tf.reduce_mean(fake_logits)
         #adversarial_loss = tf.math.multiply(0.5,tf.reduce_mean((fake_logits - 1)**2)) # Using Least squares loss
-        vgg_loss = tf.math.multiply(self.vgg_loss_obj(fake_image, real_image), self.lambda_vgg)
+        vgg_loss = tf.math.multiply(self.vgg_loss()(fake_image, real_image, fake_features=real_features), \
+            self.lambda_vgg)
         return tf.math.divide(tf.math.add(hinge_loss, vgg_loss), 2)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import numpy as np
+import tensorflow as tf
+
+from code.spadelayer import segmap_at
+from code.spectral_norm import spectral_conv, frozen_power_iteration
+
+"""
+Incremental re-synthesis for interactive editing. The output of every SpadeBlock is kept from the previous
+render. When the segmap changes, the changed pixels are found at every resolution the generator samples the
+segmap at, and the dirty box of every block output is grown by the block's receptive field. Only a window
+around each dirty box is recomputed, and the center of the window is written back into the kept outputs.
+
+At inference every layer is local (batch norm uses its moving statistics, convolutions are SAME padded and
+upsampling is nearest), so the result is the same as a full forward pass up to float rounding, as long as
+every window includes the receptive field margin of what is kept from it.
+"""
+
+def bounding_box(mask):
+	"""
+	:param mask: boolean array, shape=[height, width]
+
+	:return: (top, bottom, left, right) half open box around the True entries, or None
+	"""
+	rows = np.flatnonzero(mask.any(axis=1))
+	if len(rows) == 0:
+		return None
+	cols = np.flatnonzero(mask.any(axis=0))
+	return (rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+
+def expand(box, margin, height, width):
+	if box is None:
+		return None
+	top, bottom, left, right = box
+	return (max(0, top - margin), min(height, bottom + margin), max(0, left - margin), min(width, right + margin))
+
+def union(box, other):
+	if box is None or other is None:
+		return box if other is None else other
+	return (min(box[0], other[0]), max(box[1], other[1]), min(box[2], other[2]), max(box[3], other[3]))
+
+def crop(array, box):
+	top, bottom, left, right = box
+	return array[:, top:bottom, left:right]
+
+class IncrementalGenerator(object):
+	"""
+	Renders a sequence of edited segmaps (batch size 1) with a SPADEGenerator, recomputing only what changed.
+	"""
+	def __init__(self, generator):
+		"""
+		:param generator: a SPADEGenerator, see SPADEGenerator.prepare_inference
+		"""
+		self.generator = generator
+		self.segmap = None
+		self.last_recomputed = 0.0
+
+		# Pixels of block output that one pixel of the block input (after upsampling) reaches: the two 3x3
+		# convolutions; and that one segmap pixel reaches: the SPADE hidden and gamma/beta convolutions too
+		self.feature_radius = 2
+		self.segmap_radius = [2 + 2 * (config['kernel_size'] // 2) for config in generator.block_configs]
+
+	def render(self, segmap):
+		"""
+		:param segmap: one hot segmap, shape=[1, height, width, segmap_filters]
+
+		:return: the generated image, shape=[1, height, width, 3]
+		"""
+		segmap = tf.convert_to_tensor(segmap, tf.float32)
+		with frozen_power_iteration():
+			if self.segmap is None or self.segmap.shape != segmap.shape:
+				return self.full_render(segmap)
+			return self.incremental_render(segmap)
+
+	def segmap_levels(self, segmap, schedule):
+		"""
+		:return: the segmap at the latent resolution and at the resolution of every block
+		"""
+		generator = self.generator
+		sizes = [(generator.sh, generator.sw)] + [(height, width) for _, height, width, _ in schedule]
+		return [segmap_at(segmap, height, width).numpy() for height, width in sizes]
+
+	def full_render(self, segmap):
+		generator = self.generator
+		schedule = generator.block_schedule(segmap)
+		image, features = generator.call(None, segmap, return_features=True)
+
+		self.segmap = segmap
+		self.levels = self.segmap_levels(segmap, schedule)
+		self.latent = generator.segmap_latent(segmap).numpy()
+		self.features = [feature.numpy() for feature in features]
+		self.image = image.numpy()
+		self.last_recomputed = 1.0
+		return self.image
+
+	def incremental_render(self, segmap):
+		generator = self.generator
+		schedule = generator.block_schedule(segmap)
+		levels = self.segmap_levels(segmap, schedule)
+		changed = [bounding_box(np.any(new != old, axis=-1)[0]) for new, old in zip(levels, self.levels)]
+		self.segmap, self.levels = segmap, levels
+
+		# The latent grid is tiny, recompute it whenever its segmap samples changed
+		dirty = expand(changed[0], 1, generator.sh, generator.sw)
+		if dirty is not None:
+			self.latent = generator.segmap_latent(segmap).numpy()
+
+		recomputed = 0
+		total = 0
+		previous = self.latent
+		scale = None
+		for i, (block, (upsample, height, width, block_scale)) in enumerate(zip(generator.spade_blocks(), schedule)):
+			if block_scale is not None:
+				scale = block_scale
+			if upsample:
+				dirty = None if dirty is None else tuple(2 * side for side in dirty)
+
+			# Dirty block outputs: reached from a dirty input pixel or from a changed segmap pixel
+			dirty = union(expand(dirty, self.feature_radius, height, width), \
+				expand(changed[i + 1], self.segmap_radius[i], height, width))
+			total += height * width
+			if dirty is not None:
+				window = expand(dirty, self.segmap_radius[i], height, width)
+				if upsample:
+					# Align to the low resolution grid, so the upsampled crop matches the full upsampling
+					window = (window[0] - window[0] % 2, window[1] + window[1] % 2, window[2] - window[2] % 2, \
+						window[3] + window[3] % 2)
+				self.features[i][crop_slices(dirty)] = self.block_window(block, i, previous, levels[i + 1], window, \
+					dirty, upsample, scale)
+				recomputed += (window[1] - window[0]) * (window[3] - window[2])
+			previous = self.features[i]
+
+		height, width = self.image.shape[1:3]
+		dirty = expand(dirty, 1, height, width)
+		if dirty is not None:
+			window = expand(dirty, 1, height, width)
+			result = spectral_conv(inputs=generator.lrelu(crop(previous, window)), weight=generator.conv_layer, \
+				stride=1, bias=generator.conv_bias).numpy()
+			self.image[crop_slices(dirty)] = crop(result, relative(dirty, window))
+
+		self.last_recomputed = recomputed / total
+		return self.image
+
+	def block_window(self, block, i, previous, segmap_level, window, dirty, upsample, scale):
+		"""
+		:return: the output of block i on the dirty box, computed on the (larger) window
+		"""
+		generator = self.generator
+		if upsample:
+			features = crop(previous, tuple(side // 2 for side in window))
+			if not generator.fused_upsample:
+				features = generator.upsample(features)
+		else:
+			features = crop(previous, window)
+
+		segmap = crop(segmap_level, window)
+		seg_hidden = generator.segmap_embedding(segmap, scale, window[1] - window[0], window[3] - window[2])
+		result = block(features, segmap, seg_hidden=seg_hidden, upsample=upsample and generator.fused_upsample)
+		return crop(result.numpy(), relative(dirty, window))
+
+def relative(box, window):
+	"""
+	:return: box in the coordinates of window
+	"""
+	return (box[0] - window[0], box[1] - window[0], box[2] - window[2], box[3] - window[2])
+
+def crop_slices(box):
+	return (slice(None), slice(box[0], box[1]), slice(box[2], box[3]))
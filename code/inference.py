@@ -0,0 +1,180 @@
+import glob
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from imageio import imwrite
+
+from code.preprocess import decode_segmap, decode_segmap_labels
+from code.spectral_norm import frozen_power_iteration
+from code.tiling import tiled_generate, tiled_synthesize
+
+"""
+Offline inference over a directory of segmaps. Segmaps are decoded and batched on the tf.data threads, the
+generator runs on large batches, and the PNG encoding and writing happens on a thread pool so that it
+overlaps with the next batch. Completed files are appended to a manifest, so an interrupted run picks up
+where it stopped. Large jobs can be split into shards, each run by its own process on its own cores.
+"""
+
+def list_segmaps(dir_name, shard_index=0, num_shards=1):
+	"""
+	:return: sorted segmap paths in dir_name, only every num_shards-th one starting at shard_index
+	"""
+	return sorted(glob.glob(os.path.join(dir_name, '*.png')))[shard_index::num_shards]
+
+def output_name(segmap_path):
+	"""
+	:return: file name of the generated image for a segmap, e.g. "img0_generated.png" for "img0_seg.png"
+	"""
+	name = os.path.basename(segmap_path)
+	for suffix in ['_seg.png', '.png']:
+		if name.endswith(suffix):
+			return name[:-len(suffix)] + '_generated.png'
+	return name
+
+class Manifest(object):
+	"""
+	Append-only record of the segmaps whose output has been written. Every shard appends to its own file in
+	out_dir and reads all of them, so a run can be resumed with a different number of shards.
+	"""
+	def __init__(self, out_dir, shard_index=0):
+		self.path = os.path.join(out_dir, 'manifest_%d.txt' % shard_index)
+		self.lock = threading.Lock()
+		self.completed = set()
+		for path in glob.glob(os.path.join(out_dir, 'manifest_*.txt')):
+			with open(path, 'r') as f:
+				self.completed.update(line.strip() for line in f if line.strip())
+
+	def mark(self, segmap_path):
+		with self.lock:
+			with open(self.path, 'a') as f:
+				f.write(segmap_path + '\n')
+			self.completed.add(segmap_path)
+
+class ImageWriter(object):
+	"""
+	Encodes and writes generated images on a pool of threads. PNG compression releases the GIL, so the
+	writes run in parallel with the generator.
+	"""
+	def __init__(self, out_dir, manifest, num_threads=4, max_pending=None):
+		self.out_dir = out_dir
+		self.manifest = manifest
+		self.pool = ThreadPoolExecutor(max_workers=num_threads)
+		# Bounds the images held in memory when the writers fall behind
+		self.pending = threading.Semaphore(max_pending or 64 * num_threads)
+		# Writes that are still running or have failed
+		self.futures = []
+
+	def write(self, segmap_path, image):
+		try:
+			if image.dtype != np.uint8:
+				image = np.clip(np.asarray(image) * 255, 0, 255).astype(np.uint8)
+			imwrite(os.path.join(self.out_dir, output_name(segmap_path)), image)
+			self.manifest.mark(segmap_path)
+		finally:
+			self.pending.release()
+
+	def submit(self, segmap_path, image):
+		self.pending.acquire()
+		self.futures = [future for future in self.futures if not future.done() or future.exception() is not None]
+		self.futures.append(self.pool.submit(self.write, segmap_path, image))
+
+	def close(self):
+		"""
+		Waits for the pending writes, raises the exception of the first one that failed
+		"""
+		self.pool.shutdown(wait=True)
+		for future in self.futures:
+			future.result()
+
+def segmap_dataset(paths, num_objects, batch_size, n_threads=8):
+	"""
+	:return: dataset of (paths, segmaps) batches
+	"""
+	dataset = tf.data.Dataset.from_tensor_slices(paths)
+	dataset = dataset.map(lambda path: (path, decode_segmap(path, num_objects)), num_parallel_calls=n_threads)
+	dataset = dataset.batch(batch_size)
+	return dataset.prefetch(2)
+
+def run_inference(generator, paths, out_dir, num_objects, batch_size=64, num_writers=4, n_threads=8, shard_index=0, \
+	tile_margin=None):
+	"""
+	Generates an image for every segmap in paths that is not in the manifest yet.
+
+	:param generator: a (restored) SPADEGenerator
+	:param paths: segmap paths, see list_segmaps
+	:param out_dir: directory the generated images are written to
+	:param num_objects: number of channels in the one hot segmaps
+	:param batch_size: number of segmaps per generator call
+	:param num_writers: number of PNG writer threads
+	:param n_threads: number of tf.data threads decoding segmaps
+	:param shard_index: shard this process runs, names its manifest file
+	:param tile_margin: if given, every segmap is generated on its own with tiled inference (see tiling.py),
+	in batches of batch_size tiles, so segmaps can be of any size
+
+	:return: (number of images generated, seconds taken)
+	"""
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	manifest = Manifest(out_dir, shard_index)
+	remaining = [path for path in paths if path not in manifest.completed]
+	print("%d of %d segmaps already done, %d to go" % (len(paths) - len(remaining), len(paths), len(remaining)))
+	if not remaining:
+		return 0, 0.0
+
+	# One trace for every batch size, power iteration frozen since the weights do not change
+	generator.prepare_inference()
+	synthesize = tf.function(lambda segmaps: generator.call(None, segmaps), reduce_retracing=True)
+	writer = ImageWriter(out_dir, manifest, num_threads=num_writers)
+
+	start = time.perf_counter()
+	if tile_margin is not None:
+		synthesize = tiled_synthesize(generator)
+		for path in remaining:
+			labels = decode_segmap_labels(tf.io.read_file(path), num_objects).numpy()
+			writer.submit(path, tiled_generate(generator, labels, num_objects, tile_margin, batch_size, \
+				synthesize=synthesize))
+	else:
+		with frozen_power_iteration():
+			for batch_paths, segmaps in segmap_dataset(remaining, num_objects, batch_size, n_threads):
+				images = synthesize(segmaps).numpy()
+				for path, image in zip(batch_paths.numpy(), images):
+					writer.submit(path.decode(), image)
+	writer.close()
+	seconds = time.perf_counter() - start
+
+	print("Generated %d images in %.1fs, %.0f images/minute" % (len(remaining), seconds, \
+		60 * len(remaining) / seconds))
+	return len(remaining), seconds
+
+def launch_shards(argv, num_processes):
+	"""
+	Runs the inference command line once per shard, each process pinned to its own share of the cores and
+	with TensorFlow's thread pools sized to match.
+
+	:param argv: command line of this process (sys.argv)
+	:param num_processes: number of shards and processes
+
+	:return: None, raises RuntimeError if a shard fails
+	"""
+	# Contiguous core ranges, so that each process stays on neighbouring cores
+	cores = sorted(os.sched_getaffinity(0))
+	core_groups = [cores[i * len(cores) // num_processes:(i + 1) * len(cores) // num_processes] \
+		for i in range(num_processes)]
+
+	processes = []
+	for shard_index, group in enumerate(core_groups):
+		env = dict(os.environ, TF_NUM_INTRAOP_THREADS=str(max(1, len(group))), TF_NUM_INTEROP_THREADS='1')
+		command = [sys.executable] + argv + ['--infer-processes', '1', '--num-shards', str(num_processes), \
+			'--shard-index', str(shard_index)]
+		processes.append(subprocess.Popen(command, env=env, \
+			preexec_fn=(lambda group=group: os.sched_setaffinity(0, group)) if group else None))
+
+	failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+	if failed:
+		raise RuntimeError("Inference shards %s failed" % failed)
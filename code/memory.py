@@ -0,0 +1,170 @@
+import contextlib
+import csv
+import os
+import threading
+import time
+
+import tensorflow as tf
+
+"""
+Memory instrumentation of the training step. A MemoryTracker records the peak and current memory of every
+stage of the step (generator forward, discriminator, losses, backward, ...) from the TensorFlow allocator of
+the training device, which also keeps statistics on CPU, and from the resident set size of the process, sampled
+by a background thread while a stage runs. The RSS also covers memory outside the TensorFlow allocator, e.g.
+oneDNN scratch space and the input pipeline. Every logging window of steps becomes one row per stage in a
+CSV timeline, so a run that runs out of memory shows which stage grew.
+"""
+
+MEMORY_FIELDS = ['first_step', 'last_step', 'stage', 'calls', 'allocator_peak_mb', 'allocator_current_mb', \
+	'rss_peak_mb', 'rss_current_mb', 'seconds']
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss_bytes():
+	"""
+	:return: resident set size of this process, or None where /proc is not available
+	"""
+	try:
+		with open('/proc/self/statm', 'r') as f:
+			return int(f.read().split()[1]) * PAGE_SIZE
+	except (OSError, IndexError, ValueError):
+		return None
+
+def allocator_stats(device):
+	"""
+	:return: (current, peak) bytes of the TensorFlow allocator of device, or None if it keeps no statistics
+	"""
+	try:
+		info = tf.config.experimental.get_memory_info(device)
+	except (ValueError, tf.errors.OpError):
+		return None
+	return info['current'], info['peak']
+
+def megabytes(value):
+	return None if value is None else round(value / 2**20, 1)
+
+class RSSSampler(object):
+	"""
+	Background thread that keeps the highest RSS seen since the last reset
+	"""
+	def __init__(self, interval=0.002):
+		self.interval = interval
+		self.peak = rss_bytes()
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			rss = rss_bytes()
+			with self.lock:
+				self.peak = max(self.peak, rss)
+
+	def reset(self):
+		"""
+		:return: the peak RSS since the last reset
+		"""
+		rss = rss_bytes()
+		with self.lock:
+			peak = max(self.peak, rss)
+			self.peak = rss
+		return peak
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+
+class MemoryTracker(object):
+	def __init__(self, device, log_path, window=7):
+		"""
+		:param device: training device, e.g. "GPU:0" or "CPU:0"
+		:param log_path: CSV the timeline is appended to
+		:param window: number of steps per row of the timeline, e.g. --log-every
+		"""
+		self.device = device
+		self.log_path = log_path
+		self.window = window
+		self.use_allocator = allocator_stats(device) is not None
+		self.sampler = RSSSampler() if rss_bytes() is not None else None
+		self.step = 0
+		self.first_step = 0
+		self.stages = {}
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		"""
+		Measures the peak memory while the body runs and the memory still held after it, e.g. the activations
+		the backward pass needs
+		"""
+		if self.use_allocator:
+			tf.config.experimental.reset_memory_stats(self.device)
+		if self.sampler is not None:
+			self.sampler.reset()
+		start = time.perf_counter()
+		yield
+		# Ops run asynchronously on GPUs, wait for the stage to finish before reading the statistics
+		tf.test.experimental.sync_devices()
+		seconds = time.perf_counter() - start
+
+		current, peak = allocator_stats(self.device) if self.use_allocator else (None, None)
+		rss_peak = self.sampler.reset() if self.sampler is not None else None
+		record = self.stages.setdefault(name, {'calls': 0, 'allocator_peak': None, 'allocator_current': None, \
+			'rss_peak': None, 'rss_current': None, 'seconds': 0.0})
+		record['calls'] += 1
+		record['seconds'] += seconds
+		record['allocator_current'] = current
+		record['rss_current'] = rss_bytes()
+		for key, value in (('allocator_peak', peak), ('rss_peak', rss_peak)):
+			if value is not None:
+				record[key] = value if record[key] is None else max(record[key], value)
+
+	def end_step(self):
+		"""
+		Call once per training step, writes the window to the timeline when it is full
+		"""
+		self.step += 1
+		if self.step - self.first_step >= self.window:
+			self.flush()
+
+	def flush(self):
+		"""
+		Appends one row per stage of the current window to the timeline and prints the stage with the highest
+		peak
+		"""
+		if not self.stages:
+			return
+		rows = [{'first_step': self.first_step, 'last_step': self.step - 1, 'stage': name, 'calls': record['calls'], \
+			'allocator_peak_mb': megabytes(record['allocator_peak']), \
+			'allocator_current_mb': megabytes(record['allocator_current']), \
+			'rss_peak_mb': megabytes(record['rss_peak']), 'rss_current_mb': megabytes(record['rss_current']), \
+			'seconds': round(record['seconds'], 3)} for name, record in self.stages.items()]
+
+		directory = os.path.dirname(self.log_path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		new_file = not os.path.exists(self.log_path)
+		with open(self.log_path, 'a') as f:
+			writer = csv.DictWriter(f, fieldnames=MEMORY_FIELDS)
+			if new_file:
+				writer.writeheader()
+			writer.writerows(rows)
+
+		peak_key = 'allocator_peak_mb' if self.use_allocator else 'rss_peak_mb'
+		if all(row[peak_key] is not None for row in rows):
+			highest = max(rows, key=lambda row: row[peak_key])
+			print("Memory, steps %d-%d: highest peak %.1f MB in %s (%s)" % (self.first_step, self.step - 1, \
+				highest[peak_key], highest['stage'], 'allocator' if self.use_allocator else 'RSS'))
+		self.first_step = self.step
+		self.stages = {}
+
+	def close(self):
+		self.flush()
+		if self.sampler is not None:
+			self.sampler.stop()
+
+def track(tracker, name):
+	"""
+	:return: tracker.stage(name), or a context that does nothing without a tracker
+	"""
+	return tracker.stage(name) if tracker is not None else contextlib.nullcontext()
@@ -0,0 +1,153 @@
+import warnings
+
+import numpy as np
+import scipy.linalg
+from keras.applications.inception_v3 import InceptionV3
+from keras.applications.inception_v3 import preprocess_input
+from code.weights import pretrained_weights, INCEPTION_V3_WEIGHTS
+
+"""
+Image quality metrics on InceptionV3 activations.
+FID Functions adapted from https://machinelearningmastery.com/how-to-implement-the-frechet-inception-distance-fid-from-scratch/
+KID from Binkowski et al., "Demystifying MMD GANs", precision/recall from Kynkaanniemi et al., "Improved
+Precision and Recall Metric for Assessing Generative Models". All metrics are computed from one set of
+activations, see evaluate_activations.
+"""
+
+def inception_model(img_h, img_w):
+	"""
+	:return: InceptionV3 without its classifier, returning pooled activations for img_h x img_w images
+	"""
+	return InceptionV3(weights=pretrained_weights(INCEPTION_V3_WEIGHTS), include_top=False, pooling='avg', \
+		input_shape=(img_h,img_w,3))
+
+def activations(model, image_batch):
+	"""
+	:param model: see inception_model
+	:param image_batch: a batch of images, shape=[batch_size, height, width, channels]
+	:return: pooled InceptionV3 activations, shape=[batch_size, features]
+	"""
+	return model.predict(preprocess_input(image_batch), steps=1)
+
+def frechet_distance(act1, act2):
+	"""
+	:param act1: activations of the real images, shape=[num_images, features]
+	:param act2: activations of the generated images, shape=[num_images, features]
+	:return: the Frechet distance between Gaussians fitted to both sets of activations. Lower is better
+	"""
+	# calculate mean and covariance statistics
+	mu1, sigma1 = act1.mean(axis=0), np.cov(act1, rowvar=False)
+	mu2, sigma2 = act2.mean(axis=0), np.cov(act2, rowvar=False)
+
+	# calculate sum squared difference between means
+	ssdiff = np.sum((mu1 - mu2)**2.0)
+
+	# calculate sqrt of product between cov
+	covmean = scipy.linalg.sqrtm(sigma1.dot(sigma2))
+
+	# check and correct imaginary numbers from sqrt
+	if np.iscomplexobj(covmean):
+		covmean = covmean.real
+
+	# calculate score
+	return ssdiff + np.trace(sigma1 + sigma2 - (2.0 * covmean))
+
+def fid(model, real_image_batch, generated_image_batch):
+	"""
+	:param model: see inception_model
+	:param real_image_batch: a batch of real images from the dataset, shape=[batch_size, height, width, channels]
+	:param generated_image_batch: a batch of images generated by the generator network, shape=[batch_size, height, width, channels]
+	:return: the inception distance between the real and generated images, scalar
+	"""
+	return frechet_distance(activations(model, real_image_batch), activations(model, generated_image_batch))
+
+def kernel_inception_distance(act1, act2, num_subsets=100, subset_size=1000, seed=0):
+	"""
+	Unbiased MMD^2 estimate with the cubic polynomial kernel k(x, y) = (x.y / features + 1)^3, averaged over
+	random subsets so that the kernel matrices stay subset_size x subset_size however many samples there are.
+	With fewer samples than subset_size, the subsets are clamped to half of the smaller set, since subsets of
+	all samples would all be the same and report a standard deviation of 0.
+
+	:param act1: activations of the real images, shape=[num_images, features]
+	:param act2: activations of the generated images, shape=[num_images, features]
+	:return: (mean, standard deviation) of the KID over the subsets. Lower is better
+	"""
+	act1, act2 = act1.astype(np.float64), act2.astype(np.float64)
+	features = act1.shape[1]
+	n = min(len(act1), len(act2))
+	if n < 4:
+		raise ValueError("KID needs at least 4 samples of each set, got %d" % n)
+	m = subset_size
+	if n <= subset_size:
+		m = n // 2
+		warnings.warn("KID subset size %d clamped to %d for %d samples" % (subset_size, m, n))
+	rng = np.random.RandomState(seed)
+
+	def kernel(a, b):
+		return (a.dot(b.T) / features + 1) ** 3
+
+	mmds = []
+	for _ in range(num_subsets):
+		x = act1[rng.choice(len(act1), m, replace=False)]
+		y = act2[rng.choice(len(act2), m, replace=False)]
+		k_xx, k_yy, k_xy = kernel(x, x), kernel(y, y), kernel(x, y)
+		# Leaving out the diagonals makes the within set terms unbiased
+		mmds.append((k_xx.sum() - np.trace(k_xx)) / (m * (m - 1)) + (k_yy.sum() - np.trace(k_yy)) / (m * (m - 1)) \
+			- 2 * k_xy.mean())
+	return float(np.mean(mmds)), float(np.std(mmds))
+
+def pairwise_distances(a, b):
+	"""
+	:return: euclidean distances between the rows of a and b, shape=[len(a), len(b)]
+	"""
+	squared = (a ** 2).sum(axis=1)[:, np.newaxis] + (b ** 2).sum(axis=1)[np.newaxis, :] - 2 * a.dot(b.T)
+	return np.sqrt(np.maximum(squared, 0))
+
+def nearest_neighbour_radii(act, k=3, block_size=1024):
+	"""
+	:return: distance of every sample to its k-th nearest neighbour in act (not counting itself)
+	"""
+	radii = np.empty(len(act), dtype=np.float32)
+	for start in range(0, len(act), block_size):
+		distances = pairwise_distances(act[start:start + block_size], act)
+		# The 0th smallest distance is the sample itself
+		radii[start:start + block_size] = np.partition(distances, k, axis=1)[:, k]
+	return radii
+
+def manifold_coverage(samples, manifold, radii, block_size=1024):
+	"""
+	:return: fraction of samples within the k-NN radius of at least one manifold sample
+	"""
+	covered = 0
+	for start in range(0, len(samples), block_size):
+		distances = pairwise_distances(samples[start:start + block_size], manifold)
+		covered += np.any(distances <= radii[np.newaxis, :], axis=1).sum()
+	return covered / len(samples)
+
+def precision_recall(act1, act2, k=3, block_size=1024):
+	"""
+	:param act1: activations of the real images, shape=[num_images, features]
+	:param act2: activations of the generated images, shape=[num_images, features]
+	:param k: neighbourhood size approximating each manifold
+	:param block_size: rows of the distance matrices held in memory at a time
+	:return: (precision, recall): the fraction of generated images inside the real image manifold, and of
+	real images inside the generated image manifold. Higher is better
+	"""
+	if min(len(act1), len(act2)) <= k:
+		raise ValueError("Precision and recall with k=%d need more than %d samples of each set, got %d and %d" % \
+			(k, k, len(act1), len(act2)))
+	act1, act2 = act1.astype(np.float32), act2.astype(np.float32)
+	precision = manifold_coverage(act2, act1, nearest_neighbour_radii(act1, k, block_size), block_size)
+	recall = manifold_coverage(act1, act2, nearest_neighbour_radii(act2, k, block_size), block_size)
+	return float(precision), float(recall)
+
+def evaluate_activations(act1, act2, kid_subsets=100, kid_subset_size=1000, k=3):
+	"""
+	:param act1: activations of the real images, shape=[num_images, features]
+	:param act2: activations of the generated images, shape=[num_images, features]
+	:return: dict with the FID, KID (and its standard deviation over subsets), precision and recall
+	"""
+	kid, kid_std = kernel_inception_distance(act1, act2, kid_subsets, kid_subset_size)
+	precision, recall = precision_recall(act1, act2, k)
+	return {'fid': float(frechet_distance(act1, act2)), 'kid': kid, 'kid_std': kid_std, 'precision': precision, \
+		'recall': recall}
@@ -0,0 +1,92 @@
+import collections
+import hashlib
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+"""
+Cache of the segmap branch of the generator (SPADEGenerator.segmap_modulations). The generator ignores its
+noise, so for a given segmap and checkpoint the fc output and every SpadeLayer's gamma/beta maps are fixed;
+re-rendering a cached segmap only runs the feature path. Entries are keyed by a hash of the segmap content
+and the checkpoint id, and the least recently used ones are evicted to stay under a byte budget.
+"""
+
+def segmap_key(segmap, checkpoint_id):
+	"""
+	:param segmap: a single one hot segmap (or segmap pyramid)
+	:param checkpoint_id: identifies the weights, e.g. the checkpoint path
+
+	:return: hash of the segmap content, its shape and the checkpoint id
+	"""
+	digest = hashlib.sha1(str(checkpoint_id).encode())
+	for level in tf.nest.flatten(segmap):
+		level = np.ascontiguousarray(level)
+		digest.update(str(level.shape).encode())
+		digest.update(level.tobytes())
+	return digest.hexdigest()
+
+def structure_bytes(structure):
+	return sum(int(np.prod(tensor.shape)) * tensor.dtype.size for tensor in tf.nest.flatten(structure))
+
+class ModulationCache(object):
+	def __init__(self, max_bytes):
+		"""
+		:param max_bytes: upper bound on the size of the cached tensors
+		"""
+		self.max_bytes = max_bytes
+		self.entries = collections.OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			if key not in self.entries:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return self.entries[key][0]
+
+	def put(self, key, value):
+		size = structure_bytes(value)
+		if size > self.max_bytes:
+			return
+		with self.lock:
+			if key in self.entries:
+				self.bytes -= self.entries.pop(key)[1]
+			self.entries[key] = (value, size)
+			self.bytes += size
+			while self.bytes > self.max_bytes:
+				_, (_, evicted_size) = self.entries.popitem(last=False)
+				self.bytes -= evicted_size
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.bytes = 0
+
+	def modulations(self, segmaps, checkpoint_id, compute):
+		"""
+		Looks up the modulations of every segmap in a batch and computes the missing ones in one call.
+
+		:param segmaps: batch of one hot segmaps, shape=[batch_size, height, width, segmap_filters]
+		:param checkpoint_id: identifies the weights the modulations are computed with
+		:param compute: callable mapping a batch of segmaps to their modulations, e.g.
+		SPADEGenerator.segmap_modulations
+
+		:return: modulations of the whole batch, to pass to SPADEGenerator.call
+		"""
+		keys = [segmap_key(segmap, checkpoint_id) for segmap in np.asarray(segmaps)]
+		entries = [self.get(key) for key in keys]
+
+		missing = [i for i, entry in enumerate(entries) if entry is None]
+		if missing:
+			computed = compute(tf.gather(segmaps, missing))
+			for j, i in enumerate(missing):
+				entries[i] = tf.nest.map_structure(lambda tensor: tensor[j], computed)
+				self.put(keys[i], entries[i])
+
+		return tf.nest.map_structure(lambda *tensors: tf.stack(tensors), *entries)
@@ -0,0 +1,122 @@
+import tensorflow as tf
+
+"""
+Adam with smaller optimizer state. Plain Adam keeps two float32 moments per parameter, twice the size of the
+generator itself. The "bfloat16" state stores both moments in bfloat16, half the size. The "factored" state
+also stores the first moment in bfloat16 and replaces the second moment of every matrix and convolution kernel
+by running means over its rows and over its columns (as in Adafactor), whose outer product approximates it; for
+a 3x3x1024x1024 kernel that is 2 x 9 x 1024 values instead of 9 x 1024 x 1024. The moments are updated in
+float32 and rounded stochastically when stored, otherwise the (1 - beta_2) g^2 increments of the second moment,
+a thousandth of it, would mostly round away in bfloat16.
+"""
+
+def stochastic_bfloat16(x):
+	"""
+	:return: x rounded to bfloat16, up or down at random with probabilities that make the rounding unbiased
+	"""
+	bits = tf.bitcast(x, tf.int32)
+	noise = tf.random.uniform(tf.shape(x), maxval=2**16, dtype=tf.int32)
+	# bfloat16 is the upper half of a float32, adding noise below it and truncating rounds stochastically
+	rounded = tf.bitwise.bitwise_and(bits + noise, tf.constant(-2**16, dtype=tf.int32))
+	return tf.cast(tf.bitcast(rounded, tf.float32), tf.bfloat16)
+
+def factored(variable):
+	"""
+	:return: whether the second moment of variable is factored, i.e. it has at least two dimensions
+	"""
+	return len(variable.shape) >= 2
+
+class LowMemoryAdam(tf.keras.optimizers.Optimizer):
+	def __init__(self, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-7, state='bfloat16', \
+		name='LowMemoryAdam', **kwargs):
+		"""
+		:param state: "bfloat16" or "factored", see above
+		"""
+		super(LowMemoryAdam, self).__init__(name=name, **kwargs)
+		if state not in ('bfloat16', 'factored'):
+			raise ValueError("Unknown optimizer state %s" % state)
+		self._learning_rate = self._build_learning_rate(learning_rate)
+		self.beta_1 = beta_1
+		self.beta_2 = beta_2
+		self.epsilon = epsilon
+		self.state = state
+
+	def build(self, var_list):
+		super(LowMemoryAdam, self).build(var_list)
+		if hasattr(self, '_built') and self._built:
+			return
+		self._built = True
+		self._momentums = []
+		self._velocities = []
+		for var in var_list:
+			self._momentums.append(self.add_variable(var.shape, tf.bfloat16, name=var._shared_name + '/m'))
+			if self.state == 'factored' and factored(var):
+				# Means of the second moment over the last axis and over the one before it
+				rows = self.add_variable(var.shape[:-1], name=var._shared_name + '/v_row')
+				columns = self.add_variable(var.shape[:-2] + var.shape[-1:], name=var._shared_name + '/v_column')
+				self._velocities.append((rows, columns))
+			else:
+				dtype = tf.bfloat16 if self.state == 'bfloat16' else var.dtype
+				self._velocities.append(self.add_variable(var.shape, dtype, name=var._shared_name + '/v'))
+
+	def update_step(self, gradient, variable):
+		gradient = tf.convert_to_tensor(gradient)
+		lr = tf.cast(self.learning_rate, variable.dtype)
+		local_step = tf.cast(self.iterations + 1, variable.dtype)
+		beta_1_power = tf.pow(tf.cast(self.beta_1, variable.dtype), local_step)
+		beta_2_power = tf.pow(tf.cast(self.beta_2, variable.dtype), local_step)
+		alpha = lr * tf.sqrt(1 - beta_2_power) / (1 - beta_1_power)
+
+		index = self._index_dict[self._var_key(variable)]
+		m = self._momentums[index]
+		m_new = tf.cast(m, tf.float32)
+		m_new += (gradient - m_new) * (1 - self.beta_1)
+		m.assign(stochastic_bfloat16(m_new))
+
+		v = self._velocities[index]
+		squared = tf.square(gradient)
+		if isinstance(v, tuple):
+			rows, columns = v
+			rows.assign_add((tf.reduce_mean(squared, axis=-1) - rows) * (1 - self.beta_2))
+			columns.assign_add((tf.reduce_mean(squared, axis=-2) - columns) * (1 - self.beta_2))
+			# For a rank one second moment a b^T, rows = a mean(b) and columns = mean(a) b
+			row_mean = tf.reduce_mean(rows, axis=-1, keepdims=True)
+			v_new = tf.expand_dims(rows / tf.maximum(row_mean, 1e-30), -1) * tf.expand_dims(columns, -2)
+		elif v.dtype == tf.bfloat16:
+			v_new = tf.cast(v, tf.float32)
+			v_new += (squared - v_new) * (1 - self.beta_2)
+			v.assign(stochastic_bfloat16(v_new))
+		else:
+			v.assign_add((squared - v) * (1 - self.beta_2))
+			v_new = v
+
+		variable.assign_sub((m_new * alpha) / (tf.sqrt(v_new) + self.epsilon))
+
+	def get_config(self):
+		config = super(LowMemoryAdam, self).get_config()
+		config.update({'learning_rate': self._serialize_hyperparameter(self._learning_rate), 'beta_1': self.beta_1, \
+			'beta_2': self.beta_2, 'epsilon': self.epsilon, 'state': self.state})
+		return config
+
+def adam(learning_rate, beta_1, beta_2, state='float32'):
+	"""
+	:param state: one of OPTIMIZER_STATES, "float32" is the plain Keras Adam
+
+	:return: the Adam optimizer of a model
+	"""
+	if state == 'float32':
+		return tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2)
+	return LowMemoryAdam(learning_rate=learning_rate, beta_1=beta_1, beta_2=beta_2, state=state)
+
+def fresh_optimizer(optimizer):
+	"""
+	:return: an optimizer with the settings of optimizer and no state. A checkpoint restored into an unbuilt
+	optimizer fills its moments once it is built; the copy is not affected.
+	"""
+	return optimizer.__class__.from_config(optimizer.get_config())
+
+def state_bytes(optimizer):
+	"""
+	:return: bytes of the per parameter state (moments) of an optimizer, once it is built
+	"""
+	return sum(v.shape.num_elements() * v.dtype.size for v in optimizer.variables if len(v.shape) > 0)
@@ -1,18 +1,80 @@
 import numpy as np
 import tensorflow as tf
-import tensorflow_addons as tfa
 import os
 import sys
 
-import matplotlib.pyplot as plt
-
 """
 MODELED AFTER Brown CSCI 1470 DEEP LEARNING GAN ASSIGNMENT 7 HOMEWORK
 """
 
+def segmap_pyramid(segmap, sizes):
+    """
+    Resizes a single one-hot segmap to every resolution the generator consumes, so that the resizing happens
+    once per sample in the input pipeline rather than in every SpadeLayer on every step.
+
+    :param segmap: one-hot segmap, shape=[height, width, num_objects]
+    :param sizes: list of (height, width), coarsest first, see SPADEGenerator.segmap_pyramid_sizes
+
+    :return: tuple of segmaps, one per size
+    """
+    # The decoded segmap has no static rank (it is squeezed), which resize needs
+    segmap = tf.ensure_shape(segmap, [None, None, None])
+    return tuple(tf.image.resize(segmap, size=size, method="nearest") for size in sizes)
+
+def num_segmap_objects(objects_file='./data/objects_we_want.txt'):
+    """
+    :return: number of channels in the one hot segmaps: one per object we want, plus one for all others
+    """
+    with open(objects_file, 'r') as f:
+        # Add plus one due to the zero that represents the all other objects
+        return len(f.read().split('\n')) + 1
+
+def decode_segmap(file_path, num_objects):
+    """
+    Given a file path, this function opens and decodes the segmap stored in the file.
+
+    :param file_path: path of a grayscale segmap png
+    :param num_objects: see num_segmap_objects
+
+    :return: a one-hot encoded segmap
+    """
+    return decode_segmap_png(tf.io.read_file(file_path), num_objects)
+
+def decode_segmap_png(png, num_objects):
+    """
+    :param png: encoded grayscale segmap png, e.g. the body of a synthesis request
+    :param num_objects: see num_segmap_objects
+
+    :return: a one-hot encoded segmap
+    """
+    return tf.one_hot(decode_segmap_labels(png, num_objects), num_objects)
+
+def decode_segmap_labels(png, num_objects):
+    """
+    :return: the segmap labels of an encoded segmap png, shape=[height, width], before one-hot encoding (which
+    multiplies the memory by num_objects, see tiling.py)
+    """
+    # Load image
+    # Grayscale already, so transform to 2D grayscale array
+    image = tf.io.decode_png(png, channels=1) 
+    image = tf.squeeze(image)
+    # Charlie does not think we should be normalizing the segmaps
+    # # Convert image to normalized float (0, 1)
+    image = tf.image.convert_image_dtype(image, tf.uint8) * num_objects
+    image = tf.cast(image, tf.int32)
+    original_shape = tf.shape(image)
+    image = tf.reshape(image, shape=(-1,))
+    _, idx = tf.unique(image)
+    image = tf.reshape(idx, original_shape)
+
+    # Rescale data to range (-1, 1)
+    #image = (image - 0.5) * 2
+    return image
+
 # Sets up tensorflow graph to load images
 # (This is the version using new-style tf.data API)
-def load_image_batch(dir_name, batch_size=32, shuffle_buffer_size=25, n_threads=10, drop_remainder=True):
+def load_image_batch(dir_name, batch_size=32, shuffle_buffer_size=25, n_threads=10, drop_remainder=True, \
+    pyramid_sizes=None, feature_cache=None, prefetch_size=1):
     """
     Given a directory and a batch size, the following method returns a dataset iterator that can be queried for 
     a batch of images
@@ -23,14 +85,16 @@ def load_image_batch(dir_name, batch_size=32, shuffle_buffer_size=25, n_threads=
     NOTE: At the moment, we do not know if we need to change this ^
     sample
     :param n_thread: the number of threads that will be used to fetch the data
+    :param pyramid_sizes: if given, every segmap is replaced by a tuple of segmaps at these (height, width)
+    resolutions, coarsest first, with the full resolution one last
+    :param feature_cache: optional VGGFeatureCache; every element then also holds the segmap path, the cached
+    VGG features of the image and whether they were cached, see feature_cache.py
+    :param prefetch_size: number of batches prepared ahead of the training step, tf.data.AUTOTUNE lets tf.data
+    decide
 
     :return: an iterator into the dataset
     """
-    objects_file = './data/objects_we_want.txt'
-    f = open(objects_file, 'r')
-
-    # Add plus one due to the zero that represents the all other objects
-    num_objects = len(f.read().split('\n')) + 1
+    num_objects = num_segmap_objects()
 
     # Function used to load and pre-process image files
     # (Have to define this ahead of time b/c Python does allow multi-line
@@ -61,23 +125,7 @@ def load_image_batch(dir_name, batch_size=32, shuffle_buffer_size=25, n_threads=
 
         :return: a one-hot encoded segmap
         """
-        # Load image
-        # Grayscale already, so transform to 2D grayscale array
-        image = tf.io.decode_png(tf.io.read_file(file_path), channels=1) 
-        image = tf.squeeze(image)
-        # Charlie does not think we should be normalizing the segmaps
-        # # Convert image to normalized float (0, 1)
-        image = tf.image.convert_image_dtype(image, tf.uint8) * num_objects
-        image = tf.cast(image, tf.int32)
-        original_shape = tf.shape(image)
-        image = tf.reshape(image, shape=(-1,))
-        _, idx = tf.unique(image)
-        image = tf.reshape(idx, original_shape)
-        one_hot = tf.one_hot(image, num_objects)
-
-        # Rescale data to range (-1, 1)
-        #image = (image - 0.5) * 2
-        return one_hot
+        return decode_segmap(file_path, num_objects)
     
     def augment(image, segmap):
         """
@@ -89,6 +137,8 @@ def load_image_batch(dir_name, batch_size=32, shuffle_buffer_size=25, n_threads=
  
         :return: augmented (image, segmap) tuple, both decoded
         """
+        import tensorflow_addons as tfa
+
         # Flip image horizontally
         flip_bool = np.random.rand()
 
@@ -182,14 +232,23 @@ def load_image_batch(dir_name, batch_size=32, shuffle_buffer_size=25, n_threads=
     dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
 
     # Load and process images (in parallel)
-    dataset = dataset.map(map_func=get_image_segmap_pair, num_parallel_calls=n_threads)
+    if feature_cache is None:
+        dataset = dataset.map(map_func=get_image_segmap_pair, num_parallel_calls=n_threads)
+    else:
+        dataset = dataset.map(map_func=lambda segmap_path: get_image_segmap_pair(segmap_path) + \
+            feature_cache.lookup(segmap_path), num_parallel_calls=n_threads)
+
+    # Precompute the segmap resolution pyramid on the CPU workers
+    if pyramid_sizes is not None:
+        dataset = dataset.map(map_func=lambda image, segmap, *cached: (image, segmap_pyramid(segmap, pyramid_sizes)) + \
+            cached, num_parallel_calls=n_threads)
 
     # Create batch, dropping the final one which has less than batch_size elements and finally set to reshuffle
     # the dataset at the end of each iteration
     dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
 
     # Prefetch the next batch while the GPU is training
-    dataset = dataset.prefetch(1)
+    dataset = dataset.prefetch(prefetch_size)
 
     # Return an iterator over this dataset
     return dataset
@@ -0,0 +1,45 @@
+import tensorflow as tf
+
+"""
+Progressive resolution training: early epochs train at a fraction of the full resolution, with the
+generator skipping its first upsampling stages (see SPADEGenerator.active_upsample_count), and the
+resolution doubles every few epochs until it reaches the full size.
+"""
+
+def progressive_scale(epoch, start_scale, epochs_per_stage):
+	"""
+	:param epoch: the current epoch, starting at 0
+	:param start_scale: fraction of the full resolution to start at, a power of 2 such as 0.25. 1 disables
+	progressive training
+	:param epochs_per_stage: number of epochs to train at each resolution before doubling it
+
+	:return: fraction of the full resolution to train at in this epoch
+	"""
+	if start_scale >= 1:
+		return 1.0
+	return min(1.0, start_scale * 2 ** (epoch // epochs_per_stage))
+
+def rescale_batch(images, seg_maps, scale):
+	"""
+	Downscales a training batch for progressive training.
+
+	:param images: batch of real images, shape=[batch_size, height, width, 3]
+	:param seg_maps: batch of full resolution segmaps, or a segmap pyramid (tuple of batches, coarsest first)
+	:param scale: fraction of the full resolution to return
+
+	:return: (images, seg_maps) at the given fraction of the resolution. Pyramids keep only the levels up to
+	that resolution, so their finest level matches the images.
+	"""
+	if scale >= 1:
+		return images, seg_maps
+
+	_, height, width, _ = list(images.shape)
+	size = (int(height * scale), int(width * scale))
+	images = tf.image.resize(images, size=size, method="area")
+
+	if isinstance(seg_maps, (tuple, list)):
+		seg_maps = tuple(level for level in seg_maps if level.shape[1] <= size[0])
+	else:
+		seg_maps = tf.image.resize(seg_maps, size=size, method="nearest")
+
+	return images, seg_maps
@@ -0,0 +1,166 @@
+import numpy as np
+import tensorflow as tf
+from code.constants import PRUNE_SALIENCIES
+from code.generator import SPADEGenerator
+from code.spectral_norm import power_iteration_vector
+
+"""
+Structured channel pruning of a trained SPADEGenerator. Two kinds of channels are removed:
+- the middle channels of every SpadeBlock (output of conv0, input of conv1, normalized by spade1)
+- the hidden channels of every SpadeLayer (the segmap embedding feeding the gamma and beta convolutions)
+The channels with the lowest saliency are dropped and a smaller generator is built with the remaining weights
+copied over, so the pruned model is physically smaller rather than masked. The block input and output widths
+are left alone, since they are tied together by the residual connections.
+"""
+
+def keep_indices(saliency, ratio):
+	"""
+	:param saliency: saliency of every channel, shape=[channels]
+	:param ratio: fraction of the channels to remove
+
+	:return: sorted indices of the channels to keep, at least one
+	"""
+	saliency = np.asarray(saliency)
+	keep = max(1, int(round(len(saliency) * (1 - ratio))))
+	return np.sort(np.argsort(-saliency)[:keep])
+
+def filter_norms(weight, axis):
+	"""
+	:return: L1 norm of every slice of a convolution kernel along the given channel axis
+	"""
+	weight = np.asarray(weight)
+	return np.sum(np.abs(np.moveaxis(weight, axis, -1).reshape(-1, weight.shape[axis])), axis=0)
+
+def middle_saliency(block, saliency='weight_norm'):
+	"""
+	:param block: a SpadeBlock
+	:param saliency: "weight_norm" scores a middle channel by the norms of its conv0 filter and conv1 input
+	slice, "bn_scale" by the magnitude of its batch norm scale in spade1
+
+	:return: saliency of every middle channel
+	"""
+	if saliency == 'bn_scale':
+		return np.abs(np.asarray(block.spade1.bn.gamma))
+	return filter_norms(block.conv0, axis=-1) * filter_norms(block.conv1, axis=-2)
+
+def hidden_saliency(layer):
+	"""
+	:param layer: a SpadeLayer with its own segmap embedding
+
+	:return: saliency of every hidden channel: the norms of its conv0 filter times the norms of its gamma and
+	beta input slices. There is no batch norm on the hidden channels, so this is used for both saliencies.
+	"""
+	return filter_norms(layer.conv0, axis=-1) * (filter_norms(layer.conv1, axis=-2) + filter_norms(layer.conv2, axis=-2))
+
+def prune_plan(generator, ratio, saliency='weight_norm'):
+	"""
+	Chooses the channels to keep in every SpadeBlock.
+
+	:param generator: a trained SPADEGenerator
+	:param ratio: fraction of the middle and hidden channels to remove
+	:param saliency: one of PRUNE_SALIENCIES
+
+	:return: (block configs of the pruned generator, list of (middle indices, [hidden indices per SpadeLayer])
+	per block, where hidden indices are None for shared segmap trunks)
+	"""
+	if saliency not in PRUNE_SALIENCIES:
+		raise ValueError('Unknown saliency "%s", expected one of %s' % (saliency, PRUNE_SALIENCIES))
+	if generator.separable:
+		raise ValueError('Pruning does not support depthwise separable convolutions')
+
+	configs = []
+	plan = []
+	for block, config in zip(generator.spade_blocks(), generator.block_configs):
+		middle = keep_indices(middle_saliency(block, saliency), ratio)
+
+		# Shared segmap trunks feed every layer at a resolution, so their hidden width stays
+		hidden = [None if generator.share_segmap_trunk else keep_indices(hidden_saliency(layer), ratio) \
+			for layer in block.spade_layers()]
+		hidden_channels = config['hidden_channels'] if generator.share_segmap_trunk else \
+			[len(indices) for indices in hidden] + [len(hidden[0])] * (3 - len(hidden))
+
+		configs.append(dict(config, middle_channels=len(middle), hidden_channels=hidden_channels))
+		plan.append((middle, hidden))
+
+	return configs, plan
+
+def gather(variable, indices, axis):
+	if indices is None:
+		return variable
+	return tf.gather(variable, indices, axis=axis)
+
+def copy_kernel(kernel, pruned_kernel, value, out=None):
+	"""
+	Assigns value to pruned_kernel and carries the spectral norm power iteration vector of kernel over, so
+	the pruned model starts from the same sigma estimates.
+
+	:param out: indices of the output channels kept in value, None for all
+	"""
+	pruned_kernel.assign(value)
+	power_iteration_vector(pruned_kernel).assign(gather(power_iteration_vector(kernel), out, axis=1))
+
+def copy_spade_layer(layer, pruned_layer, hidden, out):
+	"""
+	Copies the weights of layer into the smaller pruned_layer.
+
+	:param hidden: indices of the hidden channels to keep, None for all
+	:param out: indices of the output (normalized feature) channels to keep, None for all
+	"""
+	if not layer.shared_trunk:
+		copy_kernel(layer.conv0, pruned_layer.conv0, gather(layer.conv0, hidden, axis=3), hidden)
+		pruned_layer.bias0.assign(gather(layer.bias0, hidden, axis=0))
+	for name in ['conv1', 'conv2']:
+		kernel = getattr(layer, name)
+		copy_kernel(kernel, getattr(pruned_layer, name), gather(gather(kernel, hidden, axis=2), out, axis=3), out)
+	for name in ['bias1', 'bias2']:
+		getattr(pruned_layer, name).assign(gather(getattr(layer, name), out, axis=0))
+	for weight, pruned_weight in zip(layer.bn.weights, pruned_layer.bn.weights):
+		pruned_weight.assign(gather(weight, out, axis=0))
+
+def copy_pruned_weights(generator, pruned, plan):
+	"""
+	Copies the kept channels of every weight of generator into pruned, which has to be built already.
+	"""
+	for name in ['fc', 'conv_layer']:
+		copy_kernel(getattr(generator, name), getattr(pruned, name), getattr(generator, name))
+	for name in ['fc_bias', 'conv_bias']:
+		getattr(pruned, name).assign(getattr(generator, name))
+	if generator.share_segmap_trunk:
+		for kernel, pruned_kernel in zip(generator.trunk_convs, pruned.trunk_convs):
+			copy_kernel(kernel, pruned_kernel, kernel)
+		for bias, pruned_bias in zip(generator.trunk_biases, pruned.trunk_biases):
+			pruned_bias.assign(bias)
+
+	for block, pruned_block, (middle, hidden) in zip(generator.spade_blocks(), pruned.spade_blocks(), plan):
+		copy_kernel(block.conv0, pruned_block.conv0, gather(block.conv0, middle, axis=3), middle)
+		pruned_block.bias0.assign(gather(block.bias0, middle, axis=0))
+		copy_kernel(block.conv1, pruned_block.conv1, gather(block.conv1, middle, axis=2))
+		pruned_block.bias1.assign(block.bias1)
+		if block.learned_shortcut:
+			copy_kernel(block.conv_s, pruned_block.conv_s, block.conv_s)
+
+		outs = [None, middle, None]
+		for layer, pruned_layer, layer_hidden, out in zip(block.spade_layers(), pruned_block.spade_layers(), hidden, outs):
+			copy_spade_layer(layer, pruned_layer, layer_hidden, out)
+
+def prune_generator(generator, ratio, saliency='weight_norm', **generator_kwargs):
+	"""
+	:param generator: a trained SPADEGenerator
+	:param ratio: fraction of the middle and hidden channels to remove
+	:param saliency: one of PRUNE_SALIENCIES
+	:param generator_kwargs: SPADEGenerator arguments of the pruned model (optimizer settings, fused paths)
+
+	:return: a new, smaller SPADEGenerator holding the kept weights of generator
+	"""
+	# Build the batch norm layers of a freshly restored generator, so there is something to prune
+	segmap = tf.zeros([1, generator.img_h, generator.img_w, generator.segmap_filters])
+	generator.call(None, segmap)
+
+	configs, plan = prune_plan(generator, ratio, saliency)
+	pruned = SPADEGenerator(generator.segmap_filters, z_dim=generator.z_dim, img_w=generator.img_w, \
+		img_h=generator.img_h, share_segmap_trunk=generator.share_segmap_trunk, block_configs=configs, \
+		**generator_kwargs)
+
+	pruned.call(None, segmap)
+	copy_pruned_weights(generator, pruned, plan)
+	return pruned
@@ -0,0 +1,113 @@
+import time
+import numpy as np
+import tensorflow as tf
+from code.constants import QUANTIZE_MODES
+from code.spectral_norm import frozen_power_iteration
+
+"""
+Post-training quantization of the SPADE generator for CPU serving. The generator is traced for a single
+(1, img_h, img_w, segmap_filters) segmap, converted with the TFLite converter and run with the TFLite
+interpreter so that the float and quantized models can be timed on the same runtime.
+"""
+
+def generator_concrete_function(generator, img_h, img_w, segmap_filters):
+	"""
+	Traces the generator for a single segmap. The noise input is ignored by the generator, so it is not
+	part of the exported signature. The spectral norm power iteration is frozen so the traced graph has no
+	variable updates and can be converted to constants.
+
+	:param generator: a (restored) SPADEGenerator
+	:param img_h: height of the segmaps the model is exported for
+	:param img_w: width of the segmaps the model is exported for
+	:param segmap_filters: number of channels in the one hot segmap
+
+	:return: a concrete function mapping a [1, img_h, img_w, segmap_filters] segmap to an image
+	"""
+	@tf.function(input_signature=[tf.TensorSpec([1, img_h, img_w, segmap_filters], tf.float32, name='segmap')])
+	def synthesize(segmap):
+		return generator.call(None, segmap)
+
+	generator.prepare_inference()
+	with frozen_power_iteration():
+		return synthesize.get_concrete_function()
+
+def representative_dataset(segmaps):
+	"""
+	Wraps a list of calibration segmaps in the callable the TFLite converter expects.
+
+	:param segmaps: list of segmaps, each of shape [1, height, width, segmap_filters]
+
+	:return: a callable returning a generator over single-input samples
+	"""
+	def generate():
+		for segmap in segmaps:
+			yield [tf.cast(segmap, tf.float32)]
+	return generate
+
+def convert_generator(generator, img_h, img_w, segmap_filters, mode='int8', calibration_segmaps=None):
+	"""
+	Converts the generator to a TFLite flatbuffer.
+
+	:param mode: "int8" for full integer quantization (calibrated on calibration_segmaps), "dynamic" for
+	dynamic-range quantization of the weights, or "float" for an unquantized baseline model
+	:param calibration_segmaps: list of [1, img_h, img_w, segmap_filters] segmaps, required for "int8"
+
+	:return: the serialized TFLite model
+	"""
+	if mode not in QUANTIZE_MODES:
+		raise ValueError('Unknown quantization mode "%s", expected one of %s' % (mode, QUANTIZE_MODES))
+
+	concrete_function = generator_concrete_function(generator, img_h, img_w, segmap_filters)
+	converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function], generator)
+
+	if mode == 'dynamic':
+		converter.optimizations = [tf.lite.Optimize.DEFAULT]
+	elif mode == 'int8':
+		if not calibration_segmaps:
+			raise ValueError('int8 quantization needs calibration segmaps')
+		converter.optimizations = [tf.lite.Optimize.DEFAULT]
+		converter.representative_dataset = representative_dataset(calibration_segmaps)
+		# Keep float inputs and outputs so the model is a drop in replacement for the generator
+		converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+	return converter.convert()
+
+class TFLiteGenerator(object):
+	"""
+	Runs a converted generator with the TFLite interpreter, one segmap at a time.
+	"""
+	def __init__(self, model_content, num_threads=None):
+		self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+		self.interpreter.allocate_tensors()
+		self.input_index = self.interpreter.get_input_details()[0]['index']
+		self.output_index = self.interpreter.get_output_details()[0]['index']
+
+	def __call__(self, segmaps):
+		"""
+		:param segmaps: batch of segmaps, shape=[batch_size, height, width, segmap_filters]
+
+		:return: batch of generated images as a numpy array
+		"""
+		outputs = []
+		for segmap in np.asarray(segmaps, dtype=np.float32):
+			self.interpreter.set_tensor(self.input_index, segmap[np.newaxis])
+			self.interpreter.invoke()
+			outputs.append(self.interpreter.get_tensor(self.output_index)[0])
+		return np.stack(outputs)
+
+def time_per_image(run, segmaps, warmup=2):
+	"""
+	Measures the average wall clock latency of a generator callable on single segmaps.
+
+	:param run: callable taking a [1, height, width, segmap_filters] batch
+	:param segmaps: list of single segmap batches to time over
+
+	:return: average seconds per image
+	"""
+	for segmap in segmaps[:warmup]:
+		run(segmap)
+
+	start = time.perf_counter()
+	for segmap in segmaps:
+		run(segmap)
+	return (time.perf_counter() - start) / len(segmaps)
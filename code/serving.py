@@ -0,0 +1,172 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import tensorflow as tf
+
+from code.spectral_norm import frozen_power_iteration
+
+"""
+Dynamic request batching for serving the generator. Requests are queued, and a single worker thread takes
+the oldest request and waits up to max_wait seconds for more, until max_batch_size segmaps are collected.
+It then runs one generator call on the batch and resolves every request with its image. The generator can
+be swapped for a newer one at any time; batches already running finish on the old generator.
+"""
+
+class DynamicBatcher(object):
+	def __init__(self, generator, max_batch_size=16, max_wait=0.01, cache=None, checkpoint_id=None):
+		"""
+		:param generator: a restored SPADEGenerator, see load_generator
+		:param max_batch_size: largest number of segmaps per generator call
+		:param max_wait: seconds the oldest queued request waits for the batch to fill up
+		:param cache: optional ModulationCache, so repeated segmaps skip the segmap branch
+		:param checkpoint_id: checkpoint the generator was restored from, part of the cache keys
+		"""
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		self.cache = cache
+		self.requests = queue.Queue()
+		self.batches_served = 0
+		self.images_served = 0
+		self.swap(generator, checkpoint_id)
+
+		self.worker = threading.Thread(target=self.run, daemon=True)
+		self.worker.start()
+
+	def swap(self, generator, checkpoint_id=None):
+		"""
+		Serves the following batches with generator. Replacing the attribute is atomic, so no request is
+		dropped or sees a half loaded model.
+		"""
+		segmaps = tf.zeros([1, generator.img_h, generator.img_w, generator.segmap_filters])
+		with frozen_power_iteration():
+			synthesize = tf.function(lambda segmaps: generator.call(None, segmaps), reduce_retracing=True)
+			modulate = tf.function(generator.segmap_modulations, reduce_retracing=True)
+			synthesize_modulated = tf.function(lambda segmaps, modulations: generator.call(None, segmaps, \
+				modulations=modulations), reduce_retracing=True)
+
+			# Trace before going live, so the first batch on the new generator is not slow
+			synthesize(segmaps)
+			if self.cache is not None:
+				synthesize_modulated(segmaps, modulate(segmaps))
+
+		self.pipeline = (synthesize, modulate, synthesize_modulated, checkpoint_id)
+		# Entries of the previous checkpoint can no longer hit
+		if self.cache is not None:
+			self.cache.clear()
+
+	def synthesize(self, segmaps):
+		synthesize, modulate, synthesize_modulated, checkpoint_id = self.pipeline
+		if self.cache is None:
+			return synthesize(segmaps)
+		return synthesize_modulated(segmaps, self.cache.modulations(segmaps, checkpoint_id, modulate))
+
+	def submit(self, segmap):
+		"""
+		:param segmap: one hot segmap, shape=[img_h, img_w, segmap_filters]
+
+		:return: a Future resolving to the generated image, shape=[img_h, img_w, 3]
+		"""
+		future = Future()
+		self.requests.put((segmap, future))
+		return future
+
+	def next_batch(self):
+		"""
+		:return: list of (segmap, future) requests, blocks until there is at least one
+		"""
+		batch = [self.requests.get()]
+		deadline = time.perf_counter() + self.max_wait
+		while len(batch) < self.max_batch_size:
+			timeout = deadline - time.perf_counter()
+			if timeout <= 0:
+				break
+			try:
+				batch.append(self.requests.get(timeout=timeout))
+			except queue.Empty:
+				break
+		return batch
+
+	def run(self):
+		while True:
+			batch = self.next_batch()
+			try:
+				# The first batch of a new size is traced here, that trace must not update the power iteration
+				with frozen_power_iteration():
+					images = self.synthesize(tf.stack([segmap for segmap, _ in batch])).numpy()
+			except Exception as e:
+				for _, future in batch:
+					future.set_exception(e)
+				continue
+
+			for (_, future), image in zip(batch, images):
+				future.set_result(image)
+			self.batches_served += 1
+			self.images_served += len(batch)
+
+class CheckpointWatcher(object):
+	"""
+	Polls a checkpoint directory and hot swaps the batcher's generator when a newer checkpoint appears.
+	"""
+	def __init__(self, batcher, checkpoint_dir, build_generator, poll_seconds=30, checkpoint_path=None):
+		"""
+		:param build_generator: callable returning a new, unrestored SPADEGenerator
+		:param checkpoint_path: checkpoint the batcher's current generator was restored from
+		"""
+		self.batcher = batcher
+		self.checkpoint_dir = checkpoint_dir
+		self.build_generator = build_generator
+		self.poll_seconds = poll_seconds
+		self.checkpoint_path = checkpoint_path
+
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self):
+		while True:
+			time.sleep(self.poll_seconds)
+			latest = tf.train.latest_checkpoint(self.checkpoint_dir)
+			if latest is None or latest == self.checkpoint_path:
+				continue
+			try:
+				generator = load_generator(self.build_generator, latest)
+				self.batcher.swap(generator, latest)
+			except Exception as e:
+				# Keep serving the old generator, e.g. when the checkpoint is still being written
+				print("Could not load %s: %s" % (latest, e))
+				continue
+			self.checkpoint_path = latest
+			print("Serving %s" % latest)
+
+def load_generator(build_generator, checkpoint_path):
+	"""
+	:return: a generator built with build_generator and restored from checkpoint_path (a random one if None),
+	ready for frozen power iteration inference. Raises ValueError if the checkpoint lacks weights of the
+	generator, i.e. it was trained with another architecture.
+	"""
+	generator = build_generator()
+	if checkpoint_path is not None:
+		# Builds the lazily created normalization weights first, so that the restore checks them as well
+		generator.call(None, tf.zeros([1, generator.img_h, generator.img_w, generator.segmap_filters]))
+		try:
+			tf.train.Checkpoint(generator=generator).restore(checkpoint_path).expect_partial() \
+				.assert_existing_objects_matched()
+		except AssertionError:
+			# The assertion message lists the values of every unmatched weight
+			raise ValueError("%s lacks weights of the generator being served, check the architecture flags" % \
+				checkpoint_path) from None
+	generator.prepare_inference()
+	return generator
+
+def latency_summary(latencies, seconds):
+	"""
+	:param latencies: seconds per request
+	:param seconds: wall clock duration of the load test
+
+	:return: dict with the request count, p50/p99 latency in ms and throughput in requests per second
+	"""
+	latencies = np.asarray(latencies)
+	return {'requests': len(latencies), 'p50_ms': float(np.percentile(latencies, 50) * 1000), \
+		'p99_ms': float(np.percentile(latencies, 99) * 1000), 'throughput': len(latencies) / seconds}
@@ -1,11 +1,13 @@
-from code.spadelayer import SpadeLayer
+from code.spadelayer import SpadeLayer, add_upsampled
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.layers import BatchNormalization, LeakyReLU, Layer, ReLU
-from code.spectral_norm import spectral_conv
+from code.spectral_norm import spectral_conv, conv_weights, conv
 
 class SpadeBlock(Layer): 
-	def __init__(self, fin, fout, segmap_filters, use_bias=True, use_spectral=True, skip=False): 
+	def __init__(self, fin, fout, segmap_filters, use_bias=True, use_spectral=True, skip=False, fused_spade=False, \
+		shared_trunk=False, hidden_channels=128, spade_kernel_size=5, separable=False, separable_spade=False, \
+		middle_channels=None): 
 		super(SpadeBlock, self).__init__()
 		#self.use_spectral = use_spectral 
 
@@ -25,53 +27,85 @@ class SpadeBlock(Layer):
 		self.relu = ReLU() """
 		self.use_spectral = use_spectral
 		self.learned_shortcut = (fin != fout)
-		fmiddle = min(fin, fout)
+		# middle_channels and per layer hidden_channels ([spade0, spade1, spade_s]) are set by pruning
+		fmiddle = min(fin, fout) if middle_channels is None else middle_channels
+		if isinstance(hidden_channels, int):
+			hidden_channels = [hidden_channels] * 3
 		self.glorot = tf.keras.initializers.GlorotNormal()
 		
-		# filters out = fmiddle, kernel=3, strides=1
-		self.conv0 = tf.Variable(self.glorot(shape=[3,3,fin,fmiddle]))
+		# filters out = fmiddle, kernel=3, strides=1 (depthwise separable if separable)
+		self.conv0 = conv_weights(self.glorot, 3, fin, fmiddle, separable)
 		self.bias0 = tf.Variable(self.glorot(shape=[fmiddle]))
-		# filters out = fout, kernel=3, strides=1
-		self.conv1 = tf.Variable(self.glorot(shape=[3,3,fmiddle,fout]))
+		# filters out = fout, kernel=3, strides=1 (depthwise separable if separable)
+		self.conv1 = conv_weights(self.glorot, 3, fmiddle, fout, separable)
 		self.bias1 = tf.Variable(self.glorot(shape=[fout]))
 		# filters out = fout, kernel=1, strides=1
 		if self.learned_shortcut: 
 			self.conv_s = tf.Variable(self.glorot(shape=[1,1,fin,fout]))
 
-		self.spade0 = SpadeLayer(in_channels=segmap_filters, out_channels=fin)
-		self.spade1 = SpadeLayer(in_channels=segmap_filters, out_channels=fmiddle)
+		self.spade0 = SpadeLayer(in_channels=segmap_filters, out_channels=fin, fused=fused_spade, \
+			shared_trunk=shared_trunk, hidden_channels=hidden_channels[0], kernel_size=spade_kernel_size, \
+			separable=separable_spade)
+		self.spade1 = SpadeLayer(in_channels=segmap_filters, out_channels=fmiddle, fused=fused_spade, \
+			shared_trunk=shared_trunk, hidden_channels=hidden_channels[1], kernel_size=spade_kernel_size, \
+			separable=separable_spade)
 		#self.spade_s = SpadeLayer(out_channels=fin) #comment 
 		if self.learned_shortcut: 
-			self.spade_s = SpadeLayer(in_channels=segmap_filters, out_channels=fin)
+			self.spade_s = SpadeLayer(in_channels=segmap_filters, out_channels=fin, fused=fused_spade, \
+				shared_trunk=shared_trunk, hidden_channels=hidden_channels[2], kernel_size=spade_kernel_size, \
+				separable=separable_spade)
 		self.relu = ReLU()
 
-	def call(self, features, segmap): 
+	def spade_layers(self):
+		layers = [self.spade0, self.spade1]
+		if self.learned_shortcut:
+			layers.append(self.spade_s)
+		return layers
+
+	def modulations(self, segmap, height, width, seg_hidden=None):
+		"""
+		:return: gamma_beta of every SpadeLayer of the block at the block's (output) resolution, see
+		SpadeLayer.modulation
+		"""
+		return tuple(layer.modulation(segmap, height, width, seg_hidden) for layer in self.spade_layers())
+
+	def call(self, features, segmap, seg_hidden=None, upsample=False, modulations=None): 
 		""" skip_features = self.shortcut(features, segmap)
 		#skip_features = self.conv_s(self.spade_s(features, segmap))
 		dx = self.conv0(self.lrelu1(self.spade0(features, segmap)))
 		dx = self.conv1(self.lrelu2(self.spade1(dx, segmap)))
 		out = tf.math.add(skip_features, dx) """
+		# With upsample, features are at half resolution and upsampled by 2 inside spade0 / spade_s
+		# Precomputed modulations skip the segmap branch of every SpadeLayer
+		if modulations is None:
+			modulations = (None, None, None)
 		if self.use_spectral: 
 			skip = features
-			x = self.relu(self.spade0(features, segmap))
+			x = self.relu(self.spade0(features, segmap, seg_hidden=seg_hidden, upsample=upsample, \
+				modulation=modulations[0]))
 			x = spectral_conv(inputs=x, weight=self.conv0, stride=1, bias=self.bias0)
-			x = self.relu(self.spade1(x, segmap))
+			x = self.relu(self.spade1(x, segmap, seg_hidden=seg_hidden, modulation=modulations[1]))
 			x = spectral_conv(inputs=x, weight=self.conv1, stride=1, bias=self.bias1)
 
 			if self.learned_shortcut: 
-				skip = self.relu(self.spade_s(skip, segmap))
+				skip = self.relu(self.spade_s(skip, segmap, seg_hidden=seg_hidden, upsample=upsample, \
+					modulation=modulations[2]))
 				skip = spectral_conv(inputs=skip, weight=self.conv_s, stride=1, use_bias=False)
 		else: 
 			skip = features
-			x = self.relu(self.spade0(features, segmap))
-			x = tf.nn.conv2d(x, self.conv0, [1,1,1,1], "SAME")
+			x = self.relu(self.spade0(features, segmap, seg_hidden=seg_hidden, upsample=upsample, \
+				modulation=modulations[0]))
+			x = conv(x, self.conv0, 1, normalize=False)
 			x = tf.nn.bias_add(x, self.bias0)
-			x = self.relu(self.spade1(x, segmap))
-			x = tf.nn.conv2d(x, self.conv1, [1,1,1,1], "SAME")
+			x = self.relu(self.spade1(x, segmap, seg_hidden=seg_hidden, modulation=modulations[1]))
+			x = conv(x, self.conv1, 1, normalize=False)
 			x = tf.nn.bias_add(x, self.bias1)
 
 			if self.learned_shortcut: 
-				skip = self.relu(self.spade_s(skip, segmap))
+				skip = self.relu(self.spade_s(skip, segmap, seg_hidden=seg_hidden, upsample=upsample, \
+					modulation=modulations[2]))
 				skip = tf.nn.conv2d(skip, self.conv_s, [1,1,1,1], "SAME")
 
+		if upsample and not self.learned_shortcut:
+			return add_upsampled(skip, x)
 		return tf.math.add(skip, x)
\ No newline at end of file
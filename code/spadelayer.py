@@ -1,40 +1,150 @@
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.layers import Conv2D, BatchNormalization, ReLU, Layer
-from code.spectral_norm import spectral_conv
+from code.spectral_norm import spectral_conv, spectral_norm, conv_weights
+
+def segmap_at(segmap, height, width):
+	"""
+	Returns the segmap at the given resolution. segmap is either a single full resolution segmap, which is
+	resized, or a pyramid (tuple of segmaps, see preprocess.segmap_pyramid) that already holds the level.
+	"""
+	if isinstance(segmap, (tuple, list)):
+		for level in segmap:
+			if level.shape[1] == height and level.shape[2] == width:
+				return level
+		segmap = segmap[-1]
+	if segmap.shape[1] == height and segmap.shape[2] == width:
+		return segmap
+	return tf.image.resize(segmap, size=(height, width), method="nearest")
+
+"""
+Nearest neighbour upsampling by 2 without materializing the upsampled tensor: a [b, 2h, 2w, c] tensor is viewed
+as [b, h, 2, w, 2, c] so that a [b, h, w, c] tensor broadcasts against it as its upsampled version.
+"""
+def split_upsampled(x):
+	shape = tf.shape(x)
+	return tf.reshape(x, [shape[0], shape[1] // 2, 2, shape[2] // 2, 2, shape[3]])
+
+def merge_upsampled(x):
+	shape = tf.shape(x)
+	return tf.reshape(x, [shape[0], 2 * shape[1], 2 * shape[3], shape[5]])
+
+def broadcast_upsampled(x):
+	return x[:, :, tf.newaxis, :, tf.newaxis, :]
+
+def add_upsampled(low_res, x):
+	"""
+	:return: x + nearest_upsample(low_res)
+	"""
+	return merge_upsampled(tf.math.add(split_upsampled(x), broadcast_upsampled(low_res)))
+
+def upsample_modulate(norm, gamma, beta):
+	"""
+	SPADE modulation of the nearest upsampled (by 2) normalized features, given at low resolution. Nearest
+	upsampling repeats every value 4 times, which leaves the batch norm statistics unchanged, so
+	batch_norm(upsample(x)) == upsample(batch_norm(x)) and the normalization can run at low resolution.
+	"""
+	x = tf.multiply(tf.math.add(1.0, split_upsampled(gamma)), broadcast_upsampled(norm))
+	return merge_upsampled(tf.math.add(x, split_upsampled(beta)))
+
+@tf.function(jit_compile=True, reduce_retracing=True)
+def normalize_modulate(features, scale, shift, gamma_beta, upsample=False):
+	"""
+	Inference mode batch norm folded into a per channel scale and shift, followed by the SPADE modulation,
+	compiled by XLA into a single elementwise pass over the features.
+	"""
+	gamma, beta = tf.split(gamma_beta, 2, axis=-1)
+	if upsample:
+		return upsample_modulate(features * scale + shift, gamma, beta)
+	return (features * scale + shift) * (1.0 + gamma) + beta
 
 class SpadeLayer(Layer):
-	def __init__(self, in_channels, out_channels, use_bias=True, hidden_channels=128):
+	def __init__(self, in_channels, out_channels, use_bias=True, hidden_channels=128, fused=False, shared_trunk=False, \
+		kernel_size=5, separable=False):
 		super(SpadeLayer, self).__init__()
+		# Fused computes gamma and beta with one convolution and normalizes + modulates in one pass
+		self.fused = fused
+		# With a shared trunk the segmap embedding is computed by the generator and passed in as seg_hidden
+		self.shared_trunk = shared_trunk
 		self.bn = BatchNormalization()
 		self.glorot = tf.keras.initializers.GlorotNormal()
-		# Kernel=5, Strides=1, out_channels=hidden_channels
-		self.conv0 = tf.Variable(self.glorot(shape=[5,5,in_channels, hidden_channels])) 
-		self.bias0 = tf.Variable(self.glorot(shape=[hidden_channels]))
+		# Kernel=kernel_size (5 by default), Strides=1, out_channels=hidden_channels, depthwise separable if separable
+		if not self.shared_trunk:
+			self.conv0 = conv_weights(self.glorot, kernel_size, in_channels, hidden_channels, separable)
+			self.bias0 = tf.Variable(self.glorot(shape=[hidden_channels]))
 		self.relu = ReLU()
-		# Kernel=5, strides=1, out_channels=out_channels
-		self.conv1 = tf.Variable(self.glorot(shape=[5,5,hidden_channels, out_channels])) 
+		# Kernel=kernel_size, strides=1, out_channels=out_channels
+		self.conv1 = conv_weights(self.glorot, kernel_size, hidden_channels, out_channels, separable)
 		self.bias1 = tf.Variable(self.glorot(shape=[out_channels]))
-		# kernel=5, strides=1, out_channels=out_channels
-		self.conv2 = tf.Variable(self.glorot(shape=[5,5,hidden_channels, out_channels])) 
+		# kernel=kernel_size, strides=1, out_channels=out_channels
+		self.conv2 = conv_weights(self.glorot, kernel_size, hidden_channels, out_channels, separable)
 		self.bias2 = tf.Variable(self.glorot(shape=[out_channels]))
 
 
 	""" def build(self, input_shape): 
 		super(SpadeLayer, self).build(input_shape) """
 
-	def call(self, features, segmap):
-		norm = self.bn(features)
-		
-		_, x_h, x_w, _ = list(norm.shape)
-		segmap_resized = tf.image.resize(segmap, size=(x_h, x_w), method="nearest")
+	def embed_segmap(self, segmap, x_h, x_w):
+		segmap_resized = segmap_at(segmap, x_h, x_w)
 
 		seg_result = spectral_conv(inputs=segmap_resized, weight=self.conv0, stride=1, bias=self.bias0)
-		seg_result = self.relu(seg_result)
-		result_a = spectral_conv(inputs=seg_result, weight=self.conv1, stride=1, bias=self.bias1)
-		result_b = spectral_conv(inputs=seg_result, weight=self.conv2, stride=1, bias=self.bias2)
+		return self.relu(seg_result)
+
+	def modulation(self, segmap, x_h, x_w, seg_hidden=None):
+		"""
+		:return: gamma and beta for features of size x_h x_w, concatenated along the channels. They only depend
+		on the segmap, so they can be computed once and passed back to call (see ModulationCache).
+		"""
+		if seg_hidden is None:
+			seg_hidden = self.embed_segmap(segmap, x_h, x_w)
+		return self.gamma_beta(seg_hidden)
+
+	def gamma_beta(self, seg_result):
+		if not self.fused or isinstance(self.conv1, tuple):
+			return tf.concat([spectral_conv(inputs=seg_result, weight=self.conv1, stride=1, bias=self.bias1), \
+				spectral_conv(inputs=seg_result, weight=self.conv2, stride=1, bias=self.bias2)], axis=-1)
+
+		# gamma and beta heads as one convolution with doubled output channels. Each half keeps its own
+		# spectral norm, so this matches the separate convolutions and uses the same checkpoint variables.
+		# Separable heads have different depthwise filters, so they stay two convolutions.
+		filters = tf.concat([spectral_norm(self.conv1), spectral_norm(self.conv2)], axis=-1)
+		gamma_beta = tf.nn.conv2d(input=seg_result, filters=filters, strides=1, padding="SAME")
+		return tf.nn.bias_add(gamma_beta, tf.concat([self.bias1, self.bias2], axis=-1))
+
+	def call(self, features, segmap, training=None, seg_hidden=None, upsample=False, modulation=None):
+		# With upsample the features are given at half resolution and upsampled by 2 (nearest) on the fly
+		_, x_h, x_w, _ = list(features.shape)
+		if upsample:
+			x_h, x_w = 2 * x_h, 2 * x_w
+		if modulation is None:
+			modulation = self.modulation(segmap, x_h, x_w, seg_hidden)
+
+		if self.fused:
+			return self.fused_call(features, modulation, training, upsample)
+
+		norm = self.bn(features)
+
+		result_a, result_b = tf.split(modulation, 2, axis=-1)
+
+		if upsample:
+			return upsample_modulate(norm, result_a, result_b)
 
 		x = tf.math.add(1.0, result_a)
 		x = tf.multiply(x, norm)
 		x = tf.math.add(x, result_b)
-		return x
\ No newline at end of file
+		return x
+
+	def fused_call(self, features, gamma_beta, training=None, upsample=False):
+		if training:
+			# Batch statistics (and moving average updates) still go through the keras layer
+			gamma, beta = tf.split(gamma_beta, 2, axis=-1)
+			norm = self.bn(features, training=True)
+			if upsample:
+				return upsample_modulate(norm, gamma, beta)
+			return tf.math.add(tf.multiply(tf.math.add(1.0, gamma), norm), beta)
+
+		if not self.bn.built:
+			self.bn.build(features.shape)
+		scale = self.bn.gamma * tf.math.rsqrt(self.bn.moving_variance + self.bn.epsilon)
+		shift = self.bn.beta - self.bn.moving_mean * scale
+		return normalize_modulate(features, scale, shift, gamma_beta, upsample)
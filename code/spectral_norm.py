@@ -1,14 +1,46 @@
+import contextlib
+import threading
+import weakref
 import tensorflow as tf
 """
 This spectral_norm implementation was taken from https://github.com/taki0112/Spectral_Normalization-Tensorflow
 """
+
+# Power iteration vectors, one per weight, so that the estimate of sigma carries over between calls (as the
+# original get_variable based version did) and so that calls can be traced into a tf.function. Keyed by the id
+# of the weight and dropped when the weight is garbage collected, so that discarded models (e.g. the generators
+# a server hot swaps out) are not kept alive.
+_power_iteration_vectors = {}
+# Per thread, so that a context entered and left on one thread does not change what another thread traces
+_frozen = threading.local()
+
+@contextlib.contextmanager
+def frozen_power_iteration():
+	"""
+	Within this context the power iteration vectors are read but not updated, which makes repeated calls
+	deterministic and lets the generator be traced and frozen for export. It applies to the calling thread.
+	"""
+	previous = getattr(_frozen, 'active', False)
+	_frozen.active = True
+	try:
+		yield
+	finally:
+		_frozen.active = previous
+
+def power_iteration_vector(w):
+	key = id(w)
+	if key not in _power_iteration_vectors:
+		_power_iteration_vectors[key] = tf.Variable(tf.random.truncated_normal(shape=[1, w.shape[-1]], \
+			stddev=.1, dtype=tf.float32), trainable=False, name="u")
+		weakref.finalize(w, _power_iteration_vectors.pop, key, None)
+	return _power_iteration_vectors[key]
+
 def spectral_norm(w, iteration=1):
+	u = power_iteration_vector(w)
+
 	w_shape = w.shape.as_list()
 	w = tf.reshape(w, [-1, w_shape[-1]])
 
-	u = tf.Variable(tf.random.truncated_normal(shape=[1, w_shape[-1]], \
-		stddev=.1, dtype=tf.float32), trainable=False, name="u")
-
 	u_hat = u
 	v_hat = None
 	for i in range(iteration):
@@ -27,6 +59,9 @@ def spectral_norm(w, iteration=1):
 
 	sigma = tf.matmul(tf.matmul(v_hat, w), tf.transpose(u_hat))
 
+	if getattr(_frozen, 'active', False):
+		return tf.reshape(tf.math.divide(w, sigma), w_shape)
+
 	with tf.control_dependencies([u.assign(u_hat)]):
 		w_norm = tf.math.divide(w, sigma)
 		w_norm = tf.reshape(w_norm, w_shape)
@@ -34,8 +69,52 @@ def spectral_norm(w, iteration=1):
 
 	return w_norm
 
+def refine_power_iteration(weights, iteration=50):
+	"""
+	Runs extra power iterations on the vectors of the given weights. The vectors are not checkpointed, so a
+	restored model starts from random ones; refining them before freezing gives the same sigma estimates as
+	a model that has been running for a while.
+
+	:param weights: weights to refine, the ones that have not been through spectral_norm yet are skipped
+	"""
+	for w in weights:
+		if id(w) not in _power_iteration_vectors:
+			continue
+		u = _power_iteration_vectors[id(w)]
+		w = tf.reshape(w, [-1, w.shape[-1]])
+		u_hat = u
+		for i in range(iteration):
+			v_hat = tf.nn.l2_normalize(tf.matmul(u_hat, tf.transpose(w)))
+			u_hat = tf.nn.l2_normalize(tf.matmul(v_hat, w))
+		u.assign(u_hat)
+
+def conv_weights(initializer, kernel_size, in_channels, out_channels, separable=False):
+	"""
+	Creates the weights of a kernel_size x kernel_size convolution. A separable convolution is a depthwise
+	kernel_size x kernel_size convolution followed by a pointwise 1x1 convolution, and its weights are a
+	(depthwise, pointwise) tuple. The depthwise kernel is stored as [k, k, 1, in_channels] so that its
+	spectral norm is taken over the matrix of per channel filters.
+	"""
+	if separable and kernel_size > 1:
+		return (tf.Variable(initializer(shape=[kernel_size, kernel_size, 1, in_channels])), \
+			tf.Variable(initializer(shape=[1, 1, in_channels, out_channels])))
+	return tf.Variable(initializer(shape=[kernel_size, kernel_size, in_channels, out_channels]))
+
+def conv(inputs, weight, stride, normalize=True):
+	if isinstance(weight, tuple):
+		depthwise, pointwise = weight
+		if normalize:
+			depthwise, pointwise = spectral_norm(depthwise), spectral_norm(pointwise)
+		kernel_size, _, _, in_channels = depthwise.shape.as_list()
+		depthwise = tf.reshape(depthwise, [kernel_size, kernel_size, in_channels, 1])
+		return tf.nn.separable_conv2d(inputs, depthwise, pointwise, strides=[1, stride, stride, 1], padding="SAME")
+
+	if normalize:
+		weight = spectral_norm(weight)
+	return tf.nn.conv2d(input=inputs, filters=weight, strides=stride, padding="SAME")
+
 def spectral_conv(inputs, weight, stride, bias=None, use_bias=True):
-	x = tf.nn.conv2d(input=inputs, filters=spectral_norm(weight), strides=stride, padding="SAME")
+	x = conv(inputs, weight, stride)
 	if use_bias:
 		x = tf.nn.bias_add(x, bias)
 	return x
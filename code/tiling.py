@@ -0,0 +1,113 @@
+import numpy as np
+import tensorflow as tf
+
+from code.spectral_norm import frozen_power_iteration
+
+"""
+Tiled inference for label maps larger than the generator's img_h x img_w. The map is cut into overlapping
+img_h x img_w tiles; every generated tile is weighted by a window that fades out over the overlap margin, and
+overlapping tiles are averaged with those weights so that no seam is visible. Tiles are generated one row of
+tiles at a time, and the finished rows are written out before the next tile row starts, so memory stays
+bounded by a band of two tile heights, whatever the size of the map.
+"""
+
+def tile_positions(length, tile, margin):
+	"""
+	:param length: size of the map along one axis, at least tile
+	:param tile: size of a tile along that axis
+	:param margin: overlap between neighbouring tiles is 2 * margin
+
+	:return: start offsets of the tiles, the last tile ending at length
+	"""
+	stride = max(1, tile - 2 * margin)
+	positions = list(range(0, length - tile + 1, stride))
+	if positions[-1] != length - tile:
+		positions.append(length - tile)
+	return positions
+
+def blend_window(height, width, margin):
+	"""
+	:return: per pixel weights of a tile, shape=[height, width, 1]: 1 in the middle, ramping down linearly over
+	margin pixels at every edge (never reaching 0, so that pixels covered by a single tile keep their value)
+	"""
+	def ramp(length):
+		if margin <= 0:
+			return np.ones(length, dtype=np.float32)
+		distance = np.minimum(np.arange(length), np.arange(length)[::-1]) + 0.5
+		return np.minimum(1, distance / margin).astype(np.float32)
+	return (ramp(height)[:, np.newaxis] * ramp(width)[np.newaxis, :])[:, :, np.newaxis]
+
+def tiled_synthesize(generator):
+	"""
+	:return: the generator call traced once for batches of tiles
+	"""
+	return tf.function(lambda segmaps: generator.call(None, segmaps), reduce_retracing=True)
+
+def tiled_generate(generator, labels, num_objects, margin=16, batch_size=8, out=None, synthesize=None):
+	"""
+	:param generator: a SPADEGenerator, see SPADEGenerator.prepare_inference
+	:param labels: segmap labels of any size, shape=[height, width], see preprocess.decode_segmap_labels
+	:param num_objects: number of channels in the one hot segmap
+	:param margin: context margin of every tile; neighbouring tiles overlap by 2 * margin pixels
+	:param batch_size: number of tiles per generator call
+	:param out: optional uint8 array of shape [height, width, 3] to write into, e.g. a np.memmap
+	:param synthesize: traced generator call to reuse across maps, see tiled_synthesize
+
+	:return: the generated image as uint8, shape=[height, width, 3]
+	"""
+	tile_h, tile_w = generator.img_h, generator.img_w
+	height, width = labels.shape
+	if out is None:
+		out = np.zeros((height, width, 3), dtype=np.uint8)
+
+	# Maps smaller than a tile are padded with their edge labels and cropped at the end
+	padded = np.pad(labels, ((0, max(0, tile_h - height)), (0, max(0, tile_w - width))), mode='edge')
+	padded_h, padded_w = padded.shape
+	ys = tile_positions(padded_h, tile_h, margin)
+	xs = tile_positions(padded_w, tile_w, margin)
+	window = blend_window(tile_h, tile_w, margin)
+
+	synthesize = synthesize or tiled_synthesize(generator)
+
+	# Weighted sums of the rows from band_top to band_top + 2 * tile_h, which hold every unfinished row
+	band_top = 0
+	image_sum = np.zeros((2 * tile_h, padded_w, 3), dtype=np.float32)
+	weight_sum = np.zeros((2 * tile_h, padded_w, 1), dtype=np.float32)
+
+	def flush(rows):
+		"""
+		Writes the first rows of the band to out and shifts the band down
+		"""
+		finished = image_sum[:rows] / weight_sum[:rows]
+		top, bottom = band_top, min(band_top + rows, height)
+		if bottom > top:
+			out[top:bottom] = np.clip(finished[:bottom - top, :width] * 255, 0, 255).astype(np.uint8)
+		image_sum[:-rows], weight_sum[:-rows] = image_sum[rows:].copy(), weight_sum[rows:].copy()
+		image_sum[-rows:], weight_sum[-rows:] = 0, 0
+
+	with frozen_power_iteration():
+		for row, y in enumerate(ys):
+			for start in range(0, len(xs), batch_size):
+				batch_xs = xs[start:start + batch_size]
+				tiles = np.stack([padded[y:y + tile_h, x:x + tile_w] for x in batch_xs])
+				images = synthesize(tf.one_hot(tiles, num_objects)).numpy()
+
+				offset = y - band_top
+				for x, image in zip(batch_xs, images):
+					image_sum[offset:offset + tile_h, x:x + tile_w] += image * window
+					weight_sum[offset:offset + tile_h, x:x + tile_w] += window
+
+			# Rows above the next tile row are not touched again
+			next_top = ys[row + 1] if row + 1 < len(ys) else padded_h
+			if next_top > band_top:
+				flush(next_top - band_top)
+				band_top = next_top
+
+	return out
+
+def seam_positions(length, tile, margin):
+	"""
+	:return: offsets along one axis where neighbouring tiles meet: the middle of every overlap
+	"""
+	positions = tile_positions(length, tile, margin)
+	return [(b + a + tile) // 2 for a, b in zip(positions, positions[1:])]
@@ -1,11 +1,13 @@
 import tensorflow as tf
 from keras.applications.vgg19 import preprocess_input
+from code.weights import pretrained_weights, VGG19_WEIGHTS
 
 class VGG(tf.keras.Model): 
 	
 	def __init__(self, trainable=False): 
 		super(VGG, self).__init__(name="Vgg19")
-		vgg_feats = tf.keras.applications.vgg19.VGG19(weights='imagenet', include_top=False, input_shape=(128,96,3))
+		# No fixed input size so that the loss works at any (and during progressive training, changing) resolution
+		vgg_feats = tf.keras.applications.vgg19.VGG19(weights=pretrained_weights(VGG19_WEIGHTS), include_top=False, input_shape=(None,None,3))
 
 		vgg_feats.trainable = trainable
 		
@@ -60,10 +62,20 @@ class VGG_Loss(tf.keras.Model):
 		self.loss_function = tf.keras.losses.MeanAbsoluteError()
 		self.weighting = [1/32, 1/16, 1/8, 1/4, 1]
 
-	def call(self, real, fake): 
-		fake = ((fake + 1)/2) * 255
-		real = ((real + 1)/2) * 255
-		fake_vgg, real_vgg = self.vgg(preprocess_input(fake)), self.vgg(preprocess_input(real))
+	def features(self, images):
+		"""
+		:return: the five VGG19 section outputs for a batch of images
+		"""
+		images = ((images + 1)/2) * 255
+		return self.vgg(preprocess_input(images))
+
+	def call(self, real, fake, fake_features=None): 
+		"""
+		:param fake_features: features(fake) computed before, e.g. read from a VGGFeatureCache, to skip the VGG
+		pass on fake. Its gradient is stopped anyway.
+		"""
+		fake_vgg = fake_features if fake_features is not None else self.features(fake)
+		real_vgg = self.features(real)
 		loss = 0
 		for i in range(len(fake_vgg)): 
 			fake_detach = tf.stop_gradient(fake_vgg[i])
@@ -0,0 +1,26 @@
+import os
+
+"""
+Local cache of the pretrained ImageNet weights used by the VGG loss and the Inception metrics. Set
+GAUGAN_WEIGHTS_DIR to a directory holding the Keras weight files to run without network access; otherwise
+Keras downloads them once into ~/.keras/models.
+"""
+
+VGG19_WEIGHTS = 'vgg19_weights_tf_dim_ordering_tf_kernels_notop.h5'
+INCEPTION_V3_WEIGHTS = 'inception_v3_weights_tf_dim_ordering_tf_kernels_notop.h5'
+
+def weights_dir():
+	return os.environ.get('GAUGAN_WEIGHTS_DIR', os.path.join(os.path.expanduser('~'), '.keras', 'models'))
+
+def pretrained_weights(file_name):
+	"""
+	:param file_name: Keras weight file, e.g. VGG19_WEIGHTS
+
+	:return: path of the cached weight file, or 'imagenet' to have Keras download it
+	"""
+	path = os.path.join(weights_dir(), file_name)
+	if os.path.exists(path):
+		return path
+	if 'GAUGAN_WEIGHTS_DIR' in os.environ:
+		raise FileNotFoundError("%s not found in GAUGAN_WEIGHTS_DIR (%s)" % (file_name, weights_dir()))
+	return 'imagenet'
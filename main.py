@@ -1,34 +1,13 @@
 import sys
-print(sys.path)
-import tensorflow as tf
-import tensorflow_gan as tfgan
-import tensorflow_hub as hub
-
-# Tensorflow GAN stuff for FID
-from keras.applications.inception_v3 import InceptionV3
-from keras.applications.inception_v3 import preprocess_input
-
-import matplotlib.pyplot as plt
-
-import numpy as np
-import scipy
-
-from imageio import imwrite
-from skimage.io import imsave
-from skimage import img_as_ubyte
 import os
 import csv
+import json
+import time
 import argparse
 
-from code.discriminator import Discriminator
-from code.generator import SPADEGenerator
-from code.preprocess import load_image_batch
-
-# Killing optional CPU driver warnings
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+# Only what the argument parser needs, TensorFlow is imported once the arguments are parsed
+from code.constants import GENERATOR_PRESETS, PRUNE_SALIENCIES, QUANTIZE_MODES, OPTIMIZER_STATES, VGG_POOLING_STRIDE
 
-gpu_available = tf.test.is_gpu_available()
-print("GPU Available: ", gpu_available)
 EPOCH_COUNT = 0
 
 ## --------------------------------------------------------------------------------------
@@ -44,7 +23,13 @@ parser.add_argument('--out-dir', type=str, default='./output',
 					help='Data where sampled output images will be written')
 
 parser.add_argument('--mode', type=str, default='train',
-					help='Can be "train" or "test"')
+					help='Can be "train", "test", "quantize", "distill", "prune", "infer" or "evaluate"')
+
+parser.add_argument('--log-dir', type=str, default='logs',
+					help='Directory of the loss and FID logs and the generated samples of training')
+
+parser.add_argument('--checkpoint-dir', type=str, default='./checkpoints',
+					help='Directory the generator and discriminator checkpoints are saved to and restored from')
 
 parser.add_argument('--restore-checkpoint', action='store_true',
 					help='Use this flag if you want to resuming training from a previously-saved checkpoint')
@@ -58,15 +43,36 @@ parser.add_argument('--batch-size', type=int, default=8,
 parser.add_argument('--num-data-threads', type=int, default=8,
 					help='Number of threads to use when loading & pre-processing training images')
 
+parser.add_argument('--intra-op-threads', type=int, default=0,
+					help='Threads TensorFlow uses inside one op, e.g. a convolution. 0 lets TensorFlow decide')
+
+parser.add_argument('--inter-op-threads', type=int, default=0,
+					help='Threads TensorFlow runs independent ops on. 0 lets TensorFlow decide')
+
+parser.add_argument('--prefetch-batches', type=int, default=1,
+					help='Number of batches the input pipeline prepares ahead of training, -1 lets tf.data decide (see profile_data.py)')
+
 parser.add_argument('--num-epochs', type=int, default=200,
 					help='Number of passes through the training data to make before stopping')
 
+parser.add_argument('--max-steps', type=int, default=0,
+					help='Stop training after [this many] training steps in total, even within an epoch. 0 disables')
+
+parser.add_argument('--stats-file', type=str, default=None,
+					help='JSON file training writes its steps, images per second and final losses to, e.g. for autotune.py')
+
+parser.add_argument('--config', type=str, default=None,
+					help='JSON file of argument defaults, e.g. written by autotune.py. Flags on the command line take precedence')
+
 parser.add_argument('--gen-learn-rate', type=float, default=0.0001,
 					help='Learning rate for Generator Adam optimizer')
 
 parser.add_argument('--dsc-learn-rate', type=float, default=0.0004,
 					help='Learning rate for Discriminator Adam optimizer')
 
+parser.add_argument('--optimizer-state', type=str, default='float32', choices=OPTIMIZER_STATES,
+					help='Storage of the Adam moments of both models: float32, bfloat16 or bfloat16 with factored second moments')
+
 parser.add_argument('--beta1', type=float, default=0.5,
 					help='"beta1" parameter for Adam optimizer')
 
@@ -91,11 +97,181 @@ parser.add_argument('--log-every', type=int, default=7,
 parser.add_argument('--save-every', type=int, default=10,
 					help='Save the state of the network after every [this many] epochs iterations')
 
-parser.add_argument('--device', type=str, default='GPU:0' if gpu_available else 'CPU:0',
-					help='specific the device of computation eg. CPU:0, GPU:0, GPU:1, GPU:2, ... ')
+parser.add_argument('--checkpoint-every', type=int, default=0,
+					help='Also save a checkpoint every [this many] training iterations, for --mode evaluate. 0 disables')
+
+parser.add_argument('--fid-every', type=int, default=500,
+					help='Compute the FID of the current batch every [this many] training iterations. 0 disables, see --mode evaluate')
+
+parser.add_argument('--device', type=str, default=None,
+					help='specific the device of computation eg. CPU:0, GPU:0, GPU:1, GPU:2, ... Defaults to GPU:0 if there is a GPU')
+
+parser.add_argument('--progressive-start-scale', type=float, default=1.0,
+					help='Train the first epochs at this fraction (a power of 2, e.g. 0.25) of the image size, 1 disables')
+
+parser.add_argument('--progressive-epochs', type=int, default=5,
+					help='Number of epochs to train at each resolution before doubling it during progressive training')
+
+parser.add_argument('--generator-preset', type=str, default='full', choices=sorted(GENERATOR_PRESETS),
+					help='Generator size: channel width multiplier, SPADE hidden width and kernel size per block')
+
+parser.add_argument('--separable-convs', type=str, nargs='*', default=[], choices=['spade', 'block'],
+					help='Layer types that use depthwise separable convolutions: SPADE convs and/or SpadeBlock 3x3 convs')
+
+parser.add_argument('--fused-spade', action='store_true',
+					help='Compute SPADE gamma/beta with one convolution and normalize + modulate in a single pass')
+
+parser.add_argument('--share-segmap-trunk', action='store_true',
+					help='Compute the SPADE segmap embedding once per resolution and share it across SpadeLayers')
+
+parser.add_argument('--fused-upsample', action='store_true',
+					help='Upsample inside the next SpadeBlock instead of materializing the upsampled features')
+
+parser.add_argument('--segmap-pyramid', action='store_true',
+					help='Resize segmaps to every generator resolution in the input pipeline instead of in every layer')
+
+parser.add_argument('--quantize-mode', type=str, default='int8', choices=QUANTIZE_MODES,
+					help='TFLite quantization used by --mode quantize: "int8" (calibrated) or "dynamic" (weights only)')
+
+parser.add_argument('--num-calibration-samples', type=int, default=32,
+					help='Number of test segmaps used to calibrate and evaluate the quantized generator')
+
+parser.add_argument('--teacher-checkpoint-dir', type=str, default='./checkpoints',
+					help='Checkpoint of the trained generator that --mode distill distills into the --generator-preset student, saved to another --checkpoint-dir')
+
+parser.add_argument('--teacher-preset', type=str, default='full', choices=sorted(GENERATOR_PRESETS),
+					help='Generator preset of the distillation teacher')
+
+parser.add_argument('--teacher-generator-config', type=str, default=None,
+					help='JSON file with per block configs of the distillation teacher, e.g. a pruned one, overrides --teacher-preset')
+
+parser.add_argument('--teacher-separable-convs', type=str, nargs='*', default=[], choices=['spade', 'block'],
+					help='--separable-convs the distillation teacher was trained with')
 
+parser.add_argument('--teacher-share-segmap-trunk', action='store_true',
+					help='The distillation teacher was trained with --share-segmap-trunk')
+
+parser.add_argument('--teacher-fused-upsample', action='store_true',
+					help='Run the distillation teacher with --fused-upsample')
+
+parser.add_argument('--distill-cache-dir', type=str, default='./distill_cache',
+					help='Where the teacher outputs are cached for distillation, reused while the teacher, blocks and images stay the same')
+
+parser.add_argument('--distill-blocks', type=int, nargs='*', default=[2, 4],
+					help='SpadeBlocks whose outputs the student learns to match, in addition to the final image')
+
+parser.add_argument('--lambda-feature', type=float, default=1,
+					help='weight of the SpadeBlock feature matching loss in distillation')
+
+parser.add_argument('--generator-config', type=str, default=None,
+					help='JSON file with per block configs (written by --mode prune), overrides --generator-preset')
+
+parser.add_argument('--prune-ratio', type=float, default=0.5,
+					help='Fraction of the SpadeBlock middle channels and SPADE hidden channels that --mode prune removes')
+
+parser.add_argument('--prune-saliency', type=str, default='weight_norm', choices=PRUNE_SALIENCIES,
+					help='How channels are ranked for pruning: filter weight norms or batch norm scales')
+
+parser.add_argument('--prune-epochs', type=int, default=2,
+					help='Number of fine-tuning epochs after pruning')
+
+parser.add_argument('--prune-dir', type=str, default='./checkpoints_pruned',
+					help='Where the pruned generator checkpoint and its generator_config.json are written')
+
+parser.add_argument('--infer-dir', type=str, default=None,
+					help='Directory of segmaps that --mode infer generates images for, defaults to --test-img-dir')
+
+parser.add_argument('--infer-batch-size', type=int, default=64,
+					help='Number of segmaps per generator call in --mode infer')
+
+parser.add_argument('--num-writers', type=int, default=4,
+					help='Number of threads encoding and writing generated images in --mode infer')
+
+parser.add_argument('--infer-processes', type=int, default=1,
+					help='Split --mode infer into this many shards, each run by its own process on its own cores')
+
+parser.add_argument('--num-shards', type=int, default=1,
+					help='Total number of inference shards (set by --infer-processes)')
+
+parser.add_argument('--shard-index', type=int, default=0,
+					help='Inference shard run by this process (set by --infer-processes)')
+
+parser.add_argument('--tile-margin', type=int, default=None,
+					help='Use tiled inference in --mode infer, for segmaps of any size, with this context margin per tile')
+
+parser.add_argument('--vgg-feature-cache', type=str, default=None,
+					help='Directory to cache the VGG features of the real training images in, so that later epochs skip VGG on them')
+
+parser.add_argument('--vgg-feature-cache-gb', type=float, default=16,
+					help='Size cap of --vgg-feature-cache, images beyond it keep going through VGG')
+
+parser.add_argument('--eval-samples', type=int, default=500,
+					help='Number of test images (the first in sorted order) --mode evaluate computes the FID over')
+
+parser.add_argument('--eval-batch-size', type=int, default=32,
+					help='Number of segmaps per generator call in --mode evaluate')
+
+parser.add_argument('--eval-poll-seconds', type=float, default=60,
+					help='How often --mode evaluate checks --checkpoint-dir for new checkpoints. 0 evaluates the current ones and exits')
+
+parser.add_argument('--eval-log', type=str, default='./logs/fid_eval.csv',
+					help='CSV that --mode evaluate appends the FID of every checkpoint to, keyed by training step')
+
+parser.add_argument('--track-memory', action='store_true',
+					help='Record the peak and current memory of every stage of the training step, see code/memory.py')
+
+parser.add_argument('--memory-log', type=str, default='./logs/memory.csv',
+					help='CSV --track-memory appends one row per stage and --log-every window to')
+
+# Settings from --config replace the defaults, flags given on the command line still override them
+args, _ = parser.parse_known_args()
+if args.config:
+	with open(args.config, 'r') as f:
+		config = json.load(f)
+	unknown = sorted(set(config) - set(vars(args)))
+	if unknown:
+		parser.error("Unknown settings in %s: %s" % (args.config, ', '.join(unknown)))
+	parser.set_defaults(**config)
 args = parser.parse_args()
 
+# The generator can skip at most its five upsampling stages, and the VGG loss needs both sides to be at least its
+# pooling stride, e.g. at most a quarter of 96x128
+start_scales = [2.0 ** -i for i in range(6) if min(args.img_h, args.img_w) * 2.0 ** -i >= VGG_POOLING_STRIDE]
+if args.progressive_start_scale not in start_scales:
+	parser.error("--progressive-start-scale has to be 1 or a power of 2 below it, down to 1/%d at %dx%d, not %g" % \
+		(1 / start_scales[-1], args.img_h, args.img_w, args.progressive_start_scale))
+# The student's checkpoint manager would delete the teacher's checkpoints, and a rerun would restore the student
+# as the teacher
+if args.mode == 'distill' and os.path.realpath(args.checkpoint_dir) == os.path.realpath(args.teacher_checkpoint_dir):
+	parser.error("--mode distill saves the student to --checkpoint-dir, which has to differ from --teacher-checkpoint-dir")
+
+## --------------------------------------------------------------------------------------
+
+# Killing optional CPU driver warnings, has to happen before TensorFlow is loaded
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import tensorflow as tf
+from imageio import imwrite
+
+from code.discriminator import Discriminator
+from code.generator import SPADEGenerator, save_block_configs, load_block_configs
+from code.preprocess import load_image_batch, num_segmap_objects
+from code.progressive import progressive_scale, rescale_batch
+from code.memory import MemoryTracker, track
+from code.optimizers import fresh_optimizer, state_bytes
+
+# Has to happen before TensorFlow runs its first op
+if args.intra_op_threads > 0:
+	tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+if args.inter_op_threads > 0:
+	tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
+# Listing the devices is fast, unlike tf.test.is_gpu_available, which initializes every GPU
+if args.device is None:
+	args.device = 'GPU:0' if tf.config.list_physical_devices('GPU') else 'CPU:0'
+print("Device: ", args.device)
+
 ## --------------------------------------------------------------------------------------
 
 # Numerically stable logarithm function
@@ -108,11 +284,21 @@ def log(x):
 
 ## --------------------------------------------------------------------------------------
 
-# For evaluating the quality of generated images
-# FID Functions adapted from https://machinelearningmastery.com/how-to-implement-the-frechet-inception-distance-fid-from-scratch/
+# For evaluating the quality of generated images, see metrics.py
 # Lower is better
 #module = tf.keras.Sequential([hub.KerasLayer("https://tfhub.dev/google/tf2-preview/inception_v3/classification/4", output_shape=[1001])])
-model = InceptionV3(include_top=False, pooling='avg', input_shape=(96,128,3))
+INCEPTION_MODEL = None
+def inception():
+	"""
+	Builds InceptionV3 on first use, so that modes without metrics never load it
+	"""
+	from code.metrics import inception_model
+
+	global INCEPTION_MODEL
+	if INCEPTION_MODEL is None:
+		INCEPTION_MODEL = inception_model(args.img_h, args.img_w)
+	return INCEPTION_MODEL
+
 def fid_function(real_image_batch, generated_image_batch):
 	"""
 	Given a batch of real images and a batch of generated images, this function pulls down a pre-trained inception
@@ -122,72 +308,75 @@ def fid_function(real_image_batch, generated_image_batch):
 	:param generated_image_batch: a batch of images generated by the generator network, shape=[batch_size, height, width, channels]
 	:return: the inception distance between the real and generated images, scalar
 	"""
-	def calculate_fid(model, img, img2):
-		act1 = model.predict(img, steps=1)
-		act2 = model.predict(img2, steps=1)
-
-		# calculate mean and covariance statistics
-		mu1, sigma1 = act1.mean(axis=0), np.cov(act1, rowvar=False)
-		mu2, sigma2 = act2.mean(axis=0), np.cov(act2, rowvar=False)
-
-		# calculate sum squared difference between means
-		ssdiff = np.sum((mu1 - mu2)**2.0)
-
-		# calculate sqrt of product between cov
-		covmean = scipy.linalg.sqrtm(sigma1.dot(sigma2))
+	from code.metrics import fid
 
-		# check and correct imaginary numbers from sqrt
-		if np.iscomplexobj(covmean):
-			covmean = covmean.real
-
-		# calculate score
-		fid = ssdiff + np.trace(sigma1 + sigma2 - (2.0 * covmean))
-		return fid
-
-	real = preprocess_input(real_image_batch)
-	gen = preprocess_input(generated_image_batch)
-
-	tot_fid = calculate_fid(model, real, gen)
-
-	return tot_fid
+	return fid(inception(), real_image_batch, generated_image_batch)
 
 # Train the model for one epoch.
-def train(generator, discriminator, dataset_iterator, manager):
+def train(generator, discriminator, dataset_iterator, manager, scale=1.0, step=None, feature_cache=None, \
+	memory_tracker=None, step_times=None):
 	"""
-	Train the model for one epoch. Save a checkpoint every 500 or so batches.
+	Train the model for one epoch. Save a checkpoint every --checkpoint-every batches.
 	:param generator: generator model
 	:param discriminator: discriminator model
 	:param dataset_iterator: iterator over dataset, see preprocess.py for more information
 	:param manager: the manager that handles saving checkpoints by calling save()
-	:return: The average FID score over the epoch
+	:param scale: fraction of the full resolution to train at, see progressive.py
+	:param step: optional training step variable, incremented every batch and saved with the checkpoints
+	:param feature_cache: the VGGFeatureCache the dataset was loaded with, if any
+	:param memory_tracker: optional MemoryTracker that records the memory of every stage of the step
+	:param step_times: optional list the end time of every training step is appended to
+	:return: The average FID score over the epoch (nan if --fid-every is 0) and the average losses
 	"""
 	# Loop over our data until we run out
 	total_fid = 0
 	total_gen_loss = 0
 	total_disc_loss =0
 	iterations = 0
+	fid_iterations = 0
 
 	# print("dataset_iterator is ", dataset_iterator)
 	# print(dataset_iterator[0])
 
+	# Every mode that trains, --mode prune's fine-tuning included, writes samples of the first batch here
+	samples_dir = os.path.join(args.log_dir, "generated_samples")
+	if not os.path.exists(samples_dir):
+		os.makedirs(samples_dir)
+
 	for iteration, batch in enumerate(dataset_iterator):
 		# Break batch up into images and segmaps
-		images, seg_maps = batch
+		images, seg_pyramid = rescale_batch(batch[0], batch[1], scale)
+
+		# VGG features of the real images: cached ones if the whole batch is cached, otherwise computed here
+		# and cached for the next epochs. The cache only holds full resolution features
+		real_features = None
+		if feature_cache is not None and scale == 1:
+			seg_paths, real_features, hits = batch[2:]
+			if not bool(tf.reduce_all(hits)):
+				with track(memory_tracker, 'vgg real features'):
+					real_features = generator.vgg_loss().features(images)
+				feature_cache.write(seg_paths.numpy(), real_features)
+
+		# The discriminator only needs the full resolution segmap
+		seg_maps = seg_pyramid[-1] if isinstance(seg_pyramid, tuple) else seg_pyramid
 
 		with tf.GradientTape() as generator_tape, tf.GradientTape() as discriminator_tape:
 			noise = tf.random.uniform((args.batch_size, 256), minval=-1, maxval=1)
 
 			# calculate generator output
-			gen_output = generator.call(noise, seg_maps)
+			with track(memory_tracker, 'generator forward'):
+				gen_output = generator.call(noise, seg_pyramid)
 			#print("GENERATED ARRAY MIN: ", np.min(gen_output))
 			#print("GENERATED ARRAY MAX: ", np.max(gen_output))
 
 			# Get discriminator output for fake images and real images
-			disc_real = discriminator.call(images, seg_maps)
-			disc_fake = discriminator.call(gen_output, seg_maps)
+			with track(memory_tracker, 'discriminator forward'):
+				disc_real = discriminator.call(images, seg_maps)
+				disc_fake = discriminator.call(gen_output, seg_maps)
 
-			# calculate gen. loss and disc. loss
-			g_loss = generator.loss(disc_fake, gen_output, images)
+			# calculate gen. loss and disc. loss, the VGG loss is almost all of the generator loss
+			with track(memory_tracker, 'vgg loss'):
+				g_loss = generator.loss(disc_fake, gen_output, images, real_features=real_features)
 			d_loss = discriminator.loss(disc_real, disc_fake)
 
 			# Update loss counters
@@ -196,12 +385,12 @@ def train(generator, discriminator, dataset_iterator, manager):
 
 			global EPOCH_COUNT
 			if iteration == 0:
-				s = "logs/generated_samples"+'/'+str(EPOCH_COUNT)+'.png'
+				s = samples_dir+'/'+str(EPOCH_COUNT)+'.png'
 				img_i = gen_output[0] * 255
 				imwrite(s, img_i)
 
 				# real image for funs
-				path = "logs/generated_samples"+'/'+str(EPOCH_COUNT)+'_real.png'
+				path = samples_dir+'/'+str(EPOCH_COUNT)+'_real.png'
 				reals = images[0] * 255
 				imwrite(path, reals)
 
@@ -215,22 +404,44 @@ def train(generator, discriminator, dataset_iterator, manager):
 
 
 		# get gradients
-		g_grad = generator_tape.gradient(g_loss, generator.trainable_variables)
-		d_grad = discriminator_tape.gradient(d_loss, discriminator.trainable_variables)
-
-		generator.optimizer.apply_gradients(zip(g_grad, generator.trainable_variables))
-		discriminator.optimizer.apply_gradients(zip(d_grad, discriminator.trainable_variables))
-
+		with track(memory_tracker, 'generator backward'):
+			g_grad = generator_tape.gradient(g_loss, generator.trainable_variables)
+		with track(memory_tracker, 'discriminator backward'):
+			d_grad = discriminator_tape.gradient(d_loss, discriminator.trainable_variables)
+
+		with track(memory_tracker, 'optimizer'):
+			generator.optimizer.apply_gradients(zip(g_grad, generator.trainable_variables))
+			discriminator.optimizer.apply_gradients(zip(d_grad, discriminator.trainable_variables))
+		iterations += 1
+		if memory_tracker is not None:
+			memory_tracker.end_step()
+		if step_times is not None:
+			# Ops run asynchronously on GPUs, a step is done when its updates are
+			tf.test.experimental.sync_devices()
+			step_times.append(time.perf_counter())
+
+		if step is not None:
+			step.assign_add(1)
+			if args.checkpoint_every > 0 and int(step) % args.checkpoint_every == 0:
+				manager.save(checkpoint_number=step)
+			if args.max_steps > 0 and int(step) >= args.max_steps:
+				break
 
 		# Calculate inception distance and track the fid in order
 		# to return the average
-		if iteration % 500 == 0:
-			fid_ = fid_function(images, gen_output)
+		if args.fid_every > 0 and iteration % args.fid_every == 0:
+			# Inception is built for the full resolution
+			fid_ = fid_function(tf.image.resize(images, (args.img_h, args.img_w)), \
+				tf.image.resize(gen_output, (args.img_h, args.img_w)))
 			total_fid += fid_
-			iterations += 1
+			fid_iterations += 1
+
+	if feature_cache is not None:
+		feature_cache.flush()
 
 	EPOCH_COUNT += 1
-	return total_fid / iterations, total_gen_loss / iterations, total_disc_loss / iterations
+	avg_fid = total_fid / fid_iterations if fid_iterations > 0 else float('nan')
+	return avg_fid, total_gen_loss / iterations, total_disc_loss / iterations
 
 
 # Test the model by generating some samples.
@@ -238,9 +449,15 @@ def test(generator, dataset_iterator):
 	"""
 	Test the model.
 	:param generator: generator model
-	:return: None
+	:return: the FID of every batch, the average of those, and the FID, KID and precision/recall over all
+	test images (see metrics.evaluate_activations)
 	"""
+	from skimage.io import imsave
+	from code.metrics import activations, frechet_distance, evaluate_activations
+
 	total_fid = []
+	real_activations = []
+	generated_activations = []
 	image_num = 0
 
 	for iteration, batch in enumerate(dataset_iterator):
@@ -267,74 +484,373 @@ def test(generator, dataset_iterator):
 		imsave(gener_path2, img_2)
 		imsave(truth_path2, image[1])
 
-		# Calculate the FID for this batch
-		fid = fid_function(image, gen)
+		# Calculate the FID for this batch, keeping the activations for the metrics over the whole test set
+		real_activations.append(activations(inception(), image))
+		generated_activations.append(activations(inception(), gen))
+		fid = frechet_distance(real_activations[-1], generated_activations[-1])
 		total_fid.append(fid)
 	
 	# Get the Average FID across all images
 	avg_fid = sum(total_fid) / len(total_fid)
+	metrics = evaluate_activations(np.concatenate(real_activations, axis=0), np.concatenate(generated_activations, axis=0))
+
+	return total_fid, avg_fid, metrics
+
+# Quantize the generator for CPU serving and compare it against the float model.
+def quantize(generator, dataset_iterator):
+	"""
+	Converts the generator to a float and a quantized TFLite model, calibrating on real test segmaps, and
+	reports the latency speedup and the FID difference of the quantized model.
+	:param generator: generator model
+	:param dataset_iterator: iterator over single (image, segmap) test pairs
+	:return: path of the saved quantized model
+	"""
+	from code.quantize import convert_generator, TFLiteGenerator, time_per_image
+
+	images = []
+	seg_maps = []
+	for image, seg_map in dataset_iterator.take(args.num_calibration_samples):
+		images.append(image)
+		seg_maps.append(seg_map)
+
+	float_model = convert_generator(generator, args.img_h, args.img_w, args.segmap_filters, mode='float')
+	quant_model = convert_generator(generator, args.img_h, args.img_w, args.segmap_filters, \
+		mode=args.quantize_mode, calibration_segmaps=seg_maps)
+
+	model_path = args.out_dir + '/generator_' + args.quantize_mode + '.tflite'
+	with open(model_path, 'wb') as f:
+		f.write(quant_model)
+
+	float_generator = TFLiteGenerator(float_model)
+	quant_generator = TFLiteGenerator(quant_model)
+
+	float_latency = time_per_image(float_generator, seg_maps)
+	quant_latency = time_per_image(quant_generator, seg_maps)
+
+	real = np.concatenate(images, axis=0)
+	float_fid = fid_function(real, np.concatenate([float_generator(s) for s in seg_maps], axis=0))
+	quant_fid = fid_function(real, np.concatenate([quant_generator(s) for s in seg_maps], axis=0))
+
+	print("Float model: %.1f KB, %.2f ms/image, FID %.3f" % (len(float_model) / 1024, float_latency * 1000, float_fid))
+	print("%s model: %.1f KB, %.2f ms/image, FID %.3f" % (args.quantize_mode, len(quant_model) / 1024, \
+		quant_latency * 1000, quant_fid))
+	print("Speedup: %.2fx, FID delta: %+.3f" % (float_latency / quant_latency, quant_fid - float_fid))
+
+	return model_path
 
-	return total_fid, avg_fid
+def restore_matching(checkpoint, checkpoint_path, architecture_flags):
+	"""
+	Restores a checkpoint that may hold more than the models built here (the VGG loss network is only built for
+	training, the discriminator and optimizers are not always needed), but has to hold every weight they have.
+	Otherwise layers of an architecture that differs from the trained one would keep their random weights.
+	:param checkpoint: tf.train.Checkpoint of the models to restore
+	:param checkpoint_path: checkpoint file prefix, e.g. from tf.train.latest_checkpoint
+	:param architecture_flags: the arguments the models were built from, for the error message
+	:return: the load status
+	"""
+	try:
+		return checkpoint.restore(checkpoint_path).expect_partial().assert_existing_objects_matched()
+	except AssertionError:
+		# The assertion message lists the values of every unmatched weight
+		raise ValueError("The checkpoint %s lacks weights of the architecture given by %s" % (checkpoint_path, \
+			architecture_flags)) from None
+
+# Distill a trained generator into a smaller one.
+def distill(student, train_dataset_iterator, test_dataset_iterator, manager):
+	"""
+	Trains the student generator to reproduce the teacher restored from --teacher-checkpoint-dir, on teacher
+	outputs cached once in --distill-cache-dir, then compares the FID and latency of both on the test set.
+	:param student: generator model to train
+	:param train_dataset_iterator: iterator over the training (image, segmap) batches
+	:param test_dataset_iterator: iterator over the test (image, segmap) batches
+	:param manager: the manager that saves the student's checkpoints
+	:return: (teacher FID, student FID)
+	"""
+	from code.distill import cache_teacher_outputs, teacher_cache_matches, load_teacher_cache, Distiller
+	from code.quantize import time_per_image
+
+	teacher_configs = load_block_configs(args.teacher_generator_config) if args.teacher_generator_config else None
+	teacher = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.img_w, img_h=args.img_h, \
+		fused_spade=args.fused_spade, share_segmap_trunk=args.teacher_share_segmap_trunk, \
+		fused_upsample=args.teacher_fused_upsample, preset=args.teacher_preset, separable=args.teacher_separable_convs, \
+		block_configs=teacher_configs)
+	teacher_checkpoint = tf.train.latest_checkpoint(args.teacher_checkpoint_dir)
+	if teacher_checkpoint is None:
+		raise ValueError('No teacher checkpoint in "%s"' % args.teacher_checkpoint_dir)
+	# Built before the restore, so that its batch norm statistics have to come from the checkpoint, too
+	teacher.call(None, tf.zeros([1, args.img_h, args.img_w, args.segmap_filters]))
+	restore_matching(tf.train.Checkpoint(generator=teacher), teacher_checkpoint, '--teacher-preset, ' \
+		'--teacher-generator-config, --teacher-separable-convs and --teacher-share-segmap-trunk')
+
+	# A cache of another teacher, other blocks or other images is rebuilt
+	cache_metadata = {'teacher_checkpoint': os.path.realpath(teacher_checkpoint), 'feature_blocks': args.distill_blocks, \
+		'img_size': [args.img_h, args.img_w], 'train_img_dir': os.path.realpath(args.train_img_dir)}
+	if not teacher_cache_matches(args.distill_cache_dir, cache_metadata):
+		print("Caching teacher outputs")
+		num_batches = cache_teacher_outputs(teacher, train_dataset_iterator, args.distill_cache_dir, args.distill_blocks, \
+			cache_metadata)
+		print("Cached %d batches to %s" % (num_batches, args.distill_cache_dir))
+
+	distiller = Distiller(student, teacher, args.distill_blocks, lambda_feature=args.lambda_feature, \
+		lambda_vgg=args.lambda_vgg)
+	distill_dataset = load_teacher_cache(args.distill_cache_dir, args.segmap_filters, args.distill_blocks)
+	variables = distiller.distillation_variables()
+
+	for epoch in range(0, args.num_epochs):
+		total_loss = 0
+		iterations = 0
+		for iteration, (seg_maps, teacher_images, teacher_features) in enumerate(distill_dataset):
+			with tf.GradientTape() as tape:
+				student_images, student_features = student.call(None, seg_maps, return_features=True)
+				loss, image_loss, feature_loss, vgg_loss = distiller.loss(student_images, student_features, \
+					teacher_images, teacher_features)
+
+			grads = tape.gradient(loss, variables)
+			student.optimizer.apply_gradients(zip(grads, variables))
+
+			total_loss += loss
+			iterations += 1
+			if iteration % args.log_every == 0:
+				print("Epoch %d iteration %d: loss %.4f (image %.4f, feature %.4f, vgg %.4f)" % (epoch, iteration, \
+					loss, image_loss, feature_loss, vgg_loss))
+
+		print("Average Distillation Loss for Epoch %d: %.4f" % (epoch, total_loss / iterations))
+		if epoch % args.save_every == 0:
+			print("**** SAVING CHECKPOINT AT END OF EPOCH ****")
+			manager.save()
+	manager.save()
+
+	# FID against the real test images and latency of the teacher and the student
+	scores = []
+	for name, generator in [('Teacher (%s)' % args.teacher_preset, teacher), ('Student (%s)' % args.generator_preset, student)]:
+		real, generated = [], []
+		for images, seg_maps in test_dataset_iterator:
+			real.append(images)
+			generated.append(generator.call(None, seg_maps))
+		score = fid_function(np.concatenate(real, axis=0), np.concatenate(generated, axis=0))
+
+		seg_maps = next(iter(test_dataset_iterator))[1]
+		seg_maps = seg_maps[-1] if isinstance(seg_maps, tuple) else seg_maps
+		seg_maps = [seg_map[np.newaxis] for seg_map in seg_maps]
+		latency = time_per_image(lambda s: generator.call(None, s), seg_maps)
+		print("%s: %.2f ms/image, FID %.3f" % (name, latency * 1000, score))
+		scores.append(score)
+
+	print("FID delta: %+.3f" % (scores[1] - scores[0]))
+	return tuple(scores)
+
+# Prune channels of the generator and fine-tune the smaller model.
+def prune(generator, discriminator, train_dataset_iterator, test_dataset_iterator):
+	"""
+	Removes the least salient middle and hidden channels of the generator, fine-tunes the pruned generator
+	against the restored discriminator with train() and saves it with its block configs to --prune-dir.
+	:param generator: trained generator model
+	:param discriminator: trained discriminator model
+	:param train_dataset_iterator: iterator over the training (image, segmap) batches
+	:param test_dataset_iterator: iterator over the test (image, segmap) batches, used for timing
+	:return: the pruned generator
+	"""
+	from code.prune import prune_generator
+	from code.quantize import time_per_image
+
+	pruned = prune_generator(generator, args.prune_ratio, args.prune_saliency, beta1=args.beta1, beta2=args.beta2, \
+		learning_rate=args.gen_learn_rate, batch_size=args.batch_size, lambda_vgg=args.lambda_vgg, \
+		fused_spade=args.fused_spade, fused_upsample=args.fused_upsample, optimizer_state=args.optimizer_state)
+
+	seg_maps = next(iter(test_dataset_iterator))[1]
+	seg_maps = seg_maps[-1] if isinstance(seg_maps, tuple) else seg_maps
+	seg_maps = [seg_map[np.newaxis] for seg_map in seg_maps]
+	for name, model in [('Original', generator), ('Pruned', pruned)]:
+		params = sum(int(np.prod(v.shape)) for v in model.synthesis_variables())
+		latency = time_per_image(lambda s: model.call(None, s), seg_maps)
+		print("%s generator: %.2fM parameters, %.2f ms/image" % (name, params / 1e6, latency * 1000))
+
+	if not os.path.exists(args.prune_dir):
+		os.makedirs(args.prune_dir)
+	config_path = os.path.join(args.prune_dir, 'generator_config.json')
+	save_block_configs(pruned.block_configs, config_path)
+
+	checkpoint = tf.train.Checkpoint(generator=pruned, discriminator=discriminator)
+	manager = tf.train.CheckpointManager(checkpoint, args.prune_dir, max_to_keep=3)
+	for epoch in range(0, args.prune_epochs):
+		print('========================== FINE-TUNING EPOCH %d  ==========================' % epoch)
+		avg_fid, avg_g_loss, avg_d_loss = train(pruned, discriminator, train_dataset_iterator, manager)
+		print("Average FID for Epoch: ", float(avg_fid))
+		print("Average Generator Loss: ", float(avg_g_loss))
+		print("Average Discriminator Loss: ", float(avg_d_loss))
+	manager.save()
+
+	print("Pruned generator saved to %s, use --checkpoint-dir %s --generator-config %s" % (args.prune_dir, \
+		args.prune_dir, config_path))
+	return pruned
 
 ## --------------------------------------------------------------------------------------
 
-def main():
-	# Load train images (to feed to the discriminator)
+def saved_optimizer_state(checkpoint_path):
+	"""
+	:return: the --optimizer-state a checkpoint was saved with, float32 for checkpoints from before the option
+	"""
+	if checkpoint_path is None:
+		return args.optimizer_state
+	try:
+		return tf.train.load_variable(checkpoint_path, 'optimizer_state/.ATTRIBUTES/VARIABLE_VALUE').decode()
+	except (tf.errors.NotFoundError, ValueError):
+		return 'float32'
 
-	train_dataset_iterator = load_image_batch(dir_name=args.train_img_dir, batch_size=args.batch_size, \
-		n_threads=args.num_data_threads)
+def report_optimizer_state(generator, discriminator):
+	"""
+	Prints the memory of the Adam moments of both models, and what float32 moments would take
+	"""
+	for name, model in (('Generator', generator), ('Discriminator', discriminator)):
+		used = state_bytes(model.optimizer)
+		full = 2 * sum(v.shape.num_elements() * 4 for v in model.trainable_variables)
+		print("%s optimizer state (%s): %.1f MB, %.1f MB less than float32 Adam" % (name, args.optimizer_state, \
+			used / 2**20, (full - used) / 2**20))
 
-	# Get number of train images and make an iterator over it
-	test_dataset_iterator = load_image_batch(dir_name=args.test_img_dir, batch_size=2, \
-		n_threads=args.num_data_threads, drop_remainder=False)
-	
-	print("Dataset loaded into the model")
+def write_stats(path, step_times, avg_fid, avg_g_loss, avg_d_loss, warmup_steps=2):
+	"""
+	Writes the throughput and the losses of the last epoch of a training run to a JSON file
+
+	:param step_times: start time of training followed by the end time of every step
+	:param warmup_steps: first steps left out of the throughput, they build the models and grow the allocator
+	"""
+	steps = len(step_times) - 1
+	timed = step_times[min(warmup_steps, steps - 1):] if steps > 0 else []
+	images_per_second = args.batch_size * (len(timed) - 1) / (timed[-1] - timed[0]) if len(timed) > 1 else float('nan')
+	stats = {'steps': steps, 'seconds': step_times[-1] - step_times[0], 'images_per_second': images_per_second, \
+		'avg_fid': float(avg_fid), 'avg_g_loss': float(avg_g_loss), 'avg_d_loss': float(avg_d_loss)}
+	directory = os.path.dirname(path)
+	if directory and not os.path.exists(directory):
+		os.makedirs(directory)
+	with open(path, 'w') as f:
+		json.dump(stats, f, indent=1)
+	print("%d steps, %.2f images/s" % (steps, images_per_second))
+
+def main():
+	# Modules only some modes need are imported by those modes
+	if args.mode == 'infer':
+		from code.inference import list_segmaps, run_inference, launch_shards
+	if args.mode == 'evaluate':
+		from code.evaluator import CheckpointEvaluator, EvaluationLog, follow_checkpoints
+
+	# Sharded inference runs this script again once per shard
+	if args.mode == 'infer' and args.infer_processes > 1:
+		launch_shards(sys.argv, args.infer_processes)
+		return
 
 	# Initialize generator and discriminator models
+	block_configs = load_block_configs(args.generator_config) if args.generator_config else None
 	generator = SPADEGenerator(args.segmap_filters, args.beta1, args.beta2, args.gen_learn_rate, \
-		args.batch_size, args.z_dim, args.img_w, args.img_h, args.lambda_vgg)
-	discriminator = Discriminator(args.segmap_filters, args.beta1, args.beta2, args.dsc_learn_rate)
+		args.batch_size, args.z_dim, args.img_w, args.img_h, args.lambda_vgg, fused_spade=args.fused_spade, \
+		share_segmap_trunk=args.share_segmap_trunk, fused_upsample=args.fused_upsample, preset=args.generator_preset, \
+		separable=args.separable_convs, block_configs=block_configs, optimizer_state=args.optimizer_state)
+	discriminator = Discriminator(args.segmap_filters, args.beta1, args.beta2, args.dsc_learn_rate, \
+		optimizer_state=args.optimizer_state)
 
 	print("Generator and Discriminator have been created")
 
 	# For saving/loading models
-	checkpoint_dir = './checkpoints'
+	checkpoint_dir = args.checkpoint_dir
 	checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt")
-	checkpoint = tf.train.Checkpoint(generator=generator, discriminator=discriminator)
+	# Training step, saved with the checkpoints so that --mode evaluate can log by step
+	step = tf.Variable(0, dtype=tf.int64, trainable=False)
+	# Adam moment storage the optimizer state in the checkpoint was saved with, see optimizers.py
+	optimizer_state = tf.Variable(args.optimizer_state, trainable=False)
+	checkpoint = tf.train.Checkpoint(generator=generator, discriminator=discriminator, step=step, \
+		optimizer_state=optimizer_state)
 	manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=3)
 	# Ensure the output directory exists
 	if not os.path.exists(args.out_dir):
 		os.makedirs(args.out_dir)
 
-	if args.restore_checkpoint or args.mode == 'test':
-		# restores the latest checkpoint using from the manager
-		checkpoint.restore(manager.latest_checkpoint)
+	if args.restore_checkpoint or args.mode in ('test', 'quantize', 'prune', 'infer'):
+		# restores the latest checkpoint using from the manager. Every weight the models have must be in it, the
+		# VGG loss network is not built yet, and checkpoints from before the step and the optimizer state lack them
+		if manager.latest_checkpoint is not None:
+			# Builds the lazily created batch norm weights of the generator, so that they have to match as well
+			generator.call(None, tf.zeros([1, args.img_h, args.img_w, args.segmap_filters]))
+			restore_matching(tf.train.Checkpoint(generator=generator, discriminator=discriminator), \
+				manager.latest_checkpoint, '--generator-preset, --generator-config, --separable-convs and ' \
+				'--share-segmap-trunk')
+			tf.train.Checkpoint(step=step, optimizer_state=optimizer_state).restore(manager.latest_checkpoint) \
+				.expect_partial()
+		saved_state = saved_optimizer_state(manager.latest_checkpoint)
+		if saved_state != args.optimizer_state:
+			# The moments have other shapes and types, keep the weights and start the moments from zero
+			print("The checkpoint has %s optimizer state, starting %s Adam moments from zero" % (saved_state, \
+				args.optimizer_state))
+			for model in (generator, discriminator):
+				model.optimizer = fresh_optimizer(model.optimizer)
+			optimizer_state.assign(args.optimizer_state)
+
+	# Segmaps at every generator resolution, resized on the data loading threads
+	pyramid_sizes = generator.segmap_pyramid_sizes() if args.segmap_pyramid else None
+
+	# Load train images (to feed to the discriminator)
+
+	feature_cache = None
+	if args.vgg_feature_cache and args.mode == 'train':
+		from code.feature_cache import VGGFeatureCache
+		from code.weights import pretrained_weights, VGG19_WEIGHTS
+		shapes = [feature.shape[1:] for feature in generator.vgg_loss().features(tf.zeros([1, args.img_h, args.img_w, 3]))]
+		feature_cache = VGGFeatureCache(args.vgg_feature_cache, shapes, args.vgg_feature_cache_gb * 2**30, \
+			preprocessing='%dx%d %s' % (args.img_h, args.img_w, pretrained_weights(VGG19_WEIGHTS)))
+		print("Caching the VGG features of up to %d training images" % feature_cache.capacity)
+
+	# Only the modes that read a dataset need its images, e.g. infer runs on a directory of segmaps alone
+	train_dataset_iterator = None
+	if args.mode in ('train', 'distill', 'prune'):
+		train_dataset_iterator = load_image_batch(dir_name=args.train_img_dir, batch_size=args.batch_size, \
+			n_threads=args.num_data_threads, pyramid_sizes=pyramid_sizes, feature_cache=feature_cache, \
+			prefetch_size=args.prefetch_batches)
+
+	# Get number of train images and make an iterator over it
+	test_dataset_iterator = None
+	if args.mode in ('test', 'distill', 'prune'):
+		test_dataset_iterator = load_image_batch(dir_name=args.test_img_dir, batch_size=2, \
+			n_threads=args.num_data_threads, drop_remainder=False, pyramid_sizes=pyramid_sizes)
+
+	if train_dataset_iterator is not None or test_dataset_iterator is not None:
+		print("Dataset loaded into the model")
+
+	memory_tracker = None
+	if args.track_memory and args.mode == 'train':
+		memory_tracker = MemoryTracker(args.device, args.memory_log, window=args.log_every)
 
 	try:
 		# Specify an invalid GPU device
 		with tf.device('/device:' + args.device):
 			if args.mode == 'train':
+				# Timing every step waits for the device between steps, only done for --stats-file
+				step_times = [time.perf_counter()] if args.stats_file else None
 				for epoch in range(0, args.num_epochs):
 					print('\n')
 					print('========================== EPOCH %d  ==========================' % epoch)
-					avg_fid, avg_g_loss, avg_d_loss = train(generator, discriminator, train_dataset_iterator, manager)
+					scale = progressive_scale(epoch, args.progressive_start_scale, args.progressive_epochs)
+					if scale < 1:
+						print("Training at %dx%d" % (args.img_h * scale, args.img_w * scale))
+					avg_fid, avg_g_loss, avg_d_loss = train(generator, discriminator, train_dataset_iterator, manager, \
+						scale=scale, step=step, feature_cache=feature_cache, memory_tracker=memory_tracker, \
+						step_times=step_times)
 					print("Average FID for Epoch: ", float(avg_fid))
 					print("Average Generator Loss: ", float(avg_g_loss))
 					print("Average Discriminator Loss: ", float(avg_d_loss))
+					if epoch == 0:
+						report_optimizer_state(generator, discriminator)
 
 					# Save at the end of the epoch, too
 					if epoch % args.save_every == 0:
 						print("**** SAVING CHECKPOINT AT END OF EPOCH ****")
-						manager.save()
+						manager.save(checkpoint_number=step)
 
 					# Save the losses and fid into a CSV that we make.
-					logs_path = "logs"
+					logs_path = args.log_dir
 					fn = "fid_losses_train.csv"
 					full_path = logs_path + '/' + fn
 
 					# Make logs directory if it does not exist
 					if (not os.path.exists(logs_path)):
-						os.mkdir(logs_path)
+						os.makedirs(logs_path)
 
 					# If first Epoch create new file
 					if epoch == 0:
@@ -352,27 +868,71 @@ def main():
 							# Write epoch information
 							csvwritter.writerow([epoch, float(avg_fid), float(avg_g_loss), float(avg_d_loss)])
 
+					if args.max_steps > 0 and int(step) >= args.max_steps:
+						print("Stopping after %d training steps" % int(step))
+						break
+
+				if args.stats_file:
+					write_stats(args.stats_file, step_times, avg_fid, avg_g_loss, avg_d_loss)
+
 			if args.mode == 'test':
 				print("Start Testing")
-				tot_fid, avg_fid = test(generator, test_dataset_iterator)
+				tot_fid, avg_fid, metrics = test(generator, test_dataset_iterator)
 				print("Testing Average FID: ", avg_fid)
+				print("Over all test images: FID %.3f, KID %.4f +- %.4f, precision %.3f, recall %.3f" % (metrics['fid'], \
+					metrics['kid'], metrics['kid_std'], metrics['precision'], metrics['recall']))
 
 				# Save the losses and fid into a CSV that we make.
-				logs_path = "logs"
+				logs_path = args.log_dir
 				fn = "fid_losses_test.txt"
 				full_path = logs_path + '/' + fn
 
 				# Make logs directory if it does not exist
 				if (not os.path.exists(logs_path)):
-					os.mkdir(logs_path)
+					os.makedirs(logs_path)
 				
 				with open(full_path, 'w') as writer:
 					for fid in tot_fid:
 						string = "Image FID: " + str(float(fid)) + "\n" 
 						writer.write(string)
 
+			if args.mode == 'quantize':
+				print("Start Quantizing")
+				calibration_dataset_iterator = load_image_batch(dir_name=args.test_img_dir, batch_size=1, \
+					n_threads=args.num_data_threads, drop_remainder=False)
+				model_path = quantize(generator, calibration_dataset_iterator)
+				print("Quantized generator saved to ", model_path)
+
+			if args.mode == 'distill':
+				print("Start Distilling")
+				distill(generator, train_dataset_iterator, test_dataset_iterator, manager)
+
+			if args.mode == 'prune':
+				print("Start Pruning")
+				prune(generator, discriminator, train_dataset_iterator, test_dataset_iterator)
+
+			if args.mode == 'infer':
+				paths = list_segmaps(args.infer_dir or args.test_img_dir, args.shard_index, args.num_shards)
+				run_inference(generator, paths, args.out_dir, num_segmap_objects(), batch_size=args.infer_batch_size, \
+					num_writers=args.num_writers, n_threads=args.num_data_threads, shard_index=args.shard_index, \
+					tile_margin=args.tile_margin)
+
+			if args.mode == 'evaluate':
+				# Restores every checkpoint itself, so it can run next to training
+				print("Computing the real image activations")
+				evaluator = CheckpointEvaluator(generator, inception(), args.test_img_dir, num_segmap_objects(), \
+					num_samples=args.eval_samples, batch_size=args.eval_batch_size, n_threads=args.num_data_threads, \
+					cache_dir=os.path.dirname(args.eval_log) or '.')
+				print("Following %s, logging to %s" % (args.checkpoint_dir, args.eval_log))
+				follow_checkpoints(evaluator, args.checkpoint_dir, EvaluationLog(args.eval_log), \
+					poll_seconds=args.eval_poll_seconds)
+
 	except RuntimeError as e:
 		print(e)
+	finally:
+		# Also writes the window a run that runs out of memory stopped in
+		if memory_tracker is not None:
+			memory_tracker.close()
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,290 @@
+import argparse
+import csv
+import json
+import os
+import re
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import tensorflow as tf
+
+from code.constants import GENERATOR_PRESETS
+
+"""
+Static cost report of the GAN networks. Traces one training style forward and backward pass of the generator,
+discriminator and VGG loss network at a given resolution and batch size, without running them, and adds up
+per Keras layer (SpadeBlock, SpadeLayer, VGG section, ...) and per convolution the parameters, the
+multiply-adds and the bytes of the tensors the forward and backward passes produce. Compare the CSV/JSON of
+two architectures to see what a change costs before training it.
+
+	python model_report.py --generator-preset mobile --batch-size 8 --json mobile.json
+"""
+
+# Ops whose output is a view of, or a copy of something cheap next to, their input and allocates no activation
+NO_ACTIVATION_OPS = {'Const', 'Placeholder', 'ReadVariableOp', 'Identity', 'IdentityN', 'Reshape', 'Shape', \
+	'ShapeN', 'Size', 'StopGradient', 'ExpandDims', 'Squeeze', 'NoOp', 'VarHandleOp', 'AssignVariableOp', \
+	'ZerosLike', 'OnesLike', 'Fill', 'BroadcastGradientArgs', 'Rank', 'Pack', 'StridedSlice'}
+
+CONV_OPS = {'Conv2D', 'DepthwiseConv2dNative'}
+
+REPORT_FIELDS = ['model', 'name', 'kind', 'depth', 'params', 'forward_macs', 'backward_macs', \
+	'forward_activation_bytes', 'backward_activation_bytes', 'output_shape']
+
+GRADIENT_PREFIX = 'gradient_tape/'
+
+def shape_of(tensor):
+	return [int(side) for side in tensor.shape]
+
+def multiply_adds(op):
+	"""
+	:return: multiply-adds of a convolution, its gradients or a matrix multiplication, 0 for other ops
+	"""
+	if op.type in ('Conv2D', 'Conv2DBackpropInput'):
+		# Every output (resp. incoming gradient) element is a kh x kw x cin dot product
+		kh, kw, cin, _ = shape_of(op.inputs[1])
+		return int(np.prod(shape_of(op.outputs[0] if op.type == 'Conv2D' else op.inputs[2]))) * kh * kw * cin
+	if op.type == 'Conv2DBackpropFilter':
+		kh, kw, cin, _ = shape_of(op.outputs[0])
+		return int(np.prod(shape_of(op.inputs[2]))) * kh * kw * cin
+	if op.type in ('DepthwiseConv2dNative', 'DepthwiseConv2dNativeBackpropInput'):
+		kh, kw, _, _ = shape_of(op.inputs[1])
+		return int(np.prod(shape_of(op.outputs[0] if op.type == 'DepthwiseConv2dNative' else op.inputs[2]))) * kh * kw
+	if op.type == 'DepthwiseConv2dNativeBackpropFilter':
+		kh, kw, _, _ = shape_of(op.outputs[0])
+		return int(np.prod(shape_of(op.inputs[2]))) * kh * kw
+	if op.type in ('MatMul', 'BatchMatMulV2'):
+		a = shape_of(op.inputs[0])
+		inner = a[-2] if op.get_attr('transpose_a' if op.type == 'MatMul' else 'adj_x') else a[-1]
+		return int(np.prod(shape_of(op.outputs[0]))) * inner
+	return 0
+
+def activation_bytes(op):
+	"""
+	:return: bytes of the floating point tensors an op produces
+	"""
+	if op.type in NO_ACTIVATION_OPS:
+		return 0
+	total = 0
+	for output in op.outputs:
+		if output.dtype.is_floating and output.shape.is_fully_defined():
+			total += int(np.prod(shape_of(output))) * output.dtype.size
+	return total
+
+def layer_params(model):
+	"""
+	:return: dict of Keras layer name to its trainable parameter count, sublayers included
+	"""
+	return {layer.name: sum(int(np.prod(v.shape)) for v in layer.trainable_variables) \
+		for layer in model.submodules if isinstance(layer, tf.keras.layers.Layer)}
+
+def forward_conv(op, by_filter, by_input):
+	"""
+	:return: name of the forward convolution a convolution gradient op belongs to, or None
+	"""
+	if op.type in ('Conv2DBackpropInput', 'DepthwiseConv2dNativeBackpropInput'):
+		return by_filter.get(op.inputs[1].name)
+	if op.type in ('Conv2DBackpropFilter', 'DepthwiseConv2dNativeBackpropFilter'):
+		# The same input can feed several convolutions of the same shape, e.g. the SPADE gamma and beta convs.
+		# Their costs are the same, so any one-to-one assignment will do.
+		candidates = by_input.get((op.inputs[0].name, tuple(shape_of(op.outputs[0]))))
+		return candidates.pop() if candidates else None
+	return None
+
+def live_operations(graph):
+	"""
+	:return: the ops of graph, in graph order, that its outputs or stateful updates depend on. TensorFlow prunes
+	the others when it runs the function, e.g. the gradients of the segmap and of other inputs no one asked for.
+	"""
+	live = set()
+	pending = [tensor.op for tensor in graph.outputs] + list(graph.control_outputs)
+	while pending:
+		op = pending.pop()
+		if op.name in live:
+			continue
+		live.add(op.name)
+		pending.extend(tensor.op for tensor in op.inputs)
+		pending.extend(op.control_inputs)
+	return [op for op in graph.get_operations() if op.name in live]
+
+def graph_report(model_name, graph, total_params, params_by_layer):
+	"""
+	Adds up the ops that run in a traced forward and backward pass by Keras layer. Backward ops run in the name
+	scope of the layer they differentiate, under the gradient tape scope, and are matched to their forward
+	convolution through its filter or input tensor.
+
+	:return: list of report rows: the model, every layer and every convolution
+	"""
+	layers = {}
+	convs = {}
+	by_filter = {}
+	by_input = {}
+
+	def row(name, kind, depth, params=None, output_shape=''):
+		return {'model': model_name, 'name': name, 'kind': kind, 'depth': depth, 'params': params, \
+			'forward_macs': 0, 'backward_macs': 0, 'forward_activation_bytes': 0, 'backward_activation_bytes': 0, \
+			'output_shape': output_shape}
+
+	def layer_path(name):
+		# Name scopes of nested layers, down to the first scope that is not a layer (e.g. "moments")
+		parts = []
+		for part in name.split('/')[:-1]:
+			if part not in params_by_layer and re.sub(r'_\d+$', '', part) not in params_by_layer:
+				break
+			parts.append(part)
+		return parts
+
+	operations = live_operations(graph)
+	for op in operations:
+		if op.type in CONV_OPS:
+			parts = layer_path(op.name)
+			kh, kw, cin, cout = shape_of(op.inputs[1])
+			convs[op.name] = row(model_name + '/' + op.name, 'conv' if op.type == 'Conv2D' else 'depthwise conv', \
+				len(parts) + 1, kh * kw * cin * cout, 'x'.join(str(side) for side in shape_of(op.outputs[0])))
+			by_filter[op.inputs[1].name] = op.name
+			by_input.setdefault((op.inputs[0].name, tuple(shape_of(op.inputs[1]))), []).append(op.name)
+
+	for op in operations:
+		backward = op.name.startswith(GRADIENT_PREFIX)
+		direction = 'backward' if backward else 'forward'
+		parts = layer_path(op.name[len(GRADIENT_PREFIX):] if backward else op.name)
+
+		targets = [layers.setdefault('', row(model_name, 'model', 0, total_params))]
+		for depth in range(1, len(parts) + 1):
+			path = '/'.join(parts[:depth])
+			if path not in layers:
+				name = parts[depth - 1]
+				params = params_by_layer.get(name, params_by_layer.get(re.sub(r'_\d+$', '', name)))
+				layers[path] = row(model_name + '/' + path, 'layer', depth, params)
+			targets.append(layers[path])
+		conv = op.name if op.name in convs else forward_conv(op, by_filter, by_input)
+		if conv is not None:
+			targets.append(convs[conv])
+
+		macs = multiply_adds(op)
+		size = activation_bytes(op)
+		for target in targets:
+			target[direction + '_macs'] += macs
+			target[direction + '_activation_bytes'] += size
+
+	# Layers in the order they first run, each right after its parent
+	order = {path: i for i, path in enumerate(layers)}
+	rows = [layers[path] for path in sorted(layers, key=lambda path: [order['/'.join(path.split('/')[:depth])] \
+		for depth in range(1, path.count('/') + 2)] if path else [])]
+	# Each convolution right after the layer it runs in
+	for name in reversed(list(convs)):
+		parts = layer_path(name)
+		parent = '/'.join([model_name] + parts)
+		index = next(i for i, r in enumerate(rows) if r['name'] == parent)
+		rows.insert(index + 1, convs[name])
+	return rows
+
+def trace(fn, *input_specs):
+	return tf.function(fn).get_concrete_function(*input_specs).graph
+
+def generator_report(args):
+	from code.generator import SPADEGenerator, load_block_configs
+	block_configs = load_block_configs(args.generator_config) if args.generator_config else None
+	generator = SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.img_w, img_h=args.img_h, \
+		preset=args.generator_preset, block_configs=block_configs, separable=args.separable_convs, \
+		fused_spade=args.fused_spade, share_segmap_trunk=args.share_segmap_trunk, fused_upsample=args.fused_upsample)
+	generator.call(None, tf.zeros([1, args.img_h, args.img_w, args.segmap_filters]))
+
+	def step(segmaps):
+		with tf.GradientTape() as tape:
+			loss = tf.reduce_mean(generator.call(None, segmaps))
+		return tape.gradient(loss, generator.synthesis_variables())
+
+	graph = trace(step, tf.TensorSpec([args.batch_size, args.img_h, args.img_w, args.segmap_filters]))
+	params = sum(int(np.prod(v.shape)) for v in generator.synthesis_variables())
+	return graph_report('generator', graph, params, layer_params(generator))
+
+def discriminator_report(args):
+	from code.discriminator import Discriminator
+	discriminator = Discriminator(args.segmap_filters)
+	discriminator(tf.zeros([1, args.img_h, args.img_w, 3]), tf.zeros([1, args.img_h, args.img_w, args.segmap_filters]))
+
+	def step(images, segmaps):
+		with tf.GradientTape() as tape:
+			loss = tf.reduce_mean(discriminator.call(images, segmaps))
+		return tape.gradient(loss, discriminator.trainable_variables)
+
+	graph = trace(step, tf.TensorSpec([args.batch_size, args.img_h, args.img_w, 3]), \
+		tf.TensorSpec([args.batch_size, args.img_h, args.img_w, args.segmap_filters]))
+	params = sum(int(np.prod(v.shape)) for v in discriminator.trainable_variables)
+	return graph_report('discriminator', graph, params, layer_params(discriminator))
+
+def vgg_report(args):
+	from code.vgg import VGG_Loss
+	vgg_loss = VGG_Loss()
+
+	# One pass over a batch with the gradient the generator needs, with respect to the images. The VGG weights
+	# are frozen, so they get no gradient.
+	def step(images):
+		with tf.GradientTape() as tape:
+			tape.watch(images)
+			loss = tf.add_n([tf.reduce_mean(feature) for feature in vgg_loss.features(images)])
+		return tape.gradient(loss, images)
+
+	graph = trace(step, tf.TensorSpec([args.batch_size, args.img_h, args.img_w, 3]))
+	params = sum(int(np.prod(v.shape)) for v in vgg_loss.variables)
+	# Frozen layers have no trainable variables, count all of them
+	params_by_layer = {layer.name: sum(int(np.prod(v.shape)) for v in layer.variables) \
+		for layer in vgg_loss.submodules if isinstance(layer, tf.keras.layers.Layer)}
+	return graph_report('vgg', graph, params, params_by_layer)
+
+MODEL_REPORTS = {'generator': generator_report, 'discriminator': discriminator_report, 'vgg': vgg_report}
+
+def print_report(rows, max_depth):
+	print("%-58s %11s %11s %11s %11s %11s" % ('layer', 'params (K)', 'fwd GMACs', 'bwd GMACs', 'fwd MB', 'bwd MB'))
+	for r in rows:
+		if r['depth'] > max_depth:
+			continue
+		params = '-' if r['params'] is None else '%.1f' % (r['params'] / 1e3)
+		print("%-58s %11s %11.3f %11.3f %11.1f %11.1f" % ('  ' * r['depth'] + '/'.join(r['name'].split('/')[r['depth']:]), params, \
+			r['forward_macs'] / 1e9, r['backward_macs'] / 1e9, r['forward_activation_bytes'] / 2**20, \
+			r['backward_activation_bytes'] / 2**20))
+
+def main():
+	parser = argparse.ArgumentParser(description='GAUGAN per layer parameter, multiply-add and activation memory report')
+	parser.add_argument('--models', type=str, nargs='+', default=sorted(MODEL_REPORTS), choices=sorted(MODEL_REPORTS))
+	parser.add_argument('--batch-size', type=int, default=16)
+	parser.add_argument('--img-h', type=int, default=96)
+	parser.add_argument('--img-w', type=int, default=128)
+	parser.add_argument('--segmap-filters', type=int, default=61)
+	parser.add_argument('--z-dim', type=int, default=64)
+	parser.add_argument('--generator-preset', type=str, default='full', choices=sorted(GENERATOR_PRESETS))
+	parser.add_argument('--generator-config', type=str, default=None, help='Block configs of a pruned generator')
+	parser.add_argument('--separable-convs', type=str, nargs='*', default=[], choices=['spade', 'block'])
+	parser.add_argument('--fused-spade', action='store_true')
+	parser.add_argument('--share-segmap-trunk', action='store_true')
+	parser.add_argument('--fused-upsample', action='store_true')
+	parser.add_argument('--depth', type=int, default=2, help='Deepest layer nesting printed, the exports have all rows')
+	parser.add_argument('--csv', type=str, default=None, help='Write all rows to this CSV file')
+	parser.add_argument('--json', type=str, default=None, help='Write all rows and the settings to this JSON file')
+	args = parser.parse_args()
+
+	rows = []
+	for model in args.models:
+		model_rows = MODEL_REPORTS[model](args)
+		print("\n%s, batch %d at %dx%d" % (model, args.batch_size, args.img_h, args.img_w))
+		print_report(model_rows, args.depth)
+		rows += model_rows
+
+	totals = [r for r in rows if r['kind'] == 'model']
+	print("\nTotal: %.2fM params, %.2f forward + %.2f backward GMACs, %.1f forward + %.1f backward MB of activations" % \
+		(sum(r['params'] for r in totals) / 1e6, sum(r['forward_macs'] for r in totals) / 1e9, \
+		sum(r['backward_macs'] for r in totals) / 1e9, sum(r['forward_activation_bytes'] for r in totals) / 2**20, \
+		sum(r['backward_activation_bytes'] for r in totals) / 2**20))
+
+	if args.csv:
+		with open(args.csv, 'w') as csvfile:
+			writer = csv.DictWriter(csvfile, fieldnames=REPORT_FIELDS)
+			writer.writeheader()
+			writer.writerows(rows)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump({'settings': vars(args), 'rows': rows}, f, indent=1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,154 @@
+import argparse
+import glob
+import os
+import time
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+
+from code.preprocess import load_image_batch, num_segmap_objects, decode_segmap_labels, segmap_pyramid
+
+"""
+Input pipeline profiler. Times every stage of preprocess.load_image_batch on its own, without the model, to
+find the stage that limits the samples per second, then runs the whole pipeline over a grid of thread and
+prefetch settings and reports the fastest one on this machine.
+
+	python profile_data.py --train-img-dir ./data/landscape_data/train --threads 1 2 4 8 --prefetch 1 2 -1
+"""
+
+def image_path(segmap_path):
+	return segmap_path[:-len('_seg.png')] + '.jpg'
+
+def read_pair(segmap_path):
+	"""
+	:return: the encoded segmap and real image, as load_image_batch reads them
+	"""
+	image = tf.strings.join([tf.strings.substr(segmap_path, 0, tf.strings.length(segmap_path) - 8), '.jpg'])
+	return tf.io.read_file(segmap_path), tf.io.read_file(image)
+
+def decode_image(png):
+	return tf.image.convert_image_dtype(tf.io.decode_png(png, channels=3), tf.float32)
+
+def throughput(dataset, num_elements):
+	"""
+	:return: elements per second over num_elements elements of dataset, after one warm up element
+	"""
+	iterator = iter(dataset.repeat())
+	next(iterator)
+	start = time.perf_counter()
+	for _ in range(num_elements):
+		next(iterator)
+	return num_elements / (time.perf_counter() - start)
+
+def stage_inputs(paths, num_objects):
+	"""
+	:return: the input of every stage for the sampled files, kept in memory so each stage is timed alone
+	"""
+	segmap_bytes = [tf.io.read_file(path) for path in paths]
+	image_bytes = [tf.io.read_file(image_path(path)) for path in paths]
+	labels = [decode_segmap_labels(png, num_objects) for png in segmap_bytes]
+	return {'paths': tf.constant(paths), 'segmap_bytes': tf.stack(segmap_bytes), \
+		'image_bytes': tf.stack(image_bytes), 'labels': tf.stack(labels)}
+
+def stages(inputs, num_objects, pyramid_sizes=None):
+	"""
+	:return: list of (stage name, dataset of that stage's input, per element function)
+	"""
+	result = [('read', inputs['paths'], read_pair), \
+		('image decode', inputs['image_bytes'], decode_image), \
+		('segmap decode', inputs['segmap_bytes'], lambda png: decode_segmap_labels(png, num_objects)), \
+		('one-hot', inputs['labels'], lambda labels: tf.one_hot(labels, num_objects))]
+	if pyramid_sizes is not None:
+		result.append(('pyramid', inputs['labels'], lambda labels: segmap_pyramid(tf.one_hot(labels, num_objects), \
+			pyramid_sizes)))
+	return result
+
+def profile_stages(args, paths, num_objects, pyramid_sizes):
+	"""
+	:return: dict of stage name to samples per second at the largest thread count
+	"""
+	# Every pass over the dataset lists the directory again, time a second pass
+	listed = tf.data.Dataset.list_files(os.path.join(args.train_img_dir, '*.png'), shuffle=False)
+	sum(1 for _ in listed)
+	start = time.perf_counter()
+	num_files = sum(1 for _ in listed)
+	listing = num_files / (time.perf_counter() - start)
+
+	inputs = stage_inputs(paths[:args.num_samples], num_objects)
+	threads = max(args.threads)
+	print("%-14s %16s %18s" % ('stage', '1 thread (/s)', '%d threads (/s)' % threads))
+	print("%-14s %16.0f %18s" % ('list files', listing, '-'))
+	# Listing happens once per epoch, so it is a per sample cost too
+	results = {'list files': listing}
+	for name, stage_input, fn in stages(inputs, num_objects, pyramid_sizes):
+		dataset = tf.data.Dataset.from_tensor_slices(stage_input)
+		single = throughput(dataset.map(fn, num_parallel_calls=1), args.num_elements)
+		parallel = throughput(dataset.map(fn, num_parallel_calls=threads), args.num_elements)
+		print("%-14s %16.0f %18.0f" % (name, single, parallel))
+		results[name] = parallel
+
+	# Batching on its own, over already decoded samples
+	one_hot = tf.one_hot(inputs['labels'], num_objects)
+	images = tf.data.Dataset.from_tensor_slices(inputs['image_bytes']).map(decode_image)
+	decoded = tf.data.Dataset.zip((images, tf.data.Dataset.from_tensor_slices(one_hot))).cache()
+	batched = throughput(decoded.batch(args.batch_size), args.num_elements // args.batch_size) * args.batch_size
+	print("%-14s %16.0f %18s" % ('batch', batched, '-'))
+	results['batch'] = batched
+	return results
+
+def profile_pipeline(args, num_objects, pyramid_sizes):
+	"""
+	:return: list of (threads, prefetch, samples per second) of the whole load_image_batch pipeline
+	"""
+	results = []
+	print("\n%-8s %9s %14s" % ('threads', 'prefetch', 'samples/s'))
+	for threads in args.threads:
+		for prefetch in args.prefetch:
+			dataset = load_image_batch(args.train_img_dir, batch_size=args.batch_size, n_threads=threads, \
+				pyramid_sizes=pyramid_sizes, prefetch_size=prefetch)
+			samples = throughput(dataset, args.num_elements // args.batch_size) * args.batch_size
+			print("%-8d %9s %14.0f" % (threads, 'auto' if prefetch == tf.data.AUTOTUNE else prefetch, samples))
+			results.append((threads, prefetch, samples))
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description='GAUGAN input pipeline profiler')
+	parser.add_argument('--train-img-dir', type=str, default='./data/landscape_data/train')
+	parser.add_argument('--batch-size', type=int, default=8)
+	parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='--num-data-threads values to try')
+	parser.add_argument('--prefetch', type=int, nargs='+', default=[1, 2, tf.data.AUTOTUNE],
+		help='--prefetch-batches values to try, -1 lets tf.data decide')
+	parser.add_argument('--num-samples', type=int, default=64, help='files kept in memory to time the stages on')
+	parser.add_argument('--num-elements', type=int, default=512, help='samples timed per measurement')
+	parser.add_argument('--segmap-pyramid', action='store_true', help='also profile the segmap pyramid stage')
+	parser.add_argument('--img-h', type=int, default=96)
+	parser.add_argument('--img-w', type=int, default=128)
+	args = parser.parse_args()
+
+	paths = sorted(glob.glob(os.path.join(args.train_img_dir, '*.png')))
+	if not paths:
+		raise SystemExit("No segmaps in %s" % args.train_img_dir)
+	num_objects = num_segmap_objects()
+	# The generator's resolutions, see SPADEGenerator.segmap_pyramid_sizes
+	pyramid_sizes = [(args.img_h // 2 ** i, args.img_w // 2 ** i) for i in range(5, -1, -1)] \
+		if args.segmap_pyramid else None
+	print("%d segmaps in %s, %d cores\n" % (len(paths), args.train_img_dir, len(os.sched_getaffinity(0))))
+
+	stage_results = profile_stages(args, paths, num_objects, pyramid_sizes)
+	pipeline_results = profile_pipeline(args, num_objects, pyramid_sizes)
+
+	slowest = min(stage_results, key=stage_results.get)
+	threads, prefetch, samples = max(pipeline_results, key=lambda result: result[2])
+	print("\nSlowest stage: %s at %.0f samples/s with %d threads" % (slowest, stage_results[slowest], \
+		max(args.threads)))
+	print("Fastest pipeline: %.0f samples/s with --num-data-threads %d --prefetch-batches %d" % (samples, threads, \
+		prefetch))
+	if samples > 0.8 * stage_results[slowest]:
+		print("The pipeline runs close to its slowest stage: speed that stage up (more cores if it scales with "
+			"threads, a cheaper format if not)")
+	else:
+		print("The pipeline stays well below its slowest stage: look at the per element overhead and batching")
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,170 @@
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+
+from code.generator import SPADEGenerator, GENERATOR_PRESETS, load_block_configs
+from code.preprocess import decode_segmap_png
+from code.modulation_cache import ModulationCache
+from code.serving import DynamicBatcher, CheckpointWatcher, load_generator, latency_summary
+
+"""
+Local synthesis server. POST a grayscale label map PNG to /synthesize and get the generated image back as a
+PNG; GET /health reports the checkpoint being served and batching counters.
+
+	python serve.py serve --checkpoint-dir ./checkpoints
+	python serve.py load --segmap-dir ./data/landscape_data/test --concurrency 16
+"""
+
+def make_handler(batcher, watcher, args):
+	class SynthesisHandler(BaseHTTPRequestHandler):
+		def reply(self, status, content_type, body):
+			self.send_response(status)
+			self.send_header('Content-Type', content_type)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_GET(self):
+			if self.path != '/health':
+				return self.reply(404, 'text/plain', b'not found')
+			status = {'checkpoint': watcher.checkpoint_path, 'queued': batcher.requests.qsize(), \
+				'batches': batcher.batches_served, 'images': batcher.images_served}
+			if batcher.cache is not None:
+				status['cache'] = {'hits': batcher.cache.hits, 'misses': batcher.cache.misses, \
+					'entries': len(batcher.cache.entries), 'bytes': batcher.cache.bytes}
+			self.reply(200, 'application/json', json.dumps(status).encode())
+
+		def do_POST(self):
+			if self.path != '/synthesize':
+				return self.reply(404, 'text/plain', b'not found')
+			try:
+				png = self.rfile.read(int(self.headers['Content-Length']))
+				segmap = decode_segmap_png(png, args.segmap_filters)
+				segmap = tf.image.resize(tf.ensure_shape(segmap, [None, None, None]), (args.img_h, args.img_w), \
+					method="nearest")
+			except Exception as e:
+				return self.reply(400, 'text/plain', str(e).encode())
+
+			image = batcher.submit(segmap).result()
+			image = tf.cast(tf.clip_by_value(image * 255, 0, 255), tf.uint8)
+			self.reply(200, 'image/png', tf.io.encode_png(image).numpy())
+
+		def log_message(self, format, *log_args):
+			# One line per request would dominate a load test
+			pass
+
+	return SynthesisHandler
+
+def serve(args):
+	block_configs = load_block_configs(args.generator_config) if args.generator_config else None
+	def build_generator():
+		return SPADEGenerator(args.segmap_filters, z_dim=args.z_dim, img_w=args.img_w, img_h=args.img_h, \
+			preset=args.generator_preset, block_configs=block_configs, fused_spade=args.fused_spade, \
+			share_segmap_trunk=args.share_segmap_trunk, fused_upsample=args.fused_upsample, \
+			separable=args.separable_convs)
+
+	checkpoint_path = tf.train.latest_checkpoint(args.checkpoint_dir)
+	if checkpoint_path is None:
+		print("No checkpoint in %s yet, serving an untrained generator" % args.checkpoint_dir)
+	cache = ModulationCache(args.modulation_cache_mb * 2**20) if args.modulation_cache_mb > 0 else None
+	batcher = DynamicBatcher(load_generator(build_generator, checkpoint_path), max_batch_size=args.max_batch_size, \
+		max_wait=args.max_wait_ms / 1000, cache=cache, checkpoint_id=checkpoint_path)
+	watcher = CheckpointWatcher(batcher, args.checkpoint_dir, build_generator, poll_seconds=args.poll_seconds, \
+		checkpoint_path=checkpoint_path)
+
+	server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, watcher, args))
+	print("Serving %s on http://%s:%d" % (checkpoint_path, args.host, args.port))
+	server.serve_forever()
+
+def load(args):
+	segmaps = []
+	for path in sorted(glob.glob(os.path.join(args.segmap_dir, '*.png'))):
+		with open(path, 'rb') as f:
+			segmaps.append(f.read())
+	if not segmaps:
+		raise SystemExit("No segmaps in %s" % args.segmap_dir)
+
+	url = args.url.rstrip('/') + '/synthesize'
+	latencies = []
+	errors = []
+	lock = threading.Lock()
+	counter = iter(range(args.requests))
+
+	def client():
+		# Closed loop: every client sends its next request as soon as the previous one returns
+		for i in counter:
+			request = urllib.request.Request(url, data=segmaps[i % len(segmaps)], \
+				headers={'Content-Type': 'image/png'})
+			start = time.perf_counter()
+			try:
+				urllib.request.urlopen(request).read()
+			except Exception as e:
+				with lock:
+					errors.append(e)
+				continue
+			with lock:
+				latencies.append(time.perf_counter() - start)
+
+	start = time.perf_counter()
+	clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+	for thread in clients:
+		thread.start()
+	for thread in clients:
+		thread.join()
+	seconds = time.perf_counter() - start
+
+	if not latencies:
+		raise SystemExit("All %d requests failed: %s" % (len(errors), errors[0]))
+	summary = latency_summary(latencies, seconds)
+	print("%d requests, %d errors, concurrency %d" % (summary['requests'], len(errors), args.concurrency))
+	print("p50 %.1f ms, p99 %.1f ms, %.1f images/s" % (summary['p50_ms'], summary['p99_ms'], summary['throughput']))
+
+def main():
+	parser = argparse.ArgumentParser(description='GAUGAN synthesis server')
+	subparsers = parser.add_subparsers(dest='command')
+	subparsers.required = True
+
+	server = subparsers.add_parser('serve', help='Serve the latest checkpoint over HTTP')
+	server.add_argument('--checkpoint-dir', type=str, default='./checkpoints')
+	server.add_argument('--host', type=str, default='127.0.0.1')
+	server.add_argument('--port', type=int, default=8000)
+	server.add_argument('--max-batch-size', type=int, default=16)
+	server.add_argument('--max-wait-ms', type=float, default=10,
+		help='How long the oldest request waits for a batch to fill up')
+	server.add_argument('--poll-seconds', type=float, default=30,
+		help='How often the checkpoint directory is checked for a newer checkpoint')
+	server.add_argument('--modulation-cache-mb', type=float, default=0,
+		help='Cache the segmap branch of repeated segmaps in up to this many MB, 0 disables')
+	server.add_argument('--generator-preset', type=str, default='full', choices=sorted(GENERATOR_PRESETS))
+	server.add_argument('--generator-config', type=str, default=None)
+	server.add_argument('--separable-convs', type=str, nargs='*', default=[], choices=['spade', 'block'])
+	server.add_argument('--fused-spade', action='store_true')
+	server.add_argument('--share-segmap-trunk', action='store_true')
+	server.add_argument('--fused-upsample', action='store_true')
+	server.add_argument('--img-h', type=int, default=96)
+	server.add_argument('--img-w', type=int, default=128)
+	server.add_argument('--z-dim', type=int, default=64)
+	server.add_argument('--segmap-filters', type=int, default=61)
+	server.set_defaults(run=serve)
+
+	load_test = subparsers.add_parser('load', help='Load test a running server')
+	load_test.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+	load_test.add_argument('--segmap-dir', type=str, default='./data/landscape_data/test')
+	load_test.add_argument('--requests', type=int, default=500)
+	load_test.add_argument('--concurrency', type=int, default=16)
+	load_test.set_defaults(run=load)
+
+	args = parser.parse_args()
+	args.run(args)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,327 @@
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+"""
+Hyperparameter sweep on one machine. Runs the trials of a grid or random search spec as main.py --mode train
+subprocesses, several at a time. Every running trial gets its own share of the cores, pinned with
+sched_setaffinity and matched by its TensorFlow and data loading threads, and its own share of the memory; a
+trial that grows past its share is stopped instead of the whole machine swapping. Trials whose FID (or loss)
+clearly lags behind the others at the same epoch are stopped early (median stopping rule) and the next trial
+takes over their cores. The per epoch logs of all trials end up in one results table.
+
+A spec is a JSON file. Keys are main.py arguments as in argparse (gen_learn_rate for --gen-learn-rate); a
+value that is an object sets several arguments at once, e.g. {"img_h": 48, "img_w": 64} for a resolution.
+
+	{"grid": {"gen_learn_rate": [0.0001, 0.0002], "lambda_vgg": [5, 10]},
+	 "fixed": {"num_epochs": 10, "fid_every": 50}}
+
+	{"random": {"gen_learn_rate": {"log_uniform": [1e-5, 1e-3]}, "z_dim": {"choice": [32, 64]},
+	            "resolution": {"choice": [{"img_h": 48, "img_w": 64}, {"img_h": 96, "img_w": 128}]}},
+	 "trials": 12, "fixed": {"num_epochs": 10}}
+
+	python sweep.py spec.json --parallel 4 --log-dir ./sweeps/lr
+"""
+
+RESULT_FIELDS = ['trial', 'status', 'epochs', 'fid', 'best_fid', 'g_loss', 'd_loss', 'images_per_second', \
+	'seconds', 'cores', 'settings']
+
+# Columns of the fid_losses_train.csv main.py writes every epoch
+EPOCH_COLUMNS = {'Epoch Num': 'epoch', 'Average FID': 'fid', 'Average Generator Loss': 'g_loss', \
+	'Average Discriminator Loss': 'd_loss'}
+
+def sample(distribution, rng):
+	"""
+	:param distribution: {"choice": [...]}, {"uniform": [low, high]}, {"log_uniform": [low, high]},
+	{"int_uniform": [low, high]} or a fixed value
+	"""
+	if not isinstance(distribution, dict) or len(distribution) != 1:
+		return distribution
+	kind, values = next(iter(distribution.items()))
+	if kind == 'choice':
+		return rng.choice(values)
+	if kind == 'uniform':
+		return rng.uniform(*values)
+	if kind == 'log_uniform':
+		return math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+	if kind == 'int_uniform':
+		return rng.randint(*values)
+	return distribution
+
+def expand(settings):
+	"""
+	:return: settings with the object values, which set several arguments, merged in
+	"""
+	result = {}
+	for name, value in settings.items():
+		if isinstance(value, dict):
+			result.update(value)
+		else:
+			result[name] = value
+	return result
+
+def spec_trials(spec, seed=0):
+	"""
+	:return: list of the argument settings of every trial of a spec
+	"""
+	fixed = spec.get('fixed', {})
+	if 'grid' in spec:
+		names = sorted(spec['grid'])
+		combinations = itertools.product(*[spec['grid'][name] for name in names])
+		trials = [dict(zip(names, values)) for values in combinations]
+	elif 'random' in spec:
+		rng = random.Random(seed)
+		trials = [{name: sample(distribution, rng) for name, distribution in sorted(spec['random'].items())} \
+			for _ in range(spec.get('trials', 10))]
+	else:
+		raise ValueError("A sweep spec needs a \"grid\" or a \"random\" section")
+	return [expand(dict(fixed, **trial)) for trial in trials]
+
+def core_groups(cores, parallel):
+	"""
+	:return: parallel disjoint lists of cores, as equal in size as possible
+	"""
+	size, remainder = divmod(len(cores), parallel)
+	groups = []
+	start = 0
+	for i in range(parallel):
+		end = start + size + (1 if i < remainder else 0)
+		groups.append(cores[start:end])
+		start = end
+	return groups
+
+def total_memory():
+	"""
+	:return: bytes of physical memory, or None where /proc/meminfo is not available
+	"""
+	try:
+		with open('/proc/meminfo', 'r') as f:
+			for line in f:
+				if line.startswith('MemTotal:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	return None
+
+def process_rss(pid):
+	try:
+		with open('/proc/%d/statm' % pid, 'r') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, IndexError, ValueError):
+		return 0
+
+def read_epochs(path):
+	"""
+	:return: list of dicts (epoch, fid, g_loss, d_loss) of the epochs a trial finished so far
+	"""
+	if not os.path.exists(path):
+		return []
+	epochs = []
+	with open(path, 'r') as f:
+		for row in csv.DictReader(f):
+			try:
+				epochs.append({key: float(row[column]) for column, key in EPOCH_COLUMNS.items()})
+			except (TypeError, ValueError):
+				# The last line may still be being written
+				break
+	return epochs
+
+class Trial(object):
+	def __init__(self, index, settings, directory):
+		self.index = index
+		self.settings = settings
+		self.directory = directory
+		self.process = None
+		self.output = None
+		self.cores = []
+		self.status = 'pending'
+		self.epochs = []
+		self.start = None
+		self.end = None
+
+	def command(self, args):
+		flags = dict(self.settings)
+		# Threads matching the pinned cores, unless the spec sets them
+		flags.setdefault('intra_op_threads', len(self.cores))
+		flags.setdefault('inter_op_threads', 1)
+		flags.setdefault('num_data_threads', len(self.cores))
+		flags.update({'mode': 'train', 'log_dir': os.path.join(self.directory, 'logs'), \
+			'checkpoint_dir': os.path.join(self.directory, 'checkpoints'), \
+			'out_dir': os.path.join(self.directory, 'output'), 'stats_file': os.path.join(self.directory, 'stats.json')})
+		command = [sys.executable, args.main]
+		for name, value in sorted(flags.items()):
+			if value is True:
+				command.append('--' + name.replace('_', '-'))
+			elif value is not False and value is not None:
+				command += ['--' + name.replace('_', '-')] + [str(item) for item in (value if isinstance(value, list) else [value])]
+		return command
+
+	def launch(self, args, cores):
+		self.cores = cores
+		if not os.path.exists(self.directory):
+			os.makedirs(self.directory)
+		with open(os.path.join(self.directory, 'settings.json'), 'w') as f:
+			json.dump(self.settings, f, indent=1)
+		# Logs of an earlier sweep into the same directory would count as epochs of this trial
+		for stale in (os.path.join(self.directory, 'logs', 'fid_losses_train.csv'), \
+			os.path.join(self.directory, 'stats.json')):
+			if os.path.exists(stale):
+				os.remove(stale)
+		self.output = open(os.path.join(self.directory, 'output.log'), 'w')
+		self.process = subprocess.Popen(self.command(args), stdout=self.output, stderr=subprocess.STDOUT, \
+			preexec_fn=lambda: os.sched_setaffinity(0, cores))
+		self.status = 'running'
+		self.start = time.time()
+
+	def stop(self, status):
+		if self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+		self.finish(status)
+
+	def finish(self, status):
+		self.status = status
+		self.end = time.time()
+		self.output.close()
+		self.epochs = read_epochs(os.path.join(self.directory, 'logs', 'fid_losses_train.csv'))
+
+	def best(self, metric, epoch):
+		"""
+		:return: best value of metric over the first epoch + 1 epochs, None if there is none
+		"""
+		values = [e[metric] for e in self.epochs[:epoch + 1] if not math.isnan(e[metric])]
+		return min(values) if values else None
+
+	def row(self):
+		stats = {}
+		stats_path = os.path.join(self.directory, 'stats.json')
+		if os.path.exists(stats_path):
+			with open(stats_path, 'r') as f:
+				stats = json.load(f)
+		last = self.epochs[-1] if self.epochs else {}
+		return {'trial': self.index, 'status': self.status, 'epochs': len(self.epochs), 'fid': last.get('fid'), \
+			'best_fid': self.best('fid', len(self.epochs)), 'g_loss': last.get('g_loss'), 'd_loss': last.get('d_loss'), \
+			'images_per_second': stats.get('images_per_second'), \
+			'seconds': round(self.end - self.start, 1) if self.start and self.end else None, \
+			'cores': ' '.join(str(core) for core in self.cores), 'settings': json.dumps(self.settings, sort_keys=True)}
+
+def lagging(trial, trials, args):
+	"""
+	Median stopping rule: a trial lags if the best metric it reached by its latest epoch is worse, by more than
+	the margin, than the median of the best metrics other trials reached by the same epoch
+
+	:return: whether trial should be stopped
+	"""
+	epoch = len(trial.epochs) - 1
+	if epoch < args.grace_epochs:
+		return False
+	best = trial.best(args.metric, epoch)
+	peers = [other.best(args.metric, epoch) for other in trials if other is not trial and len(other.epochs) > epoch]
+	peers = sorted(value for value in peers if value is not None)
+	if best is None or len(peers) < args.min_peers:
+		return False
+	median = peers[len(peers) // 2] if len(peers) % 2 else (peers[len(peers) // 2 - 1] + peers[len(peers) // 2]) / 2
+	return best > median + args.stop_margin * abs(median)
+
+def run_sweep(args, trials):
+	"""
+	Runs the trials, at most --parallel at a time, each pinned to its own group of cores
+	"""
+	groups = core_groups(sorted(os.sched_getaffinity(0)), args.parallel)
+	memory_limit = args.memory_gb * 2**30 / args.parallel if args.memory_gb else None
+	free_groups = list(range(len(groups)))
+	running = {}
+	pending = list(trials)
+
+	while pending or running:
+		while pending and free_groups:
+			group = free_groups.pop(0)
+			trial = pending.pop(0)
+			trial.launch(args, groups[group])
+			running[trial.index] = (trial, group)
+			print("Trial %d started on cores %s: %s" % (trial.index, ','.join(str(core) for core in groups[group]), \
+				json.dumps(trial.settings, sort_keys=True)))
+
+		time.sleep(args.poll_seconds)
+		for index, (trial, group) in list(running.items()):
+			trial.epochs = read_epochs(os.path.join(trial.directory, 'logs', 'fid_losses_train.csv'))
+			returncode = trial.process.poll()
+			if returncode is not None:
+				trial.finish('done' if returncode == 0 else 'failed')
+			elif memory_limit and process_rss(trial.process.pid) > memory_limit:
+				trial.stop('memory')
+			elif lagging(trial, trials, args):
+				trial.stop('stopped')
+			else:
+				continue
+			print("Trial %d %s after %d epochs" % (trial.index, trial.status, len(trial.epochs)))
+			del running[index]
+			free_groups.append(group)
+
+def print_results(rows):
+	print("\n%-6s %-8s %7s %9s %9s %9s %9s %9s  %s" % ('trial', 'status', 'epochs', 'fid', 'best fid', 'g loss', \
+		'd loss', 'images/s', 'settings'))
+	number = lambda value: '-' if value is None or (isinstance(value, float) and math.isnan(value)) else '%.3f' % value
+	for row in rows:
+		print("%-6d %-8s %7d %9s %9s %9s %9s %9s  %s" % (row['trial'], row['status'], row['epochs'], number(row['fid']), \
+			number(row['best_fid']), number(row['g_loss']), number(row['d_loss']), number(row['images_per_second']), \
+			row['settings']))
+
+def main():
+	parser = argparse.ArgumentParser(description='GAUGAN hyperparameter sweep over main.py trials on one machine')
+	parser.add_argument('spec', type=str, help='JSON file with a "grid" or "random" section, see sweep.py')
+	parser.add_argument('--main', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'))
+	parser.add_argument('--log-dir', type=str, default='./sweeps', help='Trial directories and the results table go here')
+	parser.add_argument('--parallel', type=int, default=2, help='Number of trials running at once, each on its own cores')
+	parser.add_argument('--memory-gb', type=float, default=None,
+		help='Memory shared by the running trials, 90%% of the physical memory by default. 0 disables the limit')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the random search')
+	parser.add_argument('--metric', type=str, default='fid', choices=['fid', 'g_loss', 'd_loss'],
+		help='Per epoch metric (lower is better) the early stopping compares trials on')
+	parser.add_argument('--grace-epochs', type=int, default=1, help='Epochs every trial runs before it can be stopped early')
+	parser.add_argument('--min-peers', type=int, default=2,
+		help='Trials that have to have reached an epoch before others are compared with them at that epoch')
+	parser.add_argument('--stop-margin', type=float, default=0.1,
+		help='How much worse than the median of the other trials, relatively, a trial has to be to be stopped early')
+	parser.add_argument('--poll-seconds', type=float, default=10)
+	args = parser.parse_args()
+
+	if args.memory_gb is None:
+		memory = total_memory()
+		args.memory_gb = 0.9 * memory / 2**30 if memory else 0
+
+	with open(args.spec, 'r') as f:
+		spec = json.load(f)
+	trials = [Trial(i, settings, os.path.join(args.log_dir, 'trial%03d' % i)) \
+		for i, settings in enumerate(spec_trials(spec, args.seed))]
+	args.parallel = max(1, min(args.parallel, len(trials), len(os.sched_getaffinity(0))))
+	print("%d trials, %d at a time, %.1f GB of memory each" % (len(trials), args.parallel, \
+		args.memory_gb / args.parallel))
+
+	try:
+		run_sweep(args, trials)
+	finally:
+		for trial in trials:
+			if trial.status == 'running':
+				trial.stop('killed')
+		rows = [trial.row() for trial in trials if trial.status != 'pending']
+		if not os.path.exists(args.log_dir):
+			os.makedirs(args.log_dir)
+		results_path = os.path.join(args.log_dir, 'results.csv')
+		with open(results_path, 'w') as csvfile:
+			writer = csv.DictWriter(csvfile, fieldnames=RESULT_FIELDS)
+			writer.writeheader()
+			writer.writerows(rows)
+		key = lambda row: (row['best_fid'] is None or math.isnan(row['best_fid']), row['best_fid'] or 0)
+		print_results(sorted(rows, key=key))
+		print("Results written to %s" % results_path)
+
+if __name__ == '__main__':
+	main()